@@ -0,0 +1,367 @@
+"""
+Load and latency benchmark for the KidsMentor backend.
+
+Drives the main endpoints in-process (ASGI, no network) or against a running
+server, with the fake LLM backend standing in for Gemini. Reports throughput,
+p50/p95/p99 latency, event-loop lag and CPU time per request for each endpoint
+and concurrency level, plus time to first request for a freshly started server,
+and saves JSON results that can be compared between commits.
+
+Examples:
+    python benchmark.py
+    python benchmark.py --concurrency 1 16 64 --requests 400 --output results.json
+    python benchmark.py --compare baseline.json --output current.json
+    python benchmark.py --endpoints lesson --lesson-items 200
+    python benchmark.py --url http://localhost:8000 --endpoints health subjects
+    python benchmark.py --endpoints health --startup-runs 5
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Any, Dict, List, Optional
+
+ENDPOINTS = ["lesson", "story", "chat", "subjects", "health"]
+
+TOPICS = ["Addition", "Plants", "Phonics", "Maps", "Colors", "Weather", "Shapes", "Rhyming"]
+
+
+def build_request(endpoint: str, i: int, use_cache: bool):
+    """Return (method, path, json body) for the i-th request to endpoint"""
+    if endpoint == "lesson":
+        return "POST", "/generate-lesson", {
+            "student_id": i,
+            "current_topic": TOPICS[i % len(TOPICS)],
+            "last_quiz_score": 50 + (i % 50),
+            "learning_objectives": ["Learn the basics"],
+            "bypass_cache": not use_cache,
+        }
+    if endpoint == "story":
+        # A unique theme per request defeats the story cache unless caching is requested
+        return "POST", "/api/story/generate", {
+            "theme": "" if use_cache else f"benchmark theme {i}",
+            "age_group": "4-5",
+            "category": "Adventure",
+        }
+    if endpoint == "chat":
+        return "POST", "/api/tutoring/chat", {
+            "query": f"What is {TOPICS[i % len(TOPICS)].lower()}?",
+            "conversationId": f"benchmark-{i}",
+            "studentProfile": {"interests": ["animals"], "preferredDifficulty": "beginner", "learningStyle": "visual"},
+        }
+    if endpoint == "subjects":
+        return "GET", "/api/subjects", None
+    if endpoint == "health":
+        return "GET", "/health", None
+    raise ValueError(f"Unknown endpoint '{endpoint}'")
+
+
+def percentile(values: List[float], pct: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def summarize(values: List[float]) -> Dict[str, float]:
+    return {
+        "p50": round(percentile(values, 50), 3),
+        "p95": round(percentile(values, 95), 3),
+        "p99": round(percentile(values, 99), 3),
+        "mean": round(statistics.fmean(values), 3) if values else 0.0,
+        "max": round(max(values), 3) if values else 0.0,
+    }
+
+
+async def monitor_loop_lag(samples: List[float], stop: asyncio.Event, interval: float = 0.01):
+    """Record how late the event loop wakes up from a fixed sleep, in milliseconds"""
+    while not stop.is_set():
+        started = time.perf_counter()
+        await asyncio.sleep(interval)
+        samples.append(max(0.0, (time.perf_counter() - started - interval) * 1000))
+
+
+async def run_level(
+    client,
+    endpoint: str,
+    concurrency: int,
+    total: int,
+    use_cache: bool,
+    offset: int = 0
+) -> Dict[str, Any]:
+    """Send total requests to endpoint with at most concurrency in flight"""
+    latencies: List[float] = []
+    errors: Dict[str, int] = {}
+    # The offset keeps request payloads unique across levels
+    counter = iter(range(offset, offset + total))
+    lag_samples: List[float] = []
+    stop = asyncio.Event()
+
+    async def worker():
+        for i in counter:
+            method, path, body = build_request(endpoint, i, use_cache)
+            started = time.perf_counter()
+            try:
+                response = await client.request(method, path, json=body)
+                status = response.status_code
+            except Exception as e:
+                status = type(e).__name__
+            latencies.append((time.perf_counter() - started) * 1000)
+            if status != 200:
+                errors[str(status)] = errors.get(str(status), 0) + 1
+
+    lag_task = asyncio.ensure_future(monitor_loop_lag(lag_samples, stop))
+    started = time.perf_counter()
+    cpu_started = time.process_time()
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+    cpu_elapsed = time.process_time() - cpu_started
+    elapsed = time.perf_counter() - started
+    stop.set()
+    await lag_task
+
+    return {
+        "endpoint": endpoint,
+        "concurrency": concurrency,
+        "requests": total,
+        "errors": errors,
+        "duration_s": round(elapsed, 3),
+        "throughput_rps": round(total / elapsed, 2) if elapsed else 0.0,
+        "latency_ms": summarize(latencies),
+        "loop_lag_ms": summarize(lag_samples),
+        # Client plus server CPU when in-process; client only with --url
+        "cpu_ms_per_request": round(cpu_elapsed * 1000 / total, 3) if total else 0.0,
+    }
+
+
+def configure_fake_backend(args):
+    """Point the app at the fake LLM backend before it is imported"""
+    os.environ["LLM_BACKEND"] = "fake"
+    os.environ["FAKE_LLM_LATENCY_MS"] = str(args.latency_ms)
+    os.environ["FAKE_LLM_JITTER_MS"] = str(args.jitter_ms)
+    os.environ["FAKE_LLM_ERROR_RATE"] = str(args.error_rate)
+    os.environ["FAKE_LLM_LESSON_ITEMS"] = str(args.lesson_items)
+    os.environ.setdefault("UPSTREAM_MAX_CONCURRENCY", str(max(args.concurrency) * 2))
+    # The chat load repeats a few questions, so near-duplicate hits would hide the model path
+    os.environ["SEMANTIC_CACHE_ENABLED"] = "true" if args.cache else "false"
+    # Keep benchmark lessons and mastery out of the development stores
+    state_dir = tempfile.mkdtemp(prefix="kidsmentor-bench-")
+    os.environ.setdefault("LESSON_STORE_PATH", os.path.join(state_dir, "lessons.db"))
+    os.environ.setdefault("MASTERY_STORE_PATH", os.path.join(state_dir, "mastery.db"))
+    os.environ.setdefault("QUIZ_STORE_PATH", os.path.join(state_dir, "quiz_results.db"))
+
+
+async def make_client(args):
+    import httpx
+
+    if args.url:
+        return httpx.AsyncClient(base_url=args.url, timeout=args.timeout)
+
+    configure_fake_backend(args)
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import main
+
+    transport = httpx.ASGITransport(app=main.app)
+    return httpx.AsyncClient(transport=transport, base_url="http://benchmark", timeout=args.timeout)
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+async def measure_startup(args) -> Dict[str, float]:
+    """
+    Start the server in a new process and time, from launch, its first response,
+    its first 200 from /ready, and its first generated lesson.
+    """
+    import httpx
+
+    port = free_port()
+    env = dict(os.environ)
+    state_dir = tempfile.mkdtemp(prefix="kidsmentor-startup-")
+    env.update(
+        LESSON_STORE_PATH=os.path.join(state_dir, "lessons.db"),
+        MASTERY_STORE_PATH=os.path.join(state_dir, "mastery.db"),
+        QUIZ_STORE_PATH=os.path.join(state_dir, "quiz_results.db"),
+    )
+    started = time.perf_counter()
+    elapsed_ms = lambda: (time.perf_counter() - started) * 1000
+    process = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--host", "127.0.0.1", "--port", str(port), "--no-access-log"],
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL
+    )
+    timings: Dict[str, float] = {}
+    try:
+        async with httpx.AsyncClient(base_url=f"http://127.0.0.1:{port}", timeout=args.timeout) as client:
+            while "ready_ms" not in timings:
+                if process.poll() is not None or elapsed_ms() > args.timeout * 1000:
+                    raise RuntimeError("Server did not become ready")
+                try:
+                    response = await client.get("/ready")
+                except httpx.TransportError:
+                    await asyncio.sleep(0.005)
+                    continue
+                timings.setdefault("first_response_ms", elapsed_ms())
+                if response.status_code == 200:
+                    timings["ready_ms"] = elapsed_ms()
+                else:
+                    await asyncio.sleep(0.005)
+            method, path, body = build_request("lesson", 0, use_cache=False)
+            await client.request(method, path, json=body)
+            timings["first_lesson_ms"] = elapsed_ms()
+    finally:
+        process.terminate()
+        process.wait(timeout=10)
+    return timings
+
+
+async def run_startup(args) -> Dict[str, float]:
+    """Median startup timings over args.startup_runs fresh server processes"""
+    runs = [await measure_startup(args) for _ in range(args.startup_runs)]
+    summary = {key: round(statistics.median(run[key] for run in runs), 1) for key in runs[0]}
+    print(
+        f"  startup first response={summary['first_response_ms']:.0f}ms  ready={summary['ready_ms']:.0f}ms  "
+        f"first lesson={summary['first_lesson_ms']:.0f}ms  (median of {len(runs)})"
+    )
+    return summary
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL,
+            text=True
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def run_benchmark(args) -> Dict[str, Any]:
+    client = await make_client(args)
+    results = []
+    offset = 1
+    async with client:
+        # Warm up imports, connection pools and caches outside the measured window
+        for endpoint in args.endpoints:
+            method, path, body = build_request(endpoint, 0, args.cache)
+            await client.request(method, path, json=body)
+
+        for endpoint in args.endpoints:
+            for concurrency in args.concurrency:
+                result = await run_level(client, endpoint, concurrency, args.requests, args.cache, offset)
+                offset += args.requests
+                results.append(result)
+                latency = result["latency_ms"]
+                print(
+                    f"{endpoint:>9} c={concurrency:<4} {result['throughput_rps']:>9.1f} req/s  "
+                    f"p50={latency['p50']:.1f}ms p95={latency['p95']:.1f}ms p99={latency['p99']:.1f}ms  "
+                    f"loop lag p99={result['loop_lag_ms']['p99']:.1f}ms  cpu={result['cpu_ms_per_request']:.2f}ms/req  "
+                    f"errors={sum(result['errors'].values())}"
+                )
+
+    startup = None
+    if not args.url and args.startup_runs > 0:
+        startup = await run_startup(args)
+
+    return {
+        "meta": {
+            "commit": git_commit(),
+            "timestamp": time.time(),
+            "python": platform.python_version(),
+            "target": args.url or "in-process",
+            "latency_ms": args.latency_ms,
+            "jitter_ms": args.jitter_ms,
+            "error_rate": args.error_rate,
+            "lesson_items": args.lesson_items,
+            "requests_per_level": args.requests,
+            "cache": args.cache,
+        },
+        "results": results,
+        "startup": startup,
+    }
+
+
+def compare(baseline: Dict[str, Any], current: Dict[str, Any], threshold: float) -> bool:
+    """Print deltas against baseline; return True if any endpoint regressed beyond threshold"""
+    previous = {(r["endpoint"], r["concurrency"]): r for r in baseline["results"]}
+    regressed = False
+    print(f"\nComparison against {baseline['meta'].get('commit') or 'baseline'} (threshold {threshold:.0%}):")
+    for result in current["results"]:
+        old = previous.get((result["endpoint"], result["concurrency"]))
+        if old is None:
+            continue
+        p95_change = (result["latency_ms"]["p95"] - old["latency_ms"]["p95"]) / max(old["latency_ms"]["p95"], 1e-9)
+        rps_change = (result["throughput_rps"] - old["throughput_rps"]) / max(old["throughput_rps"], 1e-9)
+        cpu_change = ""
+        if old.get("cpu_ms_per_request") and "cpu_ms_per_request" in result:
+            old_cpu, new_cpu = old["cpu_ms_per_request"], result["cpu_ms_per_request"]
+            cpu_change = f"  cpu {old_cpu:.2f} -> {new_cpu:.2f}ms/req ({(new_cpu - old_cpu) / old_cpu:+.1%})"
+        flag = ""
+        if p95_change > threshold or rps_change < -threshold:
+            flag = "  REGRESSION"
+            regressed = True
+        print(
+            f"{result['endpoint']:>9} c={result['concurrency']:<4} "
+            f"p95 {old['latency_ms']['p95']:.1f} -> {result['latency_ms']['p95']:.1f}ms ({p95_change:+.1%})  "
+            f"throughput {old['throughput_rps']:.1f} -> {result['throughput_rps']:.1f} req/s ({rps_change:+.1%}){cpu_change}{flag}"
+        )
+    if baseline.get("startup") and current.get("startup"):
+        # Shown for reference only; process start times are too noisy to gate on
+        print("  startup " + "  ".join(
+            f"{key[:-3].replace('_', ' ')} {baseline['startup'][key]:.0f} -> {value:.0f}ms"
+            for key, value in current["startup"].items() if key in baseline["startup"]
+        ))
+    return regressed
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the KidsMentor backend against a simulated model")
+    parser.add_argument("--endpoints", nargs="+", choices=ENDPOINTS, default=ENDPOINTS)
+    parser.add_argument("--concurrency", nargs="+", type=int, default=[1, 8, 32])
+    parser.add_argument("--requests", type=int, default=200, help="requests per endpoint and concurrency level")
+    parser.add_argument("--latency-ms", type=float, default=50, help="simulated model latency")
+    parser.add_argument("--jitter-ms", type=float, default=10, help="simulated model latency jitter")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="simulated model error rate")
+    parser.add_argument("--lesson-items", type=int, default=3, help="lessonContent items per simulated lesson")
+    parser.add_argument("--cache", action="store_true", help="allow lesson/story and semantic cache hits (default: bypass)")
+    parser.add_argument("--url", help="benchmark a running server instead of the in-process app")
+    parser.add_argument("--startup-runs", type=int, default=3, help="fresh server starts to time (0 skips; in-process mode only)")
+    parser.add_argument("--timeout", type=float, default=60)
+    parser.add_argument("--output", help="write JSON results to this file")
+    parser.add_argument("--compare", help="baseline JSON results to compare against")
+    parser.add_argument("--threshold", type=float, default=0.10, help="relative change counted as a regression")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    results = asyncio.run(run_benchmark(args))
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+        print(f"\nSaved results to {args.output}")
+
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+        if compare(baseline, results, args.threshold):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,39 +1,270 @@
-from fastapi import FastAPI, HTTPException, Depends, Body
+from fastapi import FastAPI, HTTPException, Depends, Body, Path, Query, Request
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel, Field
+from fastapi.responses import JSONResponse, PlainTextResponse, Response, StreamingResponse
+from pydantic import BaseModel, Field, TypeAdapter, ValidationError
 from typing import List, Dict, Optional, Any, Union
-import google.generativeai as genai
+from google.api_core import exceptions as google_exceptions
 from dotenv import load_dotenv
+import numpy as np
+from email.utils import formatdate, parsedate_to_datetime
+from concurrent.futures import ThreadPoolExecutor
+from array import array
+from collections import OrderedDict, deque
+import asyncio
+import atexit
+import bisect
+import contextvars
+import gzip
+import hashlib
+import heapq
+import inspect
+import math
 import os
+import queue
 import logging
+import logging.handlers
 import json
+import random
 import re
+import string
+import textwrap
+import sqlite3
 import sys
+import threading
+import time
+import uuid
+import zlib
 
-# Configure logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
-)
-logger = logging.getLogger("kidsmentor_backend")
+try:
+    import brotli  # Optional; offline bundles are also served brotli-compressed when installed
+except ImportError:
+    brotli = None
+
+def load_environment() -> str:
+    """
+    Load .env.local, or .env if it is missing, into the process environment.
 
-# Load environment variables
-# Try to load from .env.local first, then fall back to .env
-if os.path.exists(".env.local"):
-    load_dotenv(".env.local")
-    logger.info("Loaded environment variables from .env.local")
-else:
+    Called by the `python main.py` entry point before the server imports the app;
+    settings below are read from the environment when the module is imported.
+    """
+    if os.path.exists(".env.local"):
+        load_dotenv(".env.local")
+        return ".env.local"
     load_dotenv()
-    logger.info("Loaded environment variables from .env")
+    return ".env"
+
+# Logging settings
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json").lower()  # "json" or "text"
+# Share of requests whose INFO and DEBUG logs are kept, by path; a trailing * matches a prefix
+LOG_SAMPLE_RATES = os.getenv("LOG_SAMPLE_RATES", "/health=0,/ready=0,/metrics=0")
+LOG_SAMPLE_DEFAULT = float(os.getenv("LOG_SAMPLE_DEFAULT", "1"))
+
+# --- Logging ---
+
+# Request ID and log sampling decision of the request being served
+request_log_context: contextvars.ContextVar = contextvars.ContextVar("request_log_context", default=None)
+
+# LogRecord attributes that are not structured fields passed through `extra`
+_LOG_RECORD_ATTRIBUTES = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime", "request_id"}
+
+class JsonLogFormatter(logging.Formatter):
+    """One JSON object per line, with the request ID and any `extra` fields"""
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(record.created)) + f".{int(record.msecs):03d}Z",
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        if record.request_id:
+            entry["request_id"] = record.request_id
+        for key, value in record.__dict__.items():
+            if key not in _LOG_RECORD_ATTRIBUTES:
+                entry[key] = value
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+class RequestLogFilter(logging.Filter):
+    """Tags records with the current request ID and drops INFO/DEBUG records of unsampled requests"""
+    def filter(self, record: logging.LogRecord) -> bool:
+        context = request_log_context.get()
+        if context is None:
+            record.request_id = None
+            return True
+        record.request_id, sampled = context
+        return sampled or record.levelno >= logging.WARNING
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    """
+    Hands records to the listener thread without formatting them.
+
+    The stock QueueHandler merges the message arguments on the calling thread;
+    here that work, like the JSON encoding, happens on the listener thread.
+    """
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+def configure_logging() -> logging.handlers.QueueListener:
+    """Route all logging through a queue drained by a background thread; called at startup"""
+    output = logging.StreamHandler()
+    if LOG_FORMAT == "json":
+        output.setFormatter(JsonLogFormatter())
+    else:
+        output.setFormatter(logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - [%(request_id)s] %(message)s"))
+    log_queue: queue.SimpleQueue = queue.SimpleQueue()
+    handler = DeferredQueueHandler(log_queue)
+    handler.addFilter(RequestLogFilter())
+    root = logging.getLogger()
+    for existing in list(root.handlers):
+        root.removeHandler(existing)
+    root.addHandler(handler)
+    root.setLevel(LOG_LEVEL)
+    listener = logging.handlers.QueueListener(log_queue, output, respect_handler_level=True)
+    listener.start()
+    # Flush queued records when the process exits
+    atexit.register(listener.stop)
+    return listener
+
+log_listener: Optional[logging.handlers.QueueListener] = None
+logger = logging.getLogger("kidsmentor_backend")
+
+def _parse_sample_rates(spec: str):
+    exact, prefixes = {}, []
+    for item in spec.split(","):
+        path, _, rate = item.strip().partition("=")
+        if not path or not rate:
+            continue
+        if path.endswith("*"):
+            prefixes.append((path[:-1], float(rate)))
+        else:
+            exact[path] = float(rate)
+    # Longest prefix wins
+    prefixes.sort(key=lambda prefix: len(prefix[0]), reverse=True)
+    return exact, prefixes
+
+_LOG_SAMPLE_EXACT, _LOG_SAMPLE_PREFIXES = _parse_sample_rates(LOG_SAMPLE_RATES)
+
+def log_sample_rate(path: str) -> float:
+    rate = _LOG_SAMPLE_EXACT.get(path)
+    if rate is not None:
+        return rate
+    for prefix, prefix_rate in _LOG_SAMPLE_PREFIXES:
+        if path.startswith(prefix):
+            return prefix_rate
+    return LOG_SAMPLE_DEFAULT
 
 # Configure Google Gemini API key
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
 GEMINI_MODEL = os.getenv("GEMINI_MODEL", "gemini-1.5-flash")  # Using Gemini 1.5 Flash for better performance
+GEMINI_TIMEOUT_SECONDS = float(os.getenv("GEMINI_TIMEOUT_SECONDS", "30"))  # Per-call upstream timeout
+GEMINI_MAX_WORKERS = int(os.getenv("GEMINI_MAX_WORKERS", "8"))  # Thread pool size for sync-only model clients
+
+# Upstream admission control (0 disables the corresponding rate limit)
+UPSTREAM_MAX_CONCURRENCY = int(os.getenv("UPSTREAM_MAX_CONCURRENCY", "16"))
+UPSTREAM_REQUESTS_PER_MINUTE = float(os.getenv("UPSTREAM_REQUESTS_PER_MINUTE", "0"))
+UPSTREAM_TOKENS_PER_MINUTE = float(os.getenv("UPSTREAM_TOKENS_PER_MINUTE", "0"))
+UPSTREAM_QUEUE_TIMEOUT_SECONDS = float(os.getenv("UPSTREAM_QUEUE_TIMEOUT_SECONDS", "10"))
+UPSTREAM_MAX_QUEUE = int(os.getenv("UPSTREAM_MAX_QUEUE", "200"))
+
+# Upstream resilience: circuit breaker, retries and hedged requests
+CIRCUIT_FAILURE_THRESHOLD = int(os.getenv("CIRCUIT_FAILURE_THRESHOLD", "5"))  # 0 disables the breaker
+CIRCUIT_RESET_SECONDS = float(os.getenv("CIRCUIT_RESET_SECONDS", "30"))
+CIRCUIT_HALF_OPEN_PROBES = int(os.getenv("CIRCUIT_HALF_OPEN_PROBES", "1"))
+UPSTREAM_RETRY_ATTEMPTS = int(os.getenv("UPSTREAM_RETRY_ATTEMPTS", "2"))  # Retries after the first attempt
+UPSTREAM_RETRY_BASE_DELAY_MS = float(os.getenv("UPSTREAM_RETRY_BASE_DELAY_MS", "200"))
+UPSTREAM_RETRY_MAX_DELAY_MS = float(os.getenv("UPSTREAM_RETRY_MAX_DELAY_MS", "2000"))
+HEDGE_ENABLED = os.getenv("HEDGE_ENABLED", "false").lower() == "true"
+HEDGE_PERCENTILE = float(os.getenv("HEDGE_PERCENTILE", "95"))
+HEDGE_MIN_SAMPLES = int(os.getenv("HEDGE_MIN_SAMPLES", "20"))  # Successful calls needed before hedging
+
+# LLM backend selection: "gemini" (default) or "fake" for offline load testing
+LLM_BACKEND = os.getenv("LLM_BACKEND", "gemini").lower()
+
+# Fake backend tuning (only used when LLM_BACKEND=fake)
+FAKE_LLM_LATENCY_MS = float(os.getenv("FAKE_LLM_LATENCY_MS", "200"))
+FAKE_LLM_JITTER_MS = float(os.getenv("FAKE_LLM_JITTER_MS", "50"))
+FAKE_LLM_ERROR_RATE = float(os.getenv("FAKE_LLM_ERROR_RATE", "0"))
+FAKE_LLM_SEED = int(os.getenv("FAKE_LLM_SEED", "42"))
+FAKE_LLM_LESSON_ITEMS = int(os.getenv("FAKE_LLM_LESSON_ITEMS", "3"))  # lessonContent items per fake lesson
+
+# Lesson cache settings
+LESSON_CACHE_MAX_ENTRIES = int(os.getenv("LESSON_CACHE_MAX_ENTRIES", "512"))
+LESSON_CACHE_TTL_SECONDS = float(os.getenv("LESSON_CACHE_TTL_SECONDS", "86400"))
+LESSON_CACHE_DIR = os.getenv("LESSON_CACHE_DIR", "")  # Empty disables the on-disk tier
+
+# Cache backend: "local" (per process) or "sqlite" (shared by all workers on the host)
+CACHE_BACKEND = os.getenv("CACHE_BACKEND", "local").lower()
+SHARED_CACHE_PATH = os.getenv("SHARED_CACHE_PATH", "kidsmentor-cache.db")
+SHARED_CLAIM_TTL_SECONDS = float(os.getenv("SHARED_CLAIM_TTL_SECONDS", "120"))  # In-flight claims expire after this
+SHARED_POLL_INTERVAL_MS = float(os.getenv("SHARED_POLL_INTERVAL_MS", "100"))  # How often waiting workers check a claim
+
+# Story starter cache settings (shorter TTL keeps starters varied)
+STORY_CACHE_MAX_ENTRIES = int(os.getenv("STORY_CACHE_MAX_ENTRIES", "256"))
+STORY_CACHE_TTL_SECONDS = float(os.getenv("STORY_CACHE_TTL_SECONDS", "3600"))
+
+# Near-duplicate cache for chat queries and story themes
+SEMANTIC_CACHE_ENABLED = os.getenv("SEMANTIC_CACHE_ENABLED", "true").lower() == "true"
+SEMANTIC_CACHE_THRESHOLD = float(os.getenv("SEMANTIC_CACHE_THRESHOLD", "0.85"))  # Cosine similarity to count as a hit
+SEMANTIC_CACHE_MAX_ENTRIES = int(os.getenv("SEMANTIC_CACHE_MAX_ENTRIES", "2048"))  # Per cache
+SEMANTIC_CACHE_TTL_SECONDS = float(os.getenv("SEMANTIC_CACHE_TTL_SECONDS", "86400"))
+SEMANTIC_CACHE_DIMENSIONS = int(os.getenv("SEMANTIC_CACHE_DIMENSIONS", "512"))
+
+# Story starter pool for requests without a theme, characters or starting phrase
+STORY_POOL_ENABLED = os.getenv("STORY_POOL_ENABLED", "true").lower() == "true"
+STORY_POOL_TARGET_SIZE = int(os.getenv("STORY_POOL_TARGET_SIZE", "24"))  # Starters per (age_group, category)
+STORY_POOL_LOW_WATER = int(os.getenv("STORY_POOL_LOW_WATER", "9"))  # Refill below this many
+STORY_POOL_MAX_SERVES = int(os.getenv("STORY_POOL_MAX_SERVES", "20"))  # Clients served each starter before it retires
+STORY_POOL_MAX_CLIENTS = int(os.getenv("STORY_POOL_MAX_CLIENTS", "10000"))  # Clients tracked for no-repeat serving
+STORY_POOL_MAX_BUCKETS = int(os.getenv("STORY_POOL_MAX_BUCKETS", "40"))  # Catalogue (age_group, category) buckets kept
 
-if not GEMINI_API_KEY:
-    raise ValueError("GEMINI_API_KEY environment variable not set.")
+# Curriculum warm-up settings
+WARMUP_ON_STARTUP = os.getenv("WARMUP_ON_STARTUP", "false").lower() == "true"
+WARMUP_INTERVAL_SECONDS = float(os.getenv("WARMUP_INTERVAL_SECONDS", "0"))  # 0 disables scheduled re-runs
+WARMUP_REQUESTS_PER_MINUTE = float(os.getenv("WARMUP_REQUESTS_PER_MINUTE", "30"))
+WARMUP_MAX_AGE_SECONDS = float(os.getenv("WARMUP_MAX_AGE_SECONDS", str(LESSON_CACHE_TTL_SECONDS / 2)))
 
-genai.configure(api_key=GEMINI_API_KEY)
+# Incremental lesson parsing: stream lesson output and validate it as it arrives
+LESSON_STREAM_PARSE = os.getenv("LESSON_STREAM_PARSE", "true").lower() == "true"
+LESSON_STREAM_MAX_RETRIES = int(os.getenv("LESSON_STREAM_MAX_RETRIES", "1"))
+
+# Persistent lesson store (empty path disables it)
+LESSON_STORE_PATH = os.getenv("LESSON_STORE_PATH", "lessons.db")
+# Reuse a stored lesson for identical inputs when the cache misses; 0 disables reuse
+LESSON_STORE_REUSE_MAX_AGE_SECONDS = float(os.getenv("LESSON_STORE_REUSE_MAX_AGE_SECONDS", str(7 * 86400)))
+
+# Offline bundles, precompressed on disk
+BUNDLE_DIR = os.getenv("BUNDLE_DIR", "bundles")
+
+# Student mastery model (empty path keeps mastery in memory only)
+MASTERY_STORE_PATH = os.getenv("MASTERY_STORE_PATH", "mastery.db")
+MASTERY_K_FACTOR = float(os.getenv("MASTERY_K_FACTOR", "1.5"))  # Step size of a student's first update
+MASTERY_K_MIN = float(os.getenv("MASTERY_K_MIN", "0.3"))  # Floor the step size decays to with more attempts
+MASTERY_INTERMEDIATE_AT = float(os.getenv("MASTERY_INTERMEDIATE_AT", "0.6"))
+MASTERY_ADVANCED_AT = float(os.getenv("MASTERY_ADVANCED_AT", "0.8"))
+
+# Graded quiz submissions for class analytics (empty path keeps them in memory only)
+QUIZ_STORE_PATH = os.getenv("QUIZ_STORE_PATH", "quiz_results.db")
+
+# Batch lesson generation settings
+LESSON_BATCH_CONCURRENCY = int(os.getenv("LESSON_BATCH_CONCURRENCY", "4"))
+LESSON_BATCH_MAX_ITEMS = int(os.getenv("LESSON_BATCH_MAX_ITEMS", "200"))
+
+# Chat conversation memory settings ("sqlite" is shared across workers and is the default with CACHE_BACKEND=sqlite)
+CHAT_MEMORY_BACKEND = os.getenv("CHAT_MEMORY_BACKEND", "sqlite" if CACHE_BACKEND == "sqlite" else "memory").lower()
+CHAT_MEMORY_SQLITE_PATH = os.getenv("CHAT_MEMORY_SQLITE_PATH", "conversations.db")
+CHAT_MEMORY_WINDOW_TOKENS = int(os.getenv("CHAT_MEMORY_WINDOW_TOKENS", "1200"))  # Recent turns kept verbatim
+CHAT_MEMORY_SUMMARY_TOKENS = int(os.getenv("CHAT_MEMORY_SUMMARY_TOKENS", "300"))  # Summary of older turns
+CHAT_MEMORY_IDLE_TTL_SECONDS = float(os.getenv("CHAT_MEMORY_IDLE_TTL_SECONDS", "3600"))
+CHAT_MEMORY_MAX_TOTAL_TOKENS = int(os.getenv("CHAT_MEMORY_MAX_TOTAL_TOKENS", "2000000"))  # Across all conversations
+
+# Prompt token budgets: estimated input tokens per model call, system prefix included (0 disables)
+LESSON_INPUT_TOKEN_BUDGET = int(os.getenv("LESSON_INPUT_TOKEN_BUDGET", "700"))
+STORY_INPUT_TOKEN_BUDGET = int(os.getenv("STORY_INPUT_TOKEN_BUDGET", "400"))
+CHAT_INPUT_TOKEN_BUDGET = int(os.getenv("CHAT_INPUT_TOKEN_BUDGET", "1800"))
+PROMPT_FIELD_MAX_TOKENS = int(os.getenv("PROMPT_FIELD_MAX_TOKENS", "150"))  # Any single user-supplied text
+PROMPT_LIST_MAX_ITEMS = int(os.getenv("PROMPT_LIST_MAX_ITEMS", "8"))  # Objectives, characters, interests
 
 # Initialize FastAPI app
 app = FastAPI(
@@ -42,6 +273,13 @@ app = FastAPI(
     version="0.2.0",
 )
 
+@app.on_event("startup")
+async def start_logging():
+    """Install the queued log handler; registered first so the other startup hooks log through it"""
+    global log_listener
+    if log_listener is None:
+        log_listener = configure_logging()
+
 # --- CORS Configuration --- 
 # Adjust origins as needed for your frontend URL
 origins = [
@@ -57,6 +295,7 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"], # Allows all methods
     allow_headers=["*"], # Allows all headers
+    expose_headers=["X-Request-Id", "X-Tokens-Input", "X-Tokens-Output", "ETag", "Content-Range"],
 )
 
 # --- Pydantic models for requests and responses ---
@@ -69,19 +308,32 @@ class LessonContentItem(BaseModel):
     solution: Optional[str] = None
     problem_data: Optional[Dict[str, Any]] = None
 
+# Student and lesson IDs are stored in signed 64-bit array columns and SQLite integers
+MAX_ID = 2**63 - 1
+
 class PracticeQuizItem(BaseModel):
     question: str
     options: List[str]
     correct_answer: str
 
 class LessonRequest(BaseModel):
-    student_id: int
+    student_id: int = Field(ge=0, le=MAX_ID)
     last_quiz_score: Optional[float] = None
     current_topic: str
     learning_objectives: List[str] = []
     subject: Optional[str] = None  # Added subject field
     challenge_level: Optional[str] = None  # To specify difficulty level
     learning_style: Optional[str] = None  # To specify learning style
+    bypass_cache: bool = False  # Force a fresh generation
+
+class GeneratedLesson(BaseModel):
+    """Lesson content as returned by the model, before a lesson ID is attached"""
+    lessonTitle: str
+    topic: str
+    learningObjectives: List[str]
+    difficultyLevel: str
+    lessonContent: List[LessonContentItem]
+    practiceQuiz: List[PracticeQuizItem]
 
 class LessonResponse(BaseModel):
     lesson_id: int
@@ -92,6 +344,22 @@ class LessonResponse(BaseModel):
     lessonContent: List[LessonContentItem]
     practiceQuiz: List[PracticeQuizItem]
 
+class BatchLessonRequest(BaseModel):
+    lessons: List[LessonRequest]
+    max_concurrency: Optional[int] = None  # Defaults to, and is capped at, LESSON_BATCH_CONCURRENCY
+
+class QuizResultRequest(BaseModel):
+    topic: Optional[str] = None  # Taken from the lesson when omitted
+    lesson_id: Optional[int] = Field(default=None, ge=0, le=MAX_ID)
+    score: Optional[float] = None  # Percentage, 0-100
+    correct: Optional[int] = None  # Or correct answers out of total
+    total: Optional[int] = None
+
+class QuizSubmissionRequest(BaseModel):
+    lesson_id: int = Field(ge=0, le=MAX_ID)
+    answers: List[Optional[str]]  # One per practice quiz question, as option text or letter; null if skipped
+    class_id: str = ""  # Groups submissions for class analytics
+
 # Story Generator models
 class StoryRequest(BaseModel):
     theme: Optional[str] = ""
@@ -142,32 +410,606 @@ SUBJECTS = [
     }
 ]
 
+# --- Metrics ---
+
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+def _escape_label_value(value: Any) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def _format_labels(names: tuple, values: tuple, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape_label_value(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+class Counter:
+    """Monotonic counter keyed by label values"""
+    def __init__(self, name: str, documentation: str, labels: tuple = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self.values: Dict[tuple, float] = {}
+
+    def inc(self, *label_values, amount: float = 1.0):
+        self.values[label_values] = self.values.get(label_values, 0.0) + amount
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        for label_values, value in self.values.items():
+            lines.append(f"{self.name}{_format_labels(self.labels, label_values)} {value:g}")
+        return lines
+
+class Histogram:
+    """Fixed-bucket histogram keyed by label values; observe() is a bisect and three additions"""
+    def __init__(self, name: str, documentation: str, labels: tuple = (), buckets: tuple = DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self.buckets = buckets
+        self.series: Dict[tuple, list] = {}  # label values -> [bucket counts, sum, count]
+
+    def observe(self, value: float, *label_values):
+        series = self.series.get(label_values)
+        if series is None:
+            series = self.series[label_values] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        series[0][bisect.bisect_left(self.buckets, value)] += 1
+        series[1] += value
+        series[2] += 1
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        for label_values, (counts, total, count) in self.series.items():
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                le = "+Inf" if bound == float("inf") else f"{bound:g}"
+                bucket_labels = _format_labels(self.labels, label_values, f'le="{le}"')
+                lines.append(f"{self.name}_bucket{bucket_labels} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labels, label_values)} {total:.6f}")
+            lines.append(f"{self.name}_count{_format_labels(self.labels, label_values)} {count}")
+        return lines
+
+class StageTimer:
+    """Context manager that records elapsed time into stage_duration"""
+    __slots__ = ("endpoint", "stage", "started")
+
+    def __init__(self, endpoint: str, stage: str):
+        self.endpoint = endpoint
+        self.stage = stage
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        stage_duration.observe(time.perf_counter() - self.started, self.endpoint, self.stage)
+        return False
+
+http_request_duration = Histogram(
+    "kidsmentor_http_request_duration_seconds", "HTTP request latency by route", ("route", "method")
+)
+http_requests = Counter(
+    "kidsmentor_http_requests_total", "HTTP requests by route and status code", ("route", "method", "status")
+)
+stage_duration = Histogram(
+    "kidsmentor_stage_duration_seconds", "Time spent in each processing stage", ("endpoint", "stage")
+)
+upstream_calls = Counter(
+    "kidsmentor_upstream_calls_total", "Model calls by kind and outcome", ("kind", "outcome")
+)
+upstream_tokens = Counter(
+    "kidsmentor_upstream_tokens_total", "Estimated model tokens by kind and direction", ("kind", "direction")
+)
+json_extractions = Counter(
+    "kidsmentor_json_extraction_total", "JSON extraction strategy used on model output", ("method",)
+)
+lesson_stream_aborts = Counter(
+    "kidsmentor_lesson_stream_aborts_total", "Lesson streams aborted early on malformed output", ("outcome",)
+)
+upstream_retries = Counter("kidsmentor_upstream_retries_total", "Model calls retried after a transient failure", ("kind",))
+hedged_requests = Counter(
+    "kidsmentor_hedged_requests_total", "Hedged model calls sent, and how many beat the original", ("kind", "result")
+)
+circuit_fallbacks = Counter(
+    "kidsmentor_circuit_fallbacks_total", "Requests served from cache while the circuit was open", ("kind",)
+)
+prompt_truncations = Counter(
+    "kidsmentor_prompt_truncations_total", "User inputs and prompt sections shortened to fit token budgets",
+    ("kind", "field")
+)
+bundle_requests = Counter(
+    "kidsmentor_bundle_requests_total", "Offline bundle requests by response type", ("result",)
+)
+request_tokens = Histogram(
+    "kidsmentor_request_tokens", "Estimated model tokens spent per HTTP request", ("route", "direction"),
+    buckets=(50, 100, 250, 500, 1000, 2000, 4000, 8000, 16000)
+)
+
+METRICS = [
+    http_request_duration, http_requests, stage_duration, upstream_calls, upstream_tokens, json_extractions,
+    lesson_stream_aborts, upstream_retries, hedged_requests, circuit_fallbacks, prompt_truncations, request_tokens,
+    bundle_requests,
+]
+
+def _collect_component_metrics() -> List[str]:
+    """Scrape-time metrics read from cache, coalescing and admission counters"""
+    lines = [
+        "# HELP kidsmentor_cache_lookups_total Generation cache lookups by result",
+        "# TYPE kidsmentor_cache_lookups_total counter",
+    ]
+    caches = [lesson_cache, story_cache]
+    for cache in caches:
+        for result, value in (
+            ("hit", cache.hits), ("shared_hit", cache.shared_hits), ("disk_hit", cache.disk_hits), ("miss", cache.misses)
+        ):
+            lines.append(f'kidsmentor_cache_lookups_total{{cache="{cache.name}",result="{result}"}} {value}')
+    lines += ["# HELP kidsmentor_cache_entries Entries held in memory", "# TYPE kidsmentor_cache_entries gauge"]
+    for cache in caches:
+        lines.append(f'kidsmentor_cache_entries{{cache="{cache.name}"}} {len(cache._entries)}')
+    lines += [
+        "# HELP kidsmentor_coalesced_requests_total Requests served by joining an in-flight call",
+        "# TYPE kidsmentor_coalesced_requests_total counter",
+    ]
+    for flights in (lesson_flights, story_flights):
+        lines.append(f'kidsmentor_coalesced_requests_total{{kind="{flights.name}"}} {flights.followers}')
+    lines += [
+        "# HELP kidsmentor_upstream_in_flight Model calls currently admitted",
+        "# TYPE kidsmentor_upstream_in_flight gauge",
+        f"kidsmentor_upstream_in_flight {admission.in_flight}",
+        "# HELP kidsmentor_upstream_queued Model calls waiting for admission",
+        "# TYPE kidsmentor_upstream_queued gauge",
+        f"kidsmentor_upstream_queued {sum(1 for entry in admission._queue if not entry[3].done())}",
+        "# HELP kidsmentor_upstream_shed_total Model calls rejected by admission control",
+        "# TYPE kidsmentor_upstream_shed_total counter",
+        f"kidsmentor_upstream_shed_total {admission.shed}",
+        "# HELP kidsmentor_circuit_state Circuit breaker state (1 for the current state)",
+        "# TYPE kidsmentor_circuit_state gauge",
+    ]
+    for state in ("closed", "open", "half_open"):
+        lines.append(f'kidsmentor_circuit_state{{state="{state}"}} {int(upstream_circuit.state == state)}')
+    lines += [
+        "# HELP kidsmentor_circuit_rejected_total Model calls failed fast by the open circuit",
+        "# TYPE kidsmentor_circuit_rejected_total counter",
+        f"kidsmentor_circuit_rejected_total {upstream_circuit.rejected}",
+        "# HELP kidsmentor_story_pool_requests_total Story starter requests eligible for the pool, by result",
+        "# TYPE kidsmentor_story_pool_requests_total counter",
+        f'kidsmentor_story_pool_requests_total{{result="hit"}} {story_pool.hits}',
+        f'kidsmentor_story_pool_requests_total{{result="miss"}} {story_pool.misses}',
+        "# HELP kidsmentor_story_pool_starters Unretired starters per pool bucket",
+        "# TYPE kidsmentor_story_pool_starters gauge",
+    ]
+    for key, (age_group, category) in story_pool.labels.items():
+        labels = _format_labels(("age_group", "category"), (age_group, category))
+        lines.append(f"kidsmentor_story_pool_starters{labels} {len(story_pool.buckets[key])}")
+    # Stores still opening are left out rather than opened by a scrape
+    mastery_model = mastery_store.peek()
+    if mastery_model is not None:
+        lines += [
+            "# HELP kidsmentor_mastery_updates_total Quiz results applied to the mastery model",
+            "# TYPE kidsmentor_mastery_updates_total counter",
+            f"kidsmentor_mastery_updates_total {mastery_model.updates}",
+            "# HELP kidsmentor_mastery_lessons_adapted_total Lessons whose challenge level came from mastery",
+            "# TYPE kidsmentor_mastery_lessons_adapted_total counter",
+            f"kidsmentor_mastery_lessons_adapted_total {mastery_model.adapted}",
+            "# HELP kidsmentor_mastery_entries Student-topic pairs tracked",
+            "# TYPE kidsmentor_mastery_entries gauge",
+            f"kidsmentor_mastery_entries {len(mastery_model.ability)}",
+        ]
+    quiz_results = quiz_store.peek()
+    if quiz_results is not None:
+        lines += [
+            "# HELP kidsmentor_quiz_submissions_graded_total Quiz submissions graded by this process",
+            "# TYPE kidsmentor_quiz_submissions_graded_total counter",
+            f"kidsmentor_quiz_submissions_graded_total {quiz_results.graded}",
+            "# HELP kidsmentor_quiz_submissions Quiz submissions held for class analytics",
+            "# TYPE kidsmentor_quiz_submissions gauge",
+            f"kidsmentor_quiz_submissions {len(quiz_results.sub_student)}",
+        ]
+    semantic_caches = [cache for cache in (chat_semantic_cache, story_semantic_cache) if cache is not None]
+    if semantic_caches:
+        lines += [
+            "# HELP kidsmentor_semantic_cache_lookups_total Near-duplicate cache lookups by result",
+            "# TYPE kidsmentor_semantic_cache_lookups_total counter",
+        ]
+        for cache in semantic_caches:
+            lines.append(f'kidsmentor_semantic_cache_lookups_total{{cache="{cache.name}",result="hit"}} {cache.hits}')
+            lines.append(f'kidsmentor_semantic_cache_lookups_total{{cache="{cache.name}",result="miss"}} {cache.misses}')
+        lines += ["# HELP kidsmentor_semantic_cache_entries Entries held by the near-duplicate cache", "# TYPE kidsmentor_semantic_cache_entries gauge"]
+        for cache in semantic_caches:
+            lines.append(f'kidsmentor_semantic_cache_entries{{cache="{cache.name}"}} {len(cache._lru)}')
+    return lines
+
+def render_metrics() -> str:
+    lines = []
+    for metric in METRICS:
+        lines.extend(metric.render())
+    lines.extend(_collect_component_metrics())
+    return "\n".join(lines) + "\n"
+
+# Model tokens spent while serving the current HTTP request, by direction
+request_token_usage: contextvars.ContextVar = contextvars.ContextVar("request_token_usage", default=None)
+
+def record_tokens(kind: str, direction: str, amount: int):
+    """Count model tokens against the endpoint kind and the request being served"""
+    upstream_tokens.inc(kind, direction, amount=amount)
+    usage = request_token_usage.get()
+    if usage is not None:
+        usage[direction] += amount
+
+class MetricsMiddleware:
+    """ASGI middleware recording latency and status per route template"""
+    def __init__(self, app):
+        self.app = app
+        self._route_paths: Optional[Dict[Any, str]] = None
+
+    def _route_label(self, scope) -> str:
+        if self._route_paths is None:
+            self._route_paths = {
+                route.endpoint: route.path for route in scope["app"].routes if hasattr(route, "endpoint")
+            }
+        # Unmatched paths share one label to keep cardinality bounded
+        return self._route_paths.get(scope.get("endpoint"), "unmatched")
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        started = time.perf_counter()
+        status = [500]
+        usage = {"input": 0, "output": 0}
+        usage_token = request_token_usage.set(usage)
+
+        async def send_with_status(message):
+            if message["type"] == "http.response.start":
+                status[0] = message["status"]
+                # Streamed responses start before their model call, so only the final usage metric covers them
+                if usage["input"] or usage["output"]:
+                    message["headers"] = list(message.get("headers", [])) + [
+                        (b"x-tokens-input", str(usage["input"]).encode()),
+                        (b"x-tokens-output", str(usage["output"]).encode()),
+                    ]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            request_token_usage.reset(usage_token)
+            route = self._route_label(scope)
+            http_request_duration.observe(time.perf_counter() - started, route, scope["method"])
+            http_requests.inc(route, scope["method"], str(status[0]))
+            if usage["input"] or usage["output"]:
+                request_tokens.observe(usage["input"], route, "input")
+                request_tokens.observe(usage["output"], route, "output")
+
+app.add_middleware(MetricsMiddleware)
+
+class RequestContextMiddleware:
+    """
+    ASGI middleware giving each request an ID and a log sampling decision.
+
+    The ID is taken from the X-Request-Id header when the client sends one and is
+    echoed in the response. It tags every log record written while serving the
+    request, including from tasks the request starts. One summary line is logged
+    per sampled request, and for server errors unless the path is sampled at 0.
+    """
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        request_id = None
+        for name, value in scope["headers"]:
+            if name == b"x-request-id":
+                request_id = value.decode("latin-1")[:64]
+                break
+        request_id = request_id or uuid.uuid4().hex
+        rate = log_sample_rate(scope["path"])
+        sampled = rate >= 1 or (rate > 0 and random.random() < rate)
+        context_token = request_log_context.set((request_id, sampled))
+        started = time.perf_counter()
+        status = [500]
+
+        async def send_with_request_id(message):
+            if message["type"] == "http.response.start":
+                status[0] = message["status"]
+                message["headers"] = list(message.get("headers", [])) + [(b"x-request-id", request_id.encode("latin-1"))]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_request_id)
+        finally:
+            # Paths sampled at 0 (probes, scrapes) stay silent even when they fail
+            if sampled or (status[0] >= 500 and rate > 0):
+                duration_ms = round((time.perf_counter() - started) * 1000, 1)
+                logger.log(
+                    logging.WARNING if status[0] >= 500 else logging.INFO,
+                    "%s %s %s in %sms", scope["method"], scope["path"], status[0], duration_ms,
+                    extra={"method": scope["method"], "path": scope["path"], "status": status[0], "duration_ms": duration_ms}
+                )
+            request_log_context.reset(context_token)
+
+app.add_middleware(RequestContextMiddleware)
+
+# --- LLM backends ---
+
+class GeminiBackend:
+    """Google Gemini backend (production)"""
+    name = "gemini"
+
+    def __init__(self):
+        if not GEMINI_API_KEY:
+            raise ValueError("GEMINI_API_KEY environment variable not set.")
+        # The SDK takes most of a second to import, so it is only loaded when the backend is built
+        import google.generativeai as genai
+        self.genai = genai
+        genai.configure(api_key=GEMINI_API_KEY)
+        # Newer SDK releases accept a system instruction; older ones get it as a prompt prefix
+        self.supports_system_instruction = \
+            "system_instruction" in inspect.signature(genai.GenerativeModel.__init__).parameters
+
+    def get_model(
+        self,
+        model_name: str,
+        generation_config: Optional[Dict[str, Any]] = None,
+        system_instruction: Optional[str] = None
+    ):
+        kwargs = {"generation_config": generation_config}
+        if system_instruction:
+            kwargs["system_instruction"] = system_instruction
+        return self.genai.GenerativeModel(model_name, **kwargs)
+
+class FakeResponse:
+    """Minimal stand-in for a Gemini response object"""
+    def __init__(self, text: str):
+        self.text = text
+
+class FakeModel:
+    """
+    Deterministic stand-in for genai.GenerativeModel.
+
+    Returns templated lesson, story starter or chat output based on the prompt,
+    after a configurable latency with jitter, and fails at a configurable rate.
+    """
+    def __init__(self, backend: "FakeBackend", model_name: str):
+        self.backend = backend
+        self.model_name = model_name
+
+    def _next_call(self):
+        """Draw the latency (seconds) and failure outcome for one call"""
+        rng = self.backend.rng
+        jitter = rng.uniform(-self.backend.jitter_ms, self.backend.jitter_ms)
+        latency = max(0.0, self.backend.latency_ms + jitter) / 1000
+        fail = rng.random() < self.backend.error_rate
+        return latency, fail
+
+    @staticmethod
+    def _prompt_value(prompt: str, pattern: str, default: str) -> str:
+        match = re.search(pattern, prompt)
+        return match.group(1).strip() if match else default
+
+    def render(self, prompt: str) -> str:
+        """Build a canned response shaped like the one the real model would return for prompt"""
+        if '"lessonTitle"' in prompt:
+            topic = self._prompt_value(prompt, r"Current Topic: (.+)", "General")
+            difficulty = self._prompt_value(prompt, r'difficulty level to "([^"]+)"', "beginner")
+            content = [
+                {"type": "explanation", "text": f"{topic} is something we see every day."},
+                {"type": "example", "problem": f"Find an example of {topic}.", "solution": "Look around you!"},
+                {"type": "interactive_problem", "problem_data": {"prompt": f"Tap the {topic} picture", "choices": ["A", "B"]}}
+            ]
+            # Pad to FAKE_LLM_LESSON_ITEMS to simulate long lessons
+            for i in range(len(content), FAKE_LLM_LESSON_ITEMS):
+                content.append({"type": "explanation", "text": f"Fun fact {i} about {topic}: there is always more to discover."})
+            return json.dumps({
+                "lessonTitle": f"Let's Learn About {topic}",
+                "topic": topic,
+                "learningObjectives": [f"Understand the basics of {topic}", f"Practice {topic} with examples"],
+                "difficultyLevel": difficulty,
+                "lessonContent": content[:max(FAKE_LLM_LESSON_ITEMS, 1)],
+                "practiceQuiz": [
+                    {"question": f"What did we learn about {topic}?", "options": ["A lot", "Nothing"], "correct_answer": "A lot"}
+                ]
+            })
+        if '"storyStarters"' in prompt:
+            category = self._prompt_value(prompt, r"Category: (.+)", "Fantasy")
+            age_group = self._prompt_value(prompt, r"\(ages ([^)]+)\)", "3-6")
+            return json.dumps({
+                "storyStarters": [
+                    f"Once upon a time, in a {category.lower()} land, a small friend found a glowing door. What was behind it?",
+                    "Every morning the sky changed color. Today it was purple! What do you think happened next?",
+                    f"A little bird wanted to share a secret with children ages {age_group}. Can you guess what it was?"
+                ]
+            })
+        query = self._prompt_value(prompt, r'query[^"]*"(.*)"', "your question")
+        return f"Great question! Let's think about \"{query}\" together, step by step."
+
+    async def _stream(self, text: str, latency: float):
+        """Yield text word by word, spreading the latency across the chunks"""
+        words = text.split(" ")
+        started = time.monotonic()
+        for i, word in enumerate(words):
+            # Sleep until each chunk's deadline, so loop overhead does not add to the total latency
+            delay = started + latency * (i + 1) / len(words) - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            yield FakeResponse(word if i == 0 else f" {word}")
+
+    async def generate_content_async(
+        self,
+        prompt: str,
+        generation_config: Optional[Dict[str, Any]] = None,
+        stream: bool = False,
+        **kwargs
+    ):
+        latency, fail = self._next_call()
+        if stream:
+            if fail:
+                raise google_exceptions.ServiceUnavailable("Fake backend injected error")
+            return self._stream(self.render(prompt), latency)
+        await asyncio.sleep(latency)
+        if fail:
+            raise google_exceptions.ServiceUnavailable("Fake backend injected error")
+        return FakeResponse(self.render(prompt))
+
+    def generate_content(self, prompt: str, generation_config: Optional[Dict[str, Any]] = None, **kwargs):
+        latency, fail = self._next_call()
+        time.sleep(latency)
+        if fail:
+            raise google_exceptions.ServiceUnavailable("Fake backend injected error")
+        return FakeResponse(self.render(prompt))
+
+class FakeBackend:
+    """Offline backend for load testing and benchmarks; never calls the network"""
+    name = "fake"
+    supports_system_instruction = False  # Keeps the full prompt visible to FakeModel.render
+
+    def __init__(self):
+        self.latency_ms = FAKE_LLM_LATENCY_MS
+        self.jitter_ms = FAKE_LLM_JITTER_MS
+        self.error_rate = FAKE_LLM_ERROR_RATE
+        self.rng = random.Random(FAKE_LLM_SEED)
+        logger.warning(
+            "Using fake LLM backend (latency=%sms, jitter=%sms, error_rate=%s)",
+            self.latency_ms, self.jitter_ms, self.error_rate
+        )
+
+    def get_model(
+        self,
+        model_name: str,
+        generation_config: Optional[Dict[str, Any]] = None,
+        system_instruction: Optional[str] = None
+    ):
+        return FakeModel(self, model_name)
+
+LLM_BACKENDS = {
+    "gemini": GeminiBackend,
+    "fake": FakeBackend,
+}
+
+if LLM_BACKEND not in LLM_BACKENDS:
+    raise ValueError(f"Unknown LLM_BACKEND '{LLM_BACKEND}'. Expected one of: {', '.join(LLM_BACKENDS)}")
+
+# Built on first use or by the startup warm-up, so a bad key fails readiness instead of the import
+_llm_backend = None
+_llm_backend_error: Optional[str] = None
+_llm_backend_lock = threading.Lock()
+
+def get_llm_backend():
+    """Return the configured LLM backend, building it (and importing its SDK) on first use"""
+    global _llm_backend, _llm_backend_error
+    if _llm_backend is not None:
+        return _llm_backend
+    with _llm_backend_lock:
+        if _llm_backend is None:
+            try:
+                _llm_backend = LLM_BACKENDS[LLM_BACKEND]()
+                _llm_backend_error = None
+            except Exception as e:
+                _llm_backend_error = f"{type(e).__name__}: {e}"
+                logger.error("Could not initialize %s backend: %s", LLM_BACKEND, _llm_backend_error)
+                raise HTTPException(status_code=503, detail="AI service is not available") from e
+    return _llm_backend
+
+class DeferredStore:
+    """
+    A store opened on first use, or ahead of time by the startup warm-up.
+
+    Opening a store can load a whole table, so it is kept out of module import.
+    The factory returns None when the store is disabled.
+    """
+    def __init__(self, name: str, factory):
+        self.name = name
+        self.factory = factory
+        self.error: Optional[str] = None
+        self._store = None
+        self._opened = False
+        self._lock = threading.Lock()
+
+    def get(self):
+        """Return the store, opening it first if needed"""
+        if self._opened:
+            return self._store
+        with self._lock:
+            if not self._opened:
+                try:
+                    self._store = self.factory()
+                except Exception as e:
+                    self.error = f"{type(e).__name__}: {e}"
+                    logger.error("Could not open %s: %s", self.name, self.error)
+                    raise HTTPException(status_code=503, detail=f"The {self.name} is not available") from e
+                self.error = None
+                self._opened = True
+        return self._store
+
+    def peek(self):
+        """Return the store if it is already open, without opening it"""
+        return self._store if self._opened else None
+
+    @property
+    def opened(self) -> bool:
+        return self._opened
+
+# Catalogue used to pre-warm lesson and story starter content
+CHALLENGE_LEVELS = ["beginner", "intermediate", "advanced"]
+LEARNING_STYLES = [None, "visual", "auditory", "kinesthetic"]
+STORY_CATEGORIES = ["Fantasy", "Adventure", "Friendship", "Animals", "Space", "Nature", "Fairytale", "Mystery"]
+STORY_AGE_GROUPS = ["3-4", "4-5", "5-6", "6-7", "7-8"]
+
 # --- Helper Functions ---
 
-def get_gemini_model():
-    """Initialize and return the Gemini model"""
-    try:
-        logger.info(f"Initializing Gemini model: {GEMINI_MODEL}")
-        model = genai.GenerativeModel(GEMINI_MODEL)
+# Model instances by (model name, generation config, system instruction)
+_model_instances: Dict[tuple, Any] = {}
+# Estimated tokens of the system instruction each model instance sends with every call
+_model_system_tokens: Dict[int, int] = {}
+
+def get_gemini_model(generation_config: Optional[Dict[str, Any]] = None, system_instruction: Optional[str] = None):
+    """Return the model from the configured LLM backend, creating it on first use"""
+    key = (GEMINI_MODEL, json.dumps(generation_config, sort_keys=True), system_instruction)
+    model = _model_instances.get(key)
+    if model is not None:
         return model
+    try:
+        backend = get_llm_backend()
+        logger.info("Initializing %s model: %s", backend.name, GEMINI_MODEL)
+        model = backend.get_model(GEMINI_MODEL, generation_config, system_instruction)
+    except HTTPException:
+        raise
     except Exception as e:
-        logger.error(f"Error initializing Gemini model: {str(e)}")
+        logger.error("Error initializing Gemini model: %s", e)
         raise HTTPException(status_code=500, detail="Failed to initialize AI model")
+    _model_instances[key] = model
+    _model_system_tokens[id(model)] = estimate_tokens(system_instruction) if system_instruction else 0
+    return model
+
+def estimate_tokens(text: str) -> int:
+    """Cheap token estimate (~4 characters per token) used for budgeting"""
+    return max(1, len(text) // 4) if text else 0
+
+def call_input_tokens(model, prompt: str) -> int:
+    """Estimated input tokens of one model call, including a separately sent system instruction"""
+    return estimate_tokens(prompt) + _model_system_tokens.get(id(model), 0)
 
 def extract_json_from_response(response_text: str) -> str:
     """Extract JSON from Gemini response text"""
-    logger.info("Extracting JSON from response")
+    logger.debug("Extracting JSON from response")
     
     # Try finding JSON within ```json ... ``` blocks first
     json_match = re.search(r'```(?:json)?\n?({.*?})\n?```', response_text, re.DOTALL | re.IGNORECASE)
     if json_match:
-        logger.info("Found JSON within markdown code blocks")
+        logger.debug("Found JSON within markdown code blocks")
+        json_extractions.inc("code_fence")
         return json_match.group(1)
     
     # If no markdown fences, check if the whole response is JSON
     response_text = response_text.strip()
     if response_text.startswith('{') and response_text.endswith('}'):
-        logger.info("Found valid JSON structure in response")
+        logger.debug("Found valid JSON structure in response")
+        json_extractions.inc("whole_body")
         return response_text
     
     # Try finding the first '{' and last '}' as a fallback
@@ -176,267 +1018,2865 @@ def extract_json_from_response(response_text: str) -> str:
     end = response_text.rfind('}')
     if start != -1 and end != -1 and start < end:
         extracted = response_text[start:end+1]
-        logger.info(f"Extracted JSON using fallback method (chars {start}-{end})")
+        logger.debug("Extracted JSON using fallback method (chars %s-%s)", start, end)
+        json_extractions.inc("brace_span")
         return extracted
     
     # If all else fails, raise an error
     error_msg = "Could not extract valid JSON from model response"
-    logger.error(f"{error_msg}. Raw response: {response_text[:100]}...")
+    logger.error("%s (response was %s chars)", error_msg, len(response_text))
+    json_extractions.inc("failed")
     raise ValueError(error_msg)
 
-# --- AI Tutor Endpoints ---
+# --- Prompt templates ---
 
-@app.post("/generate-lesson", response_model=LessonResponse)
-async def generate_lesson(request: LessonRequest):
-    """Generate a personalized lesson using Google Gemini based on student's context"""
-    try:
-        logger.info(f"Received lesson generation request for topic: {request.current_topic}")
-        
-        # Generate lesson content using Gemini
-        lesson_data = await generate_lesson_content_gemini(
-            student_id=request.student_id,
-            last_quiz_score=request.last_quiz_score,
-            current_topic=request.current_topic,
-            learning_objectives=request.learning_objectives,
-            subject=request.subject,
-            challenge_level=request.challenge_level,
-            learning_style=request.learning_style
-        )
+class PromptTemplate:
+    """
+    A versioned prompt split into a constant system prefix and a per-request body.
 
-        # Return the lesson with a fixed ID
-        response_data = {
-            "lesson_id": request.student_id + 1000,  # Simple ID generation
-            **lesson_data
-        }
-        
-        logger.info(f"Successfully prepared lesson response for topic: {request.current_topic}")
-        return LessonResponse(**response_data)
-        
-    except Exception as e:
-        logger.error(f"Error in generate_lesson endpoint: {type(e).__name__}: {str(e)}")
-        if isinstance(e, HTTPException):
-            raise  # Re-raise HTTP exceptions as they already have status codes
-        raise HTTPException(status_code=500, detail=f"Error generating lesson: {str(e)}")
+    Both parts are dedented once when the template is defined. The prefix is sent as
+    the model's system instruction when the SDK supports it; otherwise it leads the
+    prompt unchanged, so the provider can reuse its cached prefix across calls.
+    """
+    def __init__(self, name: str, version: int, system: str, body: str):
+        self.name = name
+        self.version = version
+        self.system = textwrap.dedent(system).strip()
+        self.body = textwrap.dedent(body).strip()
+        self.fields = sorted({field for _, field, _, _ in string.Formatter().parse(self.body) if field})
 
-async def generate_lesson_content_gemini(
-    student_id: int,
-    last_quiz_score: Optional[float],
-    current_topic: str,
-    learning_objectives: List[str],
-    subject: Optional[str] = None,
-    challenge_level: Optional[str] = None,
-    learning_style: Optional[str] = None
-) -> Dict[str, Any]:
-    """Generate adaptive lesson content using Google Gemini"""
-    
-    logger.info(f"Generating lesson for student ID: {student_id}, topic: {current_topic}")
-    
-    # Determine adaptive strategy based on challenge level and score
-    if challenge_level:
-        if challenge_level.lower() == 'advanced':
-            adaptive_instruction = (
-                f"Generate an advanced-level lesson on the topic '{current_topic}'. "
-                f"Include more complex concepts, challenging examples, and thought-provoking questions. "
-                f"The lesson should be suitable for students who already have a good foundation in this subject."
-            )
-            difficulty_level = "advanced"
-        elif challenge_level.lower() == 'intermediate':
-            adaptive_instruction = (
-                f"Generate an intermediate-level lesson on the topic '{current_topic}'. "
-                f"Balance foundational concepts with more challenging applications. "
-                f"The content should be appropriate for students who have some familiarity with the basics."
-            )
-            difficulty_level = "intermediate"
-        else:  # default to beginner if not specified or unknown value
-            adaptive_instruction = (
-                f"Generate a beginner-level lesson on the topic '{current_topic}'. "
-                f"Focus on foundational concepts with clear explanations and simple examples."
-            )
-            difficulty_level = "beginner"
-    # Fall back to score-based adaptation if no challenge level provided
-    elif last_quiz_score is None:
-        adaptive_instruction = f"Generate an introductory lesson on the topic '{current_topic}' suitable for a beginner."
-        difficulty_level = "beginner"
-    elif last_quiz_score > 80:
-        adaptive_instruction = (
-            f"The student scored {last_quiz_score}% on the last quiz for a related topic. "
-            f"Generate a slightly more challenging lesson building upon '{current_topic}' or introducing the next logical topic. "
-            f"Aim for an 'intermediate' or 'advanced' difficulty."
-        )
-        difficulty_level = "intermediate to advanced"
-    else:  # last_quiz_score <= 80
-        adaptive_instruction = (
-            f"The student scored {last_quiz_score}% on the last quiz for '{current_topic}'. "
-            f"Generate a lesson reinforcing '{current_topic}' at a similar or slightly easier difficulty. "
-            f"Focus on clarity and provide foundational examples. Aim for a 'beginner' or 'easy intermediate' difficulty."
-        )
-        difficulty_level = "beginner to easy intermediate"
-    
-    logger.info(f"Adapting lesson difficulty to: {difficulty_level}")
+    @property
+    def id(self) -> str:
+        return f"{self.name}@v{self.version}"
 
-    # Define learning style adaptation if provided
-    learning_style_instruction = ""
-    if learning_style:
-        if learning_style.lower() == 'visual':
-            learning_style_instruction = (
-                "The student is a visual learner. Include visual descriptions, "
-                "diagrams, charts, and image suggestions. Use spatial organization "
-                "and visual patterns in explanations."
-            )
-        elif learning_style.lower() == 'auditory':
-            learning_style_instruction = (
-                "The student is an auditory learner. Use rhythmic patterns, "
-                "spoken word examples, and discussion-based activities. "
-                "Include suggestions for speaking concepts aloud."
-            )
-        elif learning_style.lower() == 'kinesthetic':
-            learning_style_instruction = (
-                "The student is a kinesthetic learner. Incorporate hands-on activities, "
-                "physical movements, and tactile examples. Suggest ways to physically "
-                "engage with the material."
-            )
+    def render(self, **values) -> str:
+        # Optional sections may be empty; collapse the blank lines they leave behind
+        body = re.sub(r"\n{3,}", "\n\n", self.body.format(**values)).strip()
+        if get_llm_backend().supports_system_instruction:
+            return body
+        return f"{self.system}\n\n{body}"
 
-    # Define the JSON structure example separately
-    json_structure_example = '''
-    {
-      "lessonTitle": "string",
-      "topic": "string", // The specific topic covered in this lesson
-      "learningObjectives": ["string"], // List of objectives for this lesson
-      "difficultyLevel": "string", // e.g., beginner, intermediate, advanced
-      "lessonContent": [
-        { "type": "explanation", "text": "string" },
-        { "type": "example", "problem": "string", "solution": "string" },
-        { "type": "interactive_problem", "problem_data": {...} } // Structure for React component
-        // Add more content items as needed
-      ],
-      "practiceQuiz": [
-         { "question": "string", "options": ["string"], "correct_answer": "string"}
-         // Add more quiz items as needed
-      ]
-    }
-    '''
+    def input_tokens(self, prompt: str) -> int:
+        """Estimated input tokens of a rendered prompt, counting the system prefix wherever it is sent"""
+        return estimate_tokens(prompt) + (estimate_tokens(self.system) if get_llm_backend().supports_system_instruction else 0)
 
-    # Add subject context if provided
-    subject_context = f"This lesson is part of the {subject} curriculum. " if subject else ""
+    def render_within_budget(self, kind: str, budget: int, values: Dict[str, str], elastic: list) -> str:
+        """
+        Render the prompt, shrinking elastic sections until it fits the input token budget.
+
+        elastic lists (field, shrink) pairs in the order they give way, where
+        shrink(value, max_tokens) returns the value cut down to about max_tokens.
+        """
+        prompt = self.render(**values)
+        overflow = self.input_tokens(prompt) - budget if budget > 0 else 0
+        for field, shrink in elastic:
+            if overflow <= 0:
+                break
+            tokens = estimate_tokens(values[field])
+            if not tokens:
+                continue
+            # A little slack absorbs rounding in the token estimate
+            values[field] = shrink(values[field], max(0, tokens - overflow - 2))
+            prompt_truncations.inc(kind, field)
+            prompt = self.render(**values)
+            overflow = self.input_tokens(prompt) - budget
+        if overflow > 0:
+            logger.warning("%s prompt is %s tokens over its budget of %s", self.id, overflow, budget)
+        return prompt
+
+    def get_model(self, generation_config: Optional[Dict[str, Any]] = None):
+        """Return the cached model instance for this template's system prefix and generation_config"""
+        system_instruction = self.system if get_llm_backend().supports_system_instruction else None
+        return get_gemini_model(generation_config, system_instruction)
 
-    # Construct the final prompt
-    prompt = f"""
-    Act as an expert AI Tutor specializing in early childhood education concepts.
-    Your task is to create a personalized, engaging, and adaptive lesson plan.
+    def describe(self) -> Dict[str, Any]:
+        return {
+            "id": self.id,
+            "fields": self.fields,
+            "system_tokens": estimate_tokens(self.system),
+            "system_sha256": hashlib.sha256(self.system.encode("utf-8")).hexdigest()[:12],
+        }
+
+LESSON_PROMPT = PromptTemplate(
+    "lesson", 3,
+    system='''
+    Act as an expert AI Tutor in early childhood education. Create a personalized, engaging, adaptive lesson.
+
+    Output Requirements:
+    - Return only JSON in exactly the structure below, with no text or code fences around it.
+    - Break the lesson into logical parts: explanation, example, interactive_problem.
+    - For 'interactive_problem', give 'problem_data' a React component can use to render it.
+    - Add a short multiple-choice practice quiz, and learning objectives if none were provided.
+    - Keep content age-appropriate (ages 3-8), in simple language suited to the difficulty level, with engaging examples and described visuals.
 
+    JSON structure (lessonContent and practiceQuiz may hold more items):
+    {"lessonTitle": "string", "topic": "string", "learningObjectives": ["string"], "difficultyLevel": "beginner|intermediate|advanced",
+     "lessonContent": [{"type": "explanation", "text": "string"}, {"type": "example", "problem": "string", "solution": "string"}, {"type": "interactive_problem", "problem_data": {}}],
+     "practiceQuiz": [{"question": "string", "options": ["string"], "correct_answer": "string"}]}
+    ''',
+    body='''
     Student Context:
-    - Student ID: {student_id}
     - Current Topic: {current_topic}
-    - Subject: {subject if subject else 'Not specified'}
-    - Provided Learning Objectives: {', '.join(learning_objectives) if learning_objectives else 'None provided, please infer.'}
-    - Last Quiz Score: {f'{last_quiz_score}%' if last_quiz_score is not None else 'N/A (first lesson on topic)'}
-    - Challenge Level: {challenge_level if challenge_level else 'Not specified'}
-    - Learning Style: {learning_style if learning_style else 'Not specified'}
+    - Subject: {subject}
+    - Provided Learning Objectives: {learning_objectives}
+    - Last Quiz Score: {last_quiz_score}
+    - Challenge Level: {challenge_level}
+    - Learning Style: {learning_style}
 
     {subject_context}Adaptive Instruction:
     {adaptive_instruction}
-    
+
     {learning_style_instruction}
 
-    Output Requirements:
-    - Generate the lesson content strictly in the following JSON format. Do not include any text, code formatting backticks, or explanation outside the JSON structure itself.
-    - Ensure the lesson content is broken down into logical parts (explanation, example, interactive_problem).
-    - For 'interactive_problem', define 'problem_data' that a React component can use to render the interactive element.
-    - Create a short practice quiz with multiple-choice questions.
-    - Define clear learning objectives if none were provided.
-    - Set the overall difficulty level to "{difficulty_level}".
-    - Make the content age-appropriate for young children (typically ages 3-8).
-    - Use simple, clear language appropriate for the difficulty level.
-    - Include engaging examples and visuals (described in text) where appropriate.
+    Set the overall difficulty level to "{difficulty_level}".
+    '''
+)
 
-    JSON Output Structure Example (follow this structure exactly):
-    {json_structure_example}
-    """
+STORY_PROMPT = PromptTemplate(
+    "story", 3,
+    system='''
+    You are a creative assistant for early childhood educators. Generate 2-3 open-ended story starters
+    (not full stories) for young children. Each starter is 2-3 sentences of simple, imaginative,
+    age-appropriate language (nothing scary, violent or complex) that invites children to continue the story.
 
-    try:
-        model = get_gemini_model()
-        
-        # Set up generation config for better JSON responses
-        generation_config = {
-            "temperature": 0.2,  # Lower temperature for more consistent outputs
-            "response_mime_type": "application/json"  # Request JSON directly
+    Return only this JSON object: {"storyStarters": ["string", "string", "string"]}
+    ''',
+    body='''
+    Write story starters for young children (ages {age_group}).
+
+    Category: {category}
+    {custom_details}
+    '''
+)
+
+CHAT_PROMPT = PromptTemplate(
+    "chat", 3,
+    system='''
+    You are KidsPortal AI Edu Assistant, a tutor for children ages 5-11.
+    Be friendly, patient, positive and encouraging. Use simple words, relatable examples and analogies,
+    and describe child-friendly visuals that help them picture ideas. Keep answers brief (1-3 sentences
+    for simple questions). Admit politely when unsure. Never include harmful, inappropriate or sensitive content.
+    ''',
+    body='''
+    {profile_context}
+
+    {conversation_context}
+
+    Please respond to the following query with kid-friendly visuals when appropriate: "{query}"
+    '''
+)
+
+PROMPT_TEMPLATES = {template.name: template for template in (LESSON_PROMPT, STORY_PROMPT, CHAT_PROMPT)}
+
+PROMPT_BUDGETS = {
+    "lesson": LESSON_INPUT_TOKEN_BUDGET,
+    "story": STORY_INPUT_TOKEN_BUDGET,
+    "chat": CHAT_INPUT_TOKEN_BUDGET,
+}
+
+def clip_text(text: str, max_tokens: int, keep_end: bool = False) -> str:
+    """Cut text to about max_tokens at a word boundary, marking the cut with an ellipsis"""
+    if estimate_tokens(text) <= max_tokens:
+        return text
+    if max_tokens <= 0:
+        return ""
+    max_chars = max_tokens * 4 - 2
+    if keep_end:
+        clipped = text[-max_chars:]
+        cut = clipped.find(" ")
+        return "… " + (clipped[cut + 1:] if 0 <= cut < max_chars // 2 else clipped)
+    clipped = text[:max_chars]
+    cut = clipped.rfind(" ")
+    return (clipped[:cut] if cut > max_chars // 2 else clipped).rstrip() + " …"
+
+def clip_input(kind: str, field: str, text: str) -> str:
+    """Cap one user-supplied value at PROMPT_FIELD_MAX_TOKENS"""
+    clipped = clip_text(text, PROMPT_FIELD_MAX_TOKENS)
+    if clipped is not text:
+        prompt_truncations.inc(kind, field)
+    return clipped
+
+def clip_items(kind: str, field: str, items: List[Any]) -> List[str]:
+    """Keep the first PROMPT_LIST_MAX_ITEMS of a user-supplied list, each capped like clip_input"""
+    if len(items) > PROMPT_LIST_MAX_ITEMS:
+        prompt_truncations.inc(kind, field)
+    return [clip_input(kind, field, str(item)) for item in items[:PROMPT_LIST_MAX_ITEMS]]
+
+LESSON_GENERATION_CONFIG = {
+    "temperature": 0.2,  # Lower temperature for more consistent outputs
+    "response_mime_type": "application/json"  # Request JSON directly
+}
+STORY_GENERATION_CONFIG = {
+    "temperature": 0.7,  # More creative temperature
+    "response_mime_type": "application/json"  # Request JSON directly
+}
+
+@app.get("/admin/prompts")
+async def get_prompt_templates():
+    """List the active prompt template versions and cached model instances"""
+    return {
+        "templates": [template.describe() for template in PROMPT_TEMPLATES.values()],
+        "system_instruction": get_llm_backend().supports_system_instruction,
+        "cached_models": len(_model_instances),
+    }
+
+@app.get("/admin/tokens")
+async def get_token_usage():
+    """Estimated model tokens per endpoint, input budgets and how often prompts were shortened to fit them"""
+    endpoints = {}
+    for kind, budget in PROMPT_BUDGETS.items():
+        calls = sum(value for (call_kind, _), value in upstream_calls.values.items() if call_kind == kind)
+        input_tokens = upstream_tokens.values.get((kind, "input"), 0)
+        output_tokens = upstream_tokens.values.get((kind, "output"), 0)
+        endpoints[kind] = {
+            "calls": int(calls),
+            "input_tokens": int(input_tokens),
+            "output_tokens": int(output_tokens),
+            "input_per_call": round(input_tokens / calls, 1) if calls else 0.0,
+            "output_per_call": round(output_tokens / calls, 1) if calls else 0.0,
+            "input_budget": budget,
+            "system_tokens": estimate_tokens(PROMPT_TEMPLATES[kind].system),
+            "truncations": {
+                field: int(value) for (truncated_kind, field), value in prompt_truncations.values.items()
+                if truncated_kind == kind
+            },
         }
-        
-        logger.info("Sending request to Gemini API for lesson generation")
-        response = model.generate_content(
-            prompt,
-            generation_config=generation_config
+    return {
+        "endpoints": endpoints,
+        "field_max_tokens": PROMPT_FIELD_MAX_TOKENS,
+        "list_max_items": PROMPT_LIST_MAX_ITEMS,
+    }
+
+# --- Upstream admission control ---
+
+# Lower value = served first when requests queue for the model
+PRIORITY_CHAT = 0
+PRIORITY_LESSON = 1
+PRIORITY_STORY = 2
+PRIORITY_NAMES = {PRIORITY_CHAT: "chat", PRIORITY_LESSON: "lesson", PRIORITY_STORY: "story"}
+
+class TokenBucket:
+    """Token bucket refilled continuously at rate_per_minute; a rate of 0 means unlimited"""
+    def __init__(self, rate_per_minute: float):
+        self.unlimited = rate_per_minute <= 0
+        self.capacity = rate_per_minute
+        self.tokens = rate_per_minute
+        self.refill_per_second = rate_per_minute / 60
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.refill_per_second)
+        self.updated = now
+
+    def can_consume(self, amount: float) -> bool:
+        if self.unlimited:
+            return True
+        self._refill()
+        # Requests larger than the whole bucket are admitted once it is full
+        return self.tokens >= min(amount, self.capacity)
+
+    def consume(self, amount: float):
+        """Take tokens; may go negative to record usage only known after the call"""
+        if not self.unlimited:
+            self._refill()
+            self.tokens -= amount
+
+    def wait_time(self, amount: float) -> float:
+        """Seconds until amount tokens are available"""
+        if self.unlimited:
+            return 0.0
+        self._refill()
+        missing = min(amount, self.capacity) - self.tokens
+        return max(0.0, missing / self.refill_per_second)
+
+    def drain(self):
+        if not self.unlimited:
+            self._refill()
+            self.tokens = min(self.tokens, 0)
+
+class AdmissionController:
+    """
+    Client-side admission control in front of every model call.
+
+    A call is admitted when a concurrency slot is free and both the request and
+    token buckets have capacity. Otherwise it waits in a priority queue (chat before
+    lessons before story starters, FIFO within a priority). Calls that wait longer
+    than the queue timeout, or arrive when the queue is full, are shed with a 503
+    and a Retry-After header.
+    """
+    def __init__(
+        self,
+        max_concurrency: int,
+        requests_per_minute: float,
+        tokens_per_minute: float,
+        queue_timeout_seconds: float,
+        max_queue: int
+    ):
+        self.max_concurrency = max_concurrency
+        self.requests = TokenBucket(requests_per_minute)
+        self.tokens = TokenBucket(tokens_per_minute)
+        self.queue_timeout_seconds = queue_timeout_seconds
+        self.max_queue = max_queue
+        self.in_flight = 0
+        self._queue: List[tuple] = []  # (priority, seq, tokens, future)
+        self._seq = 0
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self.admitted = 0
+        self.shed = 0
+
+    def _try_admit(self, tokens: int) -> bool:
+        if self.in_flight >= self.max_concurrency:
+            return False
+        if not self.requests.can_consume(1) or not self.tokens.can_consume(tokens):
+            return False
+        self.requests.consume(1)
+        self.tokens.consume(tokens)
+        self.in_flight += 1
+        self.admitted += 1
+        return True
+
+    def _dispatch(self):
+        """Admit queued calls in priority order while capacity allows"""
+        self._timer = None
+        while self._queue:
+            _, _, tokens, future = self._queue[0]
+            if future.done():  # Timed out or cancelled while queued
+                heapq.heappop(self._queue)
+                continue
+            if not self._try_admit(tokens):
+                # Concurrency frees up on release; bucket capacity needs a timer
+                if self.in_flight < self.max_concurrency and self._timer is None:
+                    wait = max(self.requests.wait_time(1), self.tokens.wait_time(tokens), 0.01)
+                    self._timer = asyncio.get_running_loop().call_later(wait, self._dispatch)
+                return
+            heapq.heappop(self._queue)
+            future.set_result(True)
+
+    def retry_after(self, tokens: int = 0) -> int:
+        """Suggested Retry-After in whole seconds"""
+        return max(1, math.ceil(max(self.requests.wait_time(1), self.tokens.wait_time(tokens))))
+
+    def _shed(self, tokens: int, reason: str):
+        self.shed += 1
+        retry_after = self.retry_after(tokens)
+        logger.warning("Shedding model call: %s", reason)
+        raise HTTPException(
+            status_code=503,
+            detail=f"AI service busy, please retry in {retry_after}s",
+            headers={"Retry-After": str(retry_after)}
         )
+
+    async def acquire(self, priority: int, tokens: int):
+        """Wait for admission or raise a 503 once the queue deadline passes"""
+        if not self._queue and self._try_admit(tokens):
+            return
+        if len(self._queue) >= self.max_queue:
+            self._shed(tokens, f"queue full ({self.max_queue} waiting)")
+
+        future = asyncio.get_running_loop().create_future()
+        self._seq += 1
+        heapq.heappush(self._queue, (priority, self._seq, tokens, future))
+        self._dispatch()
+        try:
+            await asyncio.wait_for(asyncio.shield(future), self.queue_timeout_seconds)
+        except asyncio.TimeoutError:
+            if future.done() and not future.cancelled():
+                return  # Admitted just as the deadline passed
+            future.cancel()
+            self._shed(tokens, f"queued longer than {self.queue_timeout_seconds:g}s")
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                self.release()
+            else:
+                future.cancel()
+            raise
+
+    def release(self, output_tokens: int = 0):
+        """Free a concurrency slot and charge output tokens against the token bucket"""
+        self.in_flight -= 1
+        self.tokens.consume(output_tokens)
+        self._dispatch()
+
+    def on_rate_limited(self):
+        """Upstream reported a rate limit: stop admitting until the request bucket refills"""
+        self.requests.drain()
+
+    def stats(self) -> Dict[str, Any]:
+        queued = [entry for entry in self._queue if not entry[3].done()]
+        return {
+            "in_flight": self.in_flight,
+            "max_concurrency": self.max_concurrency,
+            "queued": {
+                "chat": sum(1 for entry in queued if entry[0] == PRIORITY_CHAT),
+                "lesson": sum(1 for entry in queued if entry[0] == PRIORITY_LESSON),
+                "story": sum(1 for entry in queued if entry[0] == PRIORITY_STORY),
+            },
+            "admitted": self.admitted,
+            "shed": self.shed,
+            "request_tokens_available": None if self.requests.unlimited else round(self.requests.tokens, 2),
+            "model_tokens_available": None if self.tokens.unlimited else round(self.tokens.tokens, 2),
+        }
+
+admission = AdmissionController(
+    UPSTREAM_MAX_CONCURRENCY,
+    UPSTREAM_REQUESTS_PER_MINUTE,
+    UPSTREAM_TOKENS_PER_MINUTE,
+    UPSTREAM_QUEUE_TIMEOUT_SECONDS,
+    UPSTREAM_MAX_QUEUE
+)
+
+@app.get("/admin/admission")
+async def get_admission_stats():
+    """Get upstream concurrency, queue depth and shedding counters"""
+    return admission.stats()
+
+# --- Upstream resilience ---
+
+class CircuitOpenError(HTTPException):
+    """Raised instead of calling the model while the circuit breaker is open"""
+    def __init__(self, retry_after: int):
+        super().__init__(
+            status_code=503,
+            detail="AI service is temporarily unavailable",
+            headers={"Retry-After": str(retry_after)}
+        )
+
+# Status codes that indicate the provider itself is failing; client errors and
+# rate limits are handled elsewhere and do not trip the breaker
+UPSTREAM_FAILURE_STATUSES = {502, 504}
+RETRYABLE_STATUSES = {502}
+
+class CircuitBreaker:
+    """
+    Consecutive-failure circuit breaker for the model provider.
+
+    After failure_threshold consecutive failures the circuit opens and calls fail
+    fast with a 503. Once reset_seconds have passed it goes half-open and lets a
+    limited number of probe calls through: a successful probe closes the circuit,
+    a failed one reopens it for another reset period.
+    """
+    def __init__(self, failure_threshold: int, reset_seconds: float, half_open_probes: int):
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.half_open_probes = half_open_probes
+        self.state = "closed"
+        self.consecutive_failures = 0
+        self.opened_at = 0.0
+        self.probes_in_flight = 0
+        self.opened = 0
+        self.rejected = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.failure_threshold > 0
+
+    def retry_after(self) -> int:
+        remaining = self.reset_seconds - (time.monotonic() - self.opened_at)
+        return max(1, math.ceil(remaining))
+
+    def before_call(self) -> bool:
+        """Admit a call or raise CircuitOpenError; returns True if the call is a half-open probe"""
+        if not self.enabled or self.state == "closed":
+            return False
+        if self.state == "open":
+            if time.monotonic() - self.opened_at < self.reset_seconds:
+                self.rejected += 1
+                raise CircuitOpenError(self.retry_after())
+            self.state = "half_open"
+            logger.info("Circuit half-open, probing AI service")
+        if self.probes_in_flight >= self.half_open_probes:
+            self.rejected += 1
+            raise CircuitOpenError(1)
+        self.probes_in_flight += 1
+        return True
+
+    def record(self, probe: bool, status_code: Optional[int]):
+        """Record a call outcome; status_code is None on success"""
+        if probe:
+            self.probes_in_flight -= 1
+        if not self.enabled:
+            return
+        if status_code is None:
+            if self.state != "closed":
+                logger.info("Circuit closed, AI service recovered")
+            self.state = "closed"
+            self.consecutive_failures = 0
+        elif status_code in UPSTREAM_FAILURE_STATUSES:
+            self.consecutive_failures += 1
+            if self.state == "half_open" or self.consecutive_failures >= self.failure_threshold:
+                self._open()
+
+    def release(self, probe: bool):
+        """Give back a probe slot for a call that ended without an upstream verdict"""
+        if probe:
+            self.probes_in_flight -= 1
+
+    def _open(self):
+        if self.state != "open":
+            self.opened += 1
+            logger.warning(
+                "Circuit opened after %s consecutive AI service failures; failing fast for %gs",
+                self.consecutive_failures, self.reset_seconds
+            )
+        self.state = "open"
+        self.opened_at = time.monotonic()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "state": self.state,
+            "consecutive_failures": self.consecutive_failures,
+            "failure_threshold": self.failure_threshold,
+            "reset_seconds": self.reset_seconds,
+            "retry_after": self.retry_after() if self.state == "open" else 0,
+            "times_opened": self.opened,
+            "rejected": self.rejected,
+        }
+
+class LatencyTracker:
+    """Recent successful call latencies per kind, used to time hedged requests"""
+    def __init__(self, window: int = 200):
+        self.samples: Dict[str, deque] = {}
+        self.window = window
+
+    def observe(self, kind: str, seconds: float):
+        self.samples.setdefault(kind, deque(maxlen=self.window)).append(seconds)
+
+    def percentile(self, kind: str, pct: float) -> Optional[float]:
+        samples = self.samples.get(kind)
+        if not samples or len(samples) < HEDGE_MIN_SAMPLES:
+            return None
+        ordered = sorted(samples)
+        return ordered[min(len(ordered) - 1, int(pct / 100 * len(ordered)))]
+
+def backoff_delay(attempt: int) -> float:
+    """Full-jitter exponential backoff for retry number attempt (0-based), in seconds"""
+    cap = min(UPSTREAM_RETRY_MAX_DELAY_MS, UPSTREAM_RETRY_BASE_DELAY_MS * (2 ** attempt))
+    return random.uniform(0, cap) / 1000
+
+upstream_circuit = CircuitBreaker(CIRCUIT_FAILURE_THRESHOLD, CIRCUIT_RESET_SECONDS, CIRCUIT_HALF_OPEN_PROBES)
+upstream_latency = LatencyTracker()
+
+@app.get("/admin/resilience")
+async def get_resilience_stats():
+    """Get circuit breaker state and hedging delays"""
+    return {
+        "circuit": upstream_circuit.stats(),
+        "retry": {
+            "max_retries": UPSTREAM_RETRY_ATTEMPTS,
+            "base_delay_ms": UPSTREAM_RETRY_BASE_DELAY_MS,
+            "max_delay_ms": UPSTREAM_RETRY_MAX_DELAY_MS,
+        },
+        "hedging": {
+            "enabled": HEDGE_ENABLED,
+            "percentile": HEDGE_PERCENTILE,
+            "delay_seconds": {
+                kind: upstream_latency.percentile(kind, HEDGE_PERCENTILE) for kind in upstream_latency.samples
+            },
+        },
+    }
+
+# --- Async model call layer ---
+
+# Only used when a model client has no native async API
+_model_executor = ThreadPoolExecutor(max_workers=GEMINI_MAX_WORKERS, thread_name_prefix="gemini")
+
+def raise_for_api_error(api_e: Exception):
+    """Translate an upstream AI service error into an HTTPException"""
+    error_message = str(api_e)
+    error_type = type(api_e).__name__
+    logger.error("Gemini API error: %s - %s", error_type, error_message)
+
+    if isinstance(api_e, (google_exceptions.TooManyRequests, google_exceptions.ResourceExhausted)) \
+            or "rate limit" in error_message.lower():
+        logger.error("Rate limit exceeded")
+        admission.on_rate_limited()
+        raise HTTPException(
+            status_code=429,
+            detail="AI service rate limit exceeded",
+            headers={"Retry-After": str(admission.retry_after())}
+        )
+    elif isinstance(api_e, google_exceptions.InvalidArgument) or "invalid request" in error_message.lower():
+        logger.error("Invalid request to Gemini API")
+        raise HTTPException(status_code=400, detail=f"Invalid request to AI service: {error_message}")
+    elif isinstance(api_e, (google_exceptions.Unauthenticated, google_exceptions.PermissionDenied)) \
+            or "authentication" in error_message.lower() or "unauthorized" in error_message.lower():
+        logger.error("Authentication error with Gemini API")
+        raise HTTPException(status_code=401, detail="AI service authentication failed")
+    else:
+        # Generic API error
+        raise HTTPException(status_code=502, detail=f"AI service error: {error_type}")
+
+def _response_tokens(response) -> int:
+    """Estimate output tokens of a model response; blocked responses have no text"""
+    try:
+        return estimate_tokens(response.text)
+    except (ValueError, AttributeError):
+        return 0
+
+async def _wait_for_disconnect(http_request: Request, poll_interval: float = 0.5):
+    """Resolve once the client behind http_request has gone away"""
+    while not await http_request.is_disconnected():
+        await asyncio.sleep(poll_interval)
+
+async def generate_content_async(
+    model,
+    prompt: str,
+    generation_config: Optional[Dict[str, Any]] = None,
+    http_request: Optional[Request] = None,
+    timeout: Optional[float] = None,
+    priority: int = PRIORITY_LESSON
+):
+    """
+    Call the model through the circuit breaker, retrying transient failures.
+
+    Retryable errors are retried with jittered exponential backoff. With hedging
+    enabled, a second call is sent once the first has run longer than the recent
+    latency percentile for its kind, and whichever succeeds first is used.
+    """
+    kind = PRIORITY_NAMES.get(priority, "other")
+    call = lambda: _generate_content_guarded(model, prompt, generation_config, http_request, timeout, priority)
+    for attempt in range(UPSTREAM_RETRY_ATTEMPTS + 1):
+        try:
+            return await _hedged(kind, call)
+        except HTTPException as e:
+            if e.status_code not in RETRYABLE_STATUSES or attempt == UPSTREAM_RETRY_ATTEMPTS:
+                raise
+            delay = backoff_delay(attempt)
+            upstream_retries.inc(kind)
+            logger.warning("Retrying %s model call in %.2fs after %s (retry %s)", kind, delay, e.status_code, attempt + 1)
+        await asyncio.sleep(delay)
+
+async def _hedged(kind: str, call):
+    """Run call, racing a second copy against it once it exceeds the hedge delay"""
+    delay = upstream_latency.percentile(kind, HEDGE_PERCENTILE) if HEDGE_ENABLED else None
+    if delay is None:
+        return await call()
+
+    primary = asyncio.ensure_future(call())
+    tasks = [primary]
+    try:
+        done, _ = await asyncio.wait(tasks, timeout=delay)
+        if not done:
+            hedged_requests.inc(kind, "sent")
+            tasks.append(asyncio.ensure_future(call()))
+        pending = set(tasks)
+        error = None
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    if task is not primary:
+                        hedged_requests.inc(kind, "won")
+                    return task.result()
+                error = task.exception()
+        raise error
+    finally:
+        # The slower call is cancelled, which also frees its admission slot
+        for task in tasks:
+            if not task.done():
+                task.cancel()
+
+async def _generate_content_guarded(model, prompt, generation_config, http_request, timeout, priority):
+    """Make one model call and report its outcome to the circuit breaker"""
+    probe = upstream_circuit.before_call()
+    try:
+        response = await _generate_content_once(
+            model, prompt, generation_config=generation_config, http_request=http_request,
+            timeout=timeout, priority=priority
+        )
+    except HTTPException as e:
+        upstream_circuit.record(probe, e.status_code)
+        raise
+    except BaseException:
+        upstream_circuit.release(probe)
+        raise
+    upstream_circuit.record(probe, None)
+    return response
+
+async def _generate_content_once(
+    model,
+    prompt: str,
+    generation_config: Optional[Dict[str, Any]] = None,
+    http_request: Optional[Request] = None,
+    timeout: Optional[float] = None,
+    priority: int = PRIORITY_LESSON
+):
+    """
+    Call the model without blocking the event loop.
+
+    Waits for admission first, then uses the client's native async API when available
+    and falls back to a bounded thread pool otherwise. The call is cancelled if it
+    exceeds the timeout or if the client behind http_request disconnects first.
+    """
+    timeout = GEMINI_TIMEOUT_SECONDS if timeout is None else timeout
+    kind = PRIORITY_NAMES.get(priority, "other")
+    input_tokens = call_input_tokens(model, prompt)
+
+    with StageTimer(kind, "admission_wait"):
+        await admission.acquire(priority, input_tokens)
+    record_tokens(kind, "input", input_tokens)
+    output_tokens = 0
+    outcome = "error"
+    call_started = time.perf_counter()
+    try:
+        if hasattr(model, "generate_content_async"):
+            call = asyncio.ensure_future(model.generate_content_async(prompt, generation_config=generation_config))
+        else:
+            loop = asyncio.get_running_loop()
+            call = loop.run_in_executor(
+                _model_executor,
+                lambda: model.generate_content(prompt, generation_config=generation_config)
+            )
+
+        waiters = [call]
+        disconnect_watch = None
+        if http_request is not None:
+            disconnect_watch = asyncio.ensure_future(_wait_for_disconnect(http_request))
+            waiters.append(disconnect_watch)
+
+        try:
+            done, _ = await asyncio.wait(waiters, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            # Also runs when the awaiting task itself is cancelled
+            for waiter in waiters:
+                if not waiter.done():
+                    waiter.cancel()
+
+        if call in done:
+            try:
+                response = call.result()
+            except google_exceptions.GoogleAPIError as api_e:
+                raise_for_api_error(api_e)
+            output_tokens = _response_tokens(response)
+            outcome = "ok"
+            upstream_latency.observe(kind, time.perf_counter() - call_started)
+            return response
+
+        if disconnect_watch is not None and disconnect_watch in done:
+            logger.warning("Client disconnected, cancelled Gemini API call")
+            outcome = "cancelled"
+            raise HTTPException(status_code=499, detail="Client closed request")
+
+        logger.error("Gemini API call timed out after %ss", timeout)
+        outcome = "timeout"
+        raise HTTPException(status_code=504, detail=f"AI service timed out after {timeout:g}s")
+    finally:
+        admission.release(output_tokens)
+        upstream_calls.inc(kind, outcome)
+        record_tokens(kind, "output", output_tokens)
+
+async def stream_content_async(
+    model,
+    prompt: str,
+    generation_config: Optional[Dict[str, Any]] = None,
+    timeout: Optional[float] = None,
+    priority: int = PRIORITY_CHAT
+):
+    """
+    Yield response text chunks as the model produces them, through the circuit breaker.
+
+    A retryable failure before the first chunk is retried with backoff; once text
+    has been yielded, errors are passed on to the caller.
+    """
+    kind = PRIORITY_NAMES.get(priority, "other")
+    for attempt in range(UPSTREAM_RETRY_ATTEMPTS + 1):
+        probe = upstream_circuit.before_call()
+        chunks = _stream_content_once(model, prompt, generation_config=generation_config, timeout=timeout, priority=priority)
+        yielded = False
+        settled = False
+        try:
+            async for text in chunks:
+                yielded = True
+                yield text
+            upstream_circuit.record(probe, None)
+            settled = True
+            return
+        except HTTPException as e:
+            upstream_circuit.record(probe, e.status_code)
+            settled = True
+            failed_status = e.status_code
+            if yielded or e.status_code not in RETRYABLE_STATUSES or attempt == UPSTREAM_RETRY_ATTEMPTS:
+                raise
+        finally:
+            if not settled:
+                upstream_circuit.release(probe)
+            await chunks.aclose()
+        delay = backoff_delay(attempt)
+        upstream_retries.inc(kind)
+        logger.warning("Retrying %s model stream in %.2fs after %s (retry %s)", kind, delay, failed_status, attempt + 1)
+        await asyncio.sleep(delay)
+
+async def _stream_content_once(
+    model,
+    prompt: str,
+    generation_config: Optional[Dict[str, Any]] = None,
+    timeout: Optional[float] = None,
+    priority: int = PRIORITY_CHAT
+):
+    """
+    Yield response text chunks from a single model call.
+
+    The timeout applies to the wait for each chunk rather than the whole response.
+    Clients without a native async API yield the full response as a single chunk.
+    """
+    timeout = GEMINI_TIMEOUT_SECONDS if timeout is None else timeout
+
+    if not hasattr(model, "generate_content_async"):
+        response = await _generate_content_once(
+            model, prompt, generation_config=generation_config, timeout=timeout, priority=priority
+        )
+        yield response.text
+        return
+
+    kind = PRIORITY_NAMES.get(priority, "other")
+    input_tokens = call_input_tokens(model, prompt)
+    with StageTimer(kind, "admission_wait"):
+        await admission.acquire(priority, input_tokens)
+    record_tokens(kind, "input", input_tokens)
+    output_tokens = 0
+    outcome = "error"
+    try:
+        response = await asyncio.wait_for(
+            model.generate_content_async(prompt, generation_config=generation_config, stream=True),
+            timeout
+        )
+        chunks = response.__aiter__()
+        while True:
+            try:
+                chunk = await asyncio.wait_for(chunks.__anext__(), timeout)
+            except StopAsyncIteration:
+                break
+            if chunk.text:
+                output_tokens += estimate_tokens(chunk.text)
+                yield chunk.text
+        outcome = "ok"
+    except asyncio.TimeoutError:
+        logger.error("Gemini API stream stalled for more than %ss", timeout)
+        outcome = "timeout"
+        raise HTTPException(status_code=504, detail=f"AI service timed out after {timeout:g}s")
+    except google_exceptions.GoogleAPIError as api_e:
+        raise_for_api_error(api_e)
+    except (asyncio.CancelledError, GeneratorExit):
+        outcome = "cancelled"
+        raise
+    finally:
+        admission.release(output_tokens)
+        upstream_calls.inc(kind, outcome)
+        record_tokens(kind, "output", output_tokens)
+
+# --- Shared cross-worker store ---
+
+class SharedStore:
+    """
+    Cache entries and in-flight claims shared by all workers on one host.
+
+    Backed by a local SQLite file in WAL mode, so readers never block the writer and
+    no external service is needed. A claim marks a key as being generated by one
+    worker; other workers wait for its result instead of calling the model again.
+    Claims expire, so a worker that dies mid-generation cannot block a key forever.
+    """
+    SWEEP_EVERY = 100
+
+    def __init__(self, path: str):
+        self.path = path
+        self.owner = f"{os.getpid()}-{random.getrandbits(32):08x}"
+        self._writes = 0
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=5)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS cache_entries ("
+            "namespace TEXT NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL, stored_at REAL NOT NULL, "
+            "PRIMARY KEY (namespace, key))"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS cache_entries_stored_at ON cache_entries (namespace, stored_at)")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS claims ("
+            "namespace TEXT NOT NULL, key TEXT NOT NULL, owner TEXT NOT NULL, expires_at REAL NOT NULL, "
+            "PRIMARY KEY (namespace, key))"
+        )
+
+    def get(self, namespace: str, key: str) -> Optional[tuple]:
+        """Return (stored_at, value) for key, or None"""
+        with self._lock:
+            row = self._db.execute(
+                "SELECT stored_at, value FROM cache_entries WHERE namespace = ? AND key = ?", (namespace, key)
+            ).fetchone()
+        if row is None:
+            return None
+        return row[0], json.loads(row[1])
+
+    def set(self, namespace: str, key: str, value: Any, stored_at: float, ttl_seconds: float, max_entries: int):
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO cache_entries (namespace, key, value, stored_at) VALUES (?, ?, ?, ?)",
+                (namespace, key, json.dumps(value), stored_at)
+            )
+            self._writes += 1
+            if self._writes % self.SWEEP_EVERY == 0:
+                self._sweep(namespace, ttl_seconds, max_entries)
+
+    def _sweep(self, namespace: str, ttl_seconds: float, max_entries: int):
+        """Drop expired entries, then the oldest ones beyond max_entries"""
+        self._db.execute(
+            "DELETE FROM cache_entries WHERE namespace = ? AND stored_at < ?", (namespace, time.time() - ttl_seconds)
+        )
+        self._db.execute(
+            "DELETE FROM cache_entries WHERE namespace = ? AND key IN ("
+            "SELECT key FROM cache_entries WHERE namespace = ? ORDER BY stored_at DESC LIMIT -1 OFFSET ?)",
+            (namespace, namespace, max_entries)
+        )
+        self._db.execute("DELETE FROM claims WHERE expires_at < ?", (time.time(),))
+
+    def claim(self, namespace: str, key: str, ttl_seconds: float) -> bool:
+        """Atomically claim key for this worker; False if another worker holds a live claim"""
+        now = time.time()
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                row = self._db.execute(
+                    "SELECT owner, expires_at FROM claims WHERE namespace = ? AND key = ?", (namespace, key)
+                ).fetchone()
+                claimed = row is None or row[1] < now
+                if claimed:
+                    self._db.execute(
+                        "INSERT OR REPLACE INTO claims (namespace, key, owner, expires_at) VALUES (?, ?, ?, ?)",
+                        (namespace, key, self.owner, now + ttl_seconds)
+                    )
+                self._db.execute("COMMIT")
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                raise
+        return claimed
+
+    def is_claimed(self, namespace: str, key: str) -> bool:
+        with self._lock:
+            row = self._db.execute(
+                "SELECT expires_at FROM claims WHERE namespace = ? AND key = ?", (namespace, key)
+            ).fetchone()
+        return row is not None and row[0] >= time.time()
+
+    def release(self, namespace: str, key: str):
+        with self._lock:
+            self._db.execute(
+                "DELETE FROM claims WHERE namespace = ? AND key = ? AND owner = ?", (namespace, key, self.owner)
+            )
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            entries = dict(self._db.execute(
+                "SELECT namespace, COUNT(*) FROM cache_entries GROUP BY namespace"
+            ).fetchall())
+            claims = self._db.execute("SELECT COUNT(*) FROM claims WHERE expires_at >= ?", (time.time(),)).fetchone()[0]
+        return {"backend": "sqlite", "path": self.path, "entries": entries, "active_claims": claims}
+
+def create_shared_store() -> Optional[SharedStore]:
+    """Create the cross-worker store selected by CACHE_BACKEND, or None for process-local caching"""
+    if CACHE_BACKEND == "sqlite":
+        return SharedStore(SHARED_CACHE_PATH)
+    if CACHE_BACKEND != "local":
+        raise ValueError(f"Unknown CACHE_BACKEND '{CACHE_BACKEND}'. Expected 'local' or 'sqlite'")
+    return None
+
+shared_store = DeferredStore("shared cache", create_shared_store)
+
+# --- Generation cache ---
+
+class GenerationCache:
+    """
+    In-memory LRU cache with TTL and an optional on-disk JSON tier.
+
+    Values must be JSON-serializable. Disk entries are promoted back into
+    memory on read, so a restarted worker warms up from disk.
+    """
+    def __init__(
+        self,
+        name: str,
+        max_entries: int,
+        ttl_seconds: float,
+        disk_dir: str = "",
+        shared: Optional[DeferredStore] = None
+    ):
+        self.name = name
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.disk_dir = disk_dir
+        self._shared = shared
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()  # key -> (stored_at, value)
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.stale_hits = 0
+        self.shared_hits = 0
+        if disk_dir:
+            os.makedirs(disk_dir, exist_ok=True)
+
+    @property
+    def shared(self) -> Optional[SharedStore]:
+        """The cross-worker store, opened on first use; None for process-local caching"""
+        return self._shared.get() if self._shared is not None else None
+
+    def _disk_path(self, key: str) -> str:
+        return os.path.join(self.disk_dir, f"{self.name}-{key}.json")
+
+    def _read_disk(self, key: str, allow_expired: bool = False):
+        try:
+            with open(self._disk_path(key), "r", encoding="utf-8") as f:
+                stored = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if not allow_expired and time.time() - stored["stored_at"] > self.ttl_seconds:
+            return None
+        return stored["stored_at"], stored["value"]
+
+    def _write_disk(self, key: str, stored_at: float, value: Any):
+        path = self._disk_path(key)
+        tmp_path = f"{path}.tmp"
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump({"stored_at": stored_at, "value": value}, f)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logger.warning("Could not write %s cache entry to disk: %s", self.name, e)
+
+    def get(self, key: str):
+        """Return the cached value for key, or None on a miss or expiry"""
+        entry = self._entries.get(key)
+        if entry is not None and time.time() - entry[0] <= self.ttl_seconds:
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+        # Expired entries stay until evicted so get_stale can still serve them
+
+        if self.shared is not None:
+            entry = self.shared.get(self.name, key)
+            if entry is not None and time.time() - entry[0] <= self.ttl_seconds:
+                self._store(key, entry)
+                self.shared_hits += 1
+                return entry[1]
+
+        if self.disk_dir:
+            entry = self._read_disk(key)
+            if entry is not None:
+                self._store(key, entry)
+                self.disk_hits += 1
+                return entry[1]
+
+        self.misses += 1
+        return None
+
+    def get_stale(self, key: str):
+        """Return the value for key even if it has expired, or None; used when the model is unavailable"""
+        entry = self._entries.get(key)
+        if entry is None and self.shared is not None:
+            entry = self.shared.get(self.name, key)
+        if entry is None and self.disk_dir:
+            entry = self._read_disk(key, allow_expired=True)
+        if entry is None:
+            return None
+        self.stale_hits += 1
+        return entry[1]
+
+    def _store(self, key: str, entry: tuple):
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def set(self, key: str, value: Any):
+        stored_at = time.time()
+        self._store(key, (stored_at, value))
+        if self.shared is not None:
+            self.shared.set(self.name, key, value, stored_at, self.ttl_seconds, self.max_entries)
+        if self.disk_dir:
+            self._write_disk(key, stored_at, value)
+
+    def peek(self, key: str):
+        """Return the cached value for key if present and fresh, without counting a lookup"""
+        entry = self._entries.get(key)
+        if entry is None and self.shared is not None:
+            entry = self.shared.get(self.name, key)
+        if entry is None and self.disk_dir:
+            entry = self._read_disk(key)
+        if entry is None or time.time() - entry[0] > self.ttl_seconds:
+            return None
+        return entry[1]
+
+    def age(self, key: str) -> Optional[float]:
+        """Seconds since key was stored, or None if absent or expired; does not count as a lookup"""
+        entry = self._entries.get(key)
+        if entry is None and self.shared is not None:
+            entry = self.shared.get(self.name, key)
+        if entry is None and self.disk_dir:
+            entry = self._read_disk(key)
+        if entry is None:
+            return None
+        age = time.time() - entry[0]
+        return age if age <= self.ttl_seconds else None
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.shared_hits + self.disk_hits + self.misses
+        return {
+            "name": self.name,
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "ttl_seconds": self.ttl_seconds,
+            "disk_enabled": bool(self.disk_dir),
+            "shared_enabled": self.shared is not None,
+            "hits": self.hits,
+            "shared_hits": self.shared_hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "stale_hits": self.stale_hits,
+            "hit_rate": round((self.hits + self.shared_hits + self.disk_hits) / lookups, 4) if lookups else 0.0,
+        }
+
+lesson_cache = GenerationCache(
+    "lesson", LESSON_CACHE_MAX_ENTRIES, LESSON_CACHE_TTL_SECONDS, LESSON_CACHE_DIR, shared_store
+)
+story_cache = GenerationCache("story", STORY_CACHE_MAX_ENTRIES, STORY_CACHE_TTL_SECONDS, LESSON_CACHE_DIR, shared_store)
+
+def _normalize_text(value: Optional[str]) -> str:
+    return " ".join(value.lower().split()) if value else ""
+
+def score_bucket(last_quiz_score: Optional[float]) -> str:
+    """Bucket a quiz score to match the >80 / <=80 branches of the lesson prompt"""
+    if last_quiz_score is None:
+        return "none"
+    return "high" if last_quiz_score > 80 else "low"
+
+def lesson_cache_key(
+    current_topic: str,
+    learning_objectives: List[str],
+    subject: Optional[str] = None,
+    challenge_level: Optional[str] = None,
+    learning_style: Optional[str] = None,
+    last_quiz_score: Optional[float] = None
+) -> str:
+    """Hash the adaptive inputs of a lesson prompt; student_id is deliberately excluded"""
+    key_fields = {
+        "prompt": LESSON_PROMPT.id,  # A new template version starts a fresh cache
+        "topic": _normalize_text(current_topic),
+        "subject": _normalize_text(subject),
+        "challenge_level": _normalize_text(challenge_level),
+        "learning_style": _normalize_text(learning_style),
+        # The score only shapes the prompt when no challenge level is given
+        "score": "n/a" if challenge_level else score_bucket(last_quiz_score),
+        "objectives": sorted({_normalize_text(o) for o in learning_objectives if o and o.strip()}),
+    }
+    encoded = json.dumps(key_fields, sort_keys=True, separators=(",", ":")).encode("utf-8")
+    return hashlib.sha256(encoded).hexdigest()
+
+def story_request_key(
+    theme: str,
+    character_ideas: List[str],
+    starting_phrase: str,
+    age_group: str,
+    category: str
+) -> str:
+    """Hash the normalized inputs of a story starter prompt"""
+    key_fields = {
+        "prompt": STORY_PROMPT.id,
+        "theme": _normalize_text(theme),
+        "characters": sorted({_normalize_text(c) for c in character_ideas if c and c.strip()}),
+        "starting_phrase": _normalize_text(starting_phrase),
+        "age_group": _normalize_text(age_group),
+        "category": _normalize_text(category),
+    }
+    encoded = json.dumps(key_fields, sort_keys=True, separators=(",", ":")).encode("utf-8")
+    return hashlib.sha256(encoded).hexdigest()
+
+# --- Request coalescing ---
+
+class SingleFlight:
+    """
+    Coalesce concurrent calls that share a key into one upstream call.
+
+    The first caller for a key starts the call as a background task; later callers
+    await the same task. The task is shielded from any single caller going away and
+    is only cancelled once every waiter has left. Results and errors are delivered
+    to all waiters, and the key is released as soon as the task finishes.
+
+    With a shared store, the task first claims the key across workers. If another
+    worker holds the claim, it waits for that worker's result to land in the cache.
+    """
+    def __init__(self, name: str, cache: Optional[GenerationCache] = None):
+        self.name = name
+        self.cache = cache
+        self._calls: Dict[str, Dict[str, Any]] = {}  # key -> {"task": Task, "waiters": int}
+        self.leaders = 0
+        self.followers = 0
+        self.remote_waits = 0
+        self.remote_hits = 0
+
+    async def _run(self, key: str, factory):
+        """Run factory(), unless another worker is already generating key"""
+        shared = self.cache.shared if self.cache is not None else None
+        if shared is None:
+            return await factory()
+        while True:
+            waiting_since = time.time()
+            if shared.claim(self.name, key, SHARED_CLAIM_TTL_SECONDS):
+                try:
+                    return await factory()
+                finally:
+                    shared.release(self.name, key)
+
+            self.remote_waits += 1
+            logger.info("Waiting for another worker's in-flight %s request", self.name)
+            while shared.is_claimed(self.name, key):
+                await asyncio.sleep(SHARED_POLL_INTERVAL_MS / 1000)
+            entry = shared.get(self.cache.name, key)
+            if entry is not None and entry[0] >= waiting_since:
+                self.remote_hits += 1
+                return entry[1]
+            # The other worker failed or its claim expired; try to claim the key here
+
+    def _release(self, key: str, call: Dict[str, Any]):
+        if self._calls.get(key) is call:
+            del self._calls[key]
+
+    async def do(self, key: str, factory, http_request: Optional[Request] = None):
+        """Run factory() once per in-flight key and return its result to every caller"""
+        call = self._calls.get(key)
+        if call is None:
+            call = {"task": asyncio.ensure_future(self._run(key, factory)), "waiters": 0}
+            self._calls[key] = call
+            call["task"].add_done_callback(lambda _task: self._release(key, call))
+            self.leaders += 1
+        else:
+            self.followers += 1
+            logger.info("Joining in-flight %s request", self.name)
+
+        task = call["task"]
+        call["waiters"] += 1
+        try:
+            if http_request is None:
+                return await asyncio.shield(task)
+
+            disconnect_watch = asyncio.ensure_future(_wait_for_disconnect(http_request))
+            try:
+                done, _ = await asyncio.wait([task, disconnect_watch], return_when=asyncio.FIRST_COMPLETED)
+            finally:
+                if not disconnect_watch.done():
+                    disconnect_watch.cancel()
+            if task in done:
+                return task.result()
+            logger.warning("Client disconnected while waiting for %s request", self.name)
+            raise HTTPException(status_code=499, detail="Client closed request")
+        finally:
+            call["waiters"] -= 1
+            if call["waiters"] == 0 and not task.done():
+                task.cancel()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "name": self.name,
+            "in_flight": len(self._calls),
+            "upstream_calls": self.leaders,
+            "coalesced": self.followers,
+            "waited_on_other_workers": self.remote_waits,
+            "served_by_other_workers": self.remote_hits,
+        }
+
+lesson_flights = SingleFlight("lesson", lesson_cache)
+story_flights = SingleFlight("story", story_cache)
+
+# --- Semantic cache ---
+
+# Filler words that rarely change what a child is asking
+SEMANTIC_STOP_WORDS = frozenset({
+    "a", "an", "the", "is", "are", "was", "were", "be", "do", "does", "did", "can", "could", "would",
+    "you", "me", "i", "my", "tell", "about", "please", "of", "to", "some", "really", "so", "just",
+})
+
+class SemanticCache:
+    """
+    Near-duplicate lookup for free-text requests by cosine similarity.
+
+    Texts are normalized (lowercased, filler words dropped, plurals folded) and
+    hashed into a fixed-size vector of word, word-pair and character-trigram
+    features. All vectors share one NumPy matrix, so a lookup is a single
+    matrix-vector product masked to the request's scope. Texts containing
+    different numbers never match. The least recently used entry is evicted
+    when the matrix is full.
+    """
+    def __init__(self, name: str, max_entries: int, threshold: float, ttl_seconds: float, dimensions: int):
+        self.name = name
+        self.max_entries = max_entries
+        self.threshold = threshold
+        self.ttl_seconds = ttl_seconds
+        self.dimensions = dimensions
+        # Allocated on the first insert, so an unused cache costs nothing at startup
+        self.matrix: Optional["np.ndarray"] = None
+        self.row_scope: Optional["np.ndarray"] = None
+        self.row_used: Optional["np.ndarray"] = None
+        self.stored_at: Optional["np.ndarray"] = None
+        self.values: List[Any] = []
+        self._lru: "OrderedDict[int, None]" = OrderedDict()
+        self._free: List[int] = []
+        self._high_water = 0  # Rows at or above this have never been used
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def _words(text: str) -> List[str]:
+        words = []
+        for word in re.findall(r"[a-z0-9]+", re.sub(r"'s\b", "", text.lower())):
+            if word in SEMANTIC_STOP_WORDS:
+                continue
+            if len(word) > 3 and word.endswith("ies"):
+                word = word[:-3] + "y"
+            elif len(word) > 3 and word.endswith("es") and word[-3] in "sxz":
+                word = word[:-2]
+            elif len(word) > 3 and word.endswith("s") and not word.endswith("ss"):
+                word = word[:-1]
+            words.append(word)
+        return words
+
+    def vectorize(self, text: str) -> "np.ndarray":
+        """Unit-length hashed feature vector of text"""
+        vector = np.zeros(self.dimensions, dtype=np.float32)
+        words = self._words(text)
+        features = []
+        for word in words:
+            features.append((f"w:{word}", 1.0))
+            padded = f" {word} "
+            trigrams = [padded[i:i + 3] for i in range(len(padded) - 2)]
+            # Trigrams catch spelling variants without outweighing the word itself
+            weight = 1.0 / math.sqrt(len(trigrams))
+            features.extend((f"c:{trigram}", weight) for trigram in trigrams)
+        features.extend((f"b:{first} {second}", 0.7) for first, second in zip(words, words[1:]))
+        for feature, weight in features:
+            hashed = zlib.crc32(feature.encode("utf-8"))
+            # The hash's top bit picks the sign, so collisions tend to cancel out
+            vector[hashed % self.dimensions] += -weight if hashed & 0x80000000 else weight
+        norm = float(np.linalg.norm(vector))
+        return vector / norm if norm else vector
+
+    @staticmethod
+    def _scope_id(scope: tuple, text: str) -> int:
+        numbers = tuple(sorted(set(re.findall(r"\d+", text))))
+        digest = hashlib.blake2b(repr((scope, numbers)).encode("utf-8"), digest_size=8).digest()
+        return int.from_bytes(digest, "little", signed=True)
+
+    def _best_row(self, scope_id: int, vector: "np.ndarray"):
+        if self._high_water == 0 or not vector.any():
+            return None, 0.0
+        scores = self.matrix[:self._high_water] @ vector
+        scores[(self.row_scope[:self._high_water] != scope_id) | ~self.row_used[:self._high_water]] = -1.0
+        row = int(np.argmax(scores))
+        return row, float(scores[row])
+
+    def _release(self, row: int):
+        self.row_used[row] = False
+        self.values[row] = None
+        self._lru.pop(row, None)
+        self._free.append(row)
+
+    def get(self, scope: tuple, text: str) -> Optional[Any]:
+        """Return the value stored for the most similar text in scope, if similar enough and fresh"""
+        row, score = self._best_row(self._scope_id(scope, text), self.vectorize(text))
+        if row is None or score < self.threshold:
+            self.misses += 1
+            return None
+        if time.time() - self.stored_at[row] > self.ttl_seconds:
+            self._release(row)
+            self.misses += 1
+            return None
+        self._lru.move_to_end(row)
+        self.hits += 1
+        return self.values[row]
+
+    def _allocate(self):
+        self.matrix = np.zeros((self.max_entries, self.dimensions), dtype=np.float32)
+        self.row_scope = np.zeros(self.max_entries, dtype=np.int64)
+        self.row_used = np.zeros(self.max_entries, dtype=bool)
+        self.stored_at = np.zeros(self.max_entries, dtype=np.float64)
+        self.values = [None] * self.max_entries
+        self._free = list(range(self.max_entries - 1, -1, -1))
+
+    def set(self, scope: tuple, text: str, value: Any):
+        vector = self.vectorize(text)
+        if not vector.any():
+            return
+        if self.matrix is None:
+            self._allocate()
+        scope_id = self._scope_id(scope, text)
+        row, score = self._best_row(scope_id, vector)
+        # A near-identical text replaces the old entry rather than taking a second row
+        if row is None or score < 0.999:
+            if not self._free:
+                self._release(next(iter(self._lru)))
+                self.evictions += 1
+            row = self._free.pop()
+            self._high_water = max(self._high_water, row + 1)
+        self.matrix[row] = vector
+        self.row_scope[row] = scope_id
+        self.row_used[row] = True
+        self.stored_at[row] = time.time()
+        self.values[row] = value
+        self._lru[row] = None
+        self._lru.move_to_end(row)
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._lru),
+            "max_entries": self.max_entries,
+            "threshold": self.threshold,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            "evictions": self.evictions,
+        }
+
+def create_semantic_cache(name: str) -> Optional[SemanticCache]:
+    if not SEMANTIC_CACHE_ENABLED:
+        return None
+    return SemanticCache(
+        name, SEMANTIC_CACHE_MAX_ENTRIES, SEMANTIC_CACHE_THRESHOLD, SEMANTIC_CACHE_TTL_SECONDS, SEMANTIC_CACHE_DIMENSIONS
+    )
+
+chat_semantic_cache = create_semantic_cache("chat")
+story_semantic_cache = create_semantic_cache("story")
+
+@app.get("/api/cache/stats")
+async def get_cache_stats():
+    """Get hit/miss counters for the generation caches"""
+    shared = shared_store.get()
+    return {
+        "lesson": lesson_cache.stats(),
+        "story": story_cache.stats(),
+        "shared": shared.stats() if shared is not None else None,
+        "semantic": {
+            "chat": chat_semantic_cache.stats() if chat_semantic_cache is not None else None,
+            "story": story_semantic_cache.stats() if story_semantic_cache is not None else None,
+        },
+        "coalescing": {
+            "lesson": lesson_flights.stats(),
+            "story": story_flights.stats(),
+        },
+    }
+
+# --- Lesson repository ---
+
+def encode_lesson_content(lesson_data: Dict[str, Any]) -> bytes:
+    """Canonical JSON of a lesson without its ID; identical content encodes identically"""
+    content = {key: value for key, value in lesson_data.items() if key != "lesson_id"}
+    return json.dumps(content, sort_keys=True, separators=(",", ":")).encode("utf-8")
+
+def lesson_fingerprint_id(lesson_data: Dict[str, Any]) -> int:
+    """Stable lesson ID derived from the content, for lessons without a repository ID"""
+    return int.from_bytes(hashlib.sha256(encode_lesson_content(lesson_data)).digest()[:8], "big") & MAX_ID
+
+class LessonRepository:
+    """
+    Persistent store of every generated lesson, with real IDs.
+
+    Lessons are stored once per distinct content as zlib-compressed JSON and indexed
+    by subject, topic, difficulty and learning style, so they can be fetched by ID,
+    searched, or reused instead of generating a near-identical lesson again.
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self.reused = 0
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=5)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS lessons ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, content_hash TEXT NOT NULL UNIQUE, request_key TEXT NOT NULL, "
+            "subject TEXT NOT NULL, topic TEXT NOT NULL, difficulty TEXT NOT NULL, learning_style TEXT NOT NULL, "
+            "title TEXT NOT NULL, created_at REAL NOT NULL, data BLOB NOT NULL)"
+        )
+        self._db.execute(
+            "CREATE INDEX IF NOT EXISTS lessons_lookup ON lessons (subject, topic, difficulty, learning_style)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS lessons_topic ON lessons (topic)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS lessons_request_key ON lessons (request_key, created_at)")
+
+    @staticmethod
+    def _decode(blob: bytes) -> Dict[str, Any]:
+        return json.loads(zlib.decompress(blob))
+
+    def save(
+        self,
+        request_key: str,
+        lesson_data: Dict[str, Any],
+        topic: str,
+        subject: Optional[str],
+        difficulty: Optional[str],
+        learning_style: Optional[str]
+    ) -> int:
+        """Store a lesson and return its ID; identical content keeps its existing ID"""
+        encoded = encode_lesson_content(lesson_data)
+        content_hash = hashlib.sha256(encoded).hexdigest()
+        with self._lock:
+            self._db.execute(
+                "INSERT OR IGNORE INTO lessons (content_hash, request_key, subject, topic, difficulty, learning_style, "
+                "title, created_at, data) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    content_hash, request_key, _normalize_text(subject), _normalize_text(topic),
+                    _normalize_text(difficulty), _normalize_text(learning_style),
+                    lesson_data.get("lessonTitle", ""), time.time(), zlib.compress(encoded, 6)
+                )
+            )
+            return self._db.execute("SELECT id FROM lessons WHERE content_hash = ?", (content_hash,)).fetchone()[0]
+
+    def get(self, lesson_id: int) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            row = self._db.execute("SELECT data FROM lessons WHERE id = ?", (lesson_id,)).fetchone()
+        if row is None:
+            return None
+        return {"lesson_id": lesson_id, **self._decode(row[0])}
+
+    def latest_for_request(self, request_key: str, max_age_seconds: float) -> Optional[Dict[str, Any]]:
+        """The newest lesson generated for exactly these adaptive inputs, if recent enough"""
+        with self._lock:
+            row = self._db.execute(
+                "SELECT id, data FROM lessons WHERE request_key = ? AND created_at >= ? "
+                "ORDER BY created_at DESC LIMIT 1",
+                (request_key, time.time() - max_age_seconds)
+            ).fetchone()
+        if row is None:
+            return None
+        self.reused += 1
+        return {"lesson_id": row[0], **self._decode(row[1])}
+
+    def search(
+        self,
+        subject: Optional[str] = None,
+        topic: Optional[str] = None,
+        difficulty: Optional[str] = None,
+        learning_style: Optional[str] = None,
+        limit: int = 20
+    ) -> List[Dict[str, Any]]:
+        """Summaries of lessons matching every given index field, newest first"""
+        clauses, params = [], []
+        for column, value in (
+            ("subject", subject), ("topic", topic), ("difficulty", difficulty), ("learning_style", learning_style)
+        ):
+            if value is not None:
+                clauses.append(f"{column} = ?")
+                params.append(_normalize_text(value))
+        where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT id, title, subject, topic, difficulty, learning_style, created_at FROM lessons "
+                f"{where} ORDER BY created_at DESC LIMIT ?",
+                (*params, limit)
+            ).fetchall()
+        columns = ("lesson_id", "lessonTitle", "subject", "topic", "difficulty", "learning_style", "created_at")
+        return [dict(zip(columns, row)) for row in rows]
+
+    def closest(
+        self,
+        topic: str,
+        subject: Optional[str] = None,
+        difficulty: Optional[str] = None,
+        learning_style: Optional[str] = None
+    ) -> Optional[Dict[str, Any]]:
+        """
+        Find the stored lesson that best matches a lesson request.
+
+        Candidates share at least one topic word or the subject. They are ranked by
+        topic word overlap first, then by matching subject, difficulty and learning
+        style, then by recency.
+        """
+        topic_words = set(_normalize_text(topic).split())
+        if not topic_words:
+            return None
+        subject, difficulty, learning_style = (
+            _normalize_text(subject), _normalize_text(difficulty), _normalize_text(learning_style)
+        )
+        like_clauses = " OR ".join("(' ' || topic || ' ') LIKE ?" for _ in topic_words)
+        params = [f"% {word} %" for word in topic_words]
+        if subject:
+            like_clauses += " OR subject = ?"
+            params.append(subject)
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT id, subject, topic, difficulty, learning_style, created_at FROM lessons "
+                f"WHERE {like_clauses} ORDER BY created_at DESC LIMIT 500",
+                params
+            ).fetchall()
+
+        best, best_score = None, 0.0
+        for lesson_id, row_subject, row_topic, row_difficulty, row_style, _ in rows:
+            row_words = set(row_topic.split())
+            overlap = len(topic_words & row_words) / len(topic_words | row_words)
+            if overlap == 0:
+                continue
+            score = 4 * overlap
+            score += 2 if subject and row_subject == subject else 0
+            score += 1.5 if difficulty and row_difficulty == difficulty else 0
+            score += 1 if learning_style and row_style == learning_style else 0
+            if score > best_score:
+                best, best_score = lesson_id, score
+        if best is None:
+            return None
+        # 8.5 is a perfect match on every field
+        return {"lesson_id": best, "score": round(best_score / 8.5, 3), "lesson": self.get(best)}
+
+    @staticmethod
+    def _subject_clause(subject: str, topics: List[str]):
+        """Lessons of a subject, including those generated without one for a topic of that subject"""
+        topics = [_normalize_text(topic) for topic in topics]
+        placeholders = ", ".join("?" for _ in topics) or "NULL"
+        return f"(subject = ? OR (subject = '' AND topic IN ({placeholders})))", [_normalize_text(subject), *topics]
+
+    def fingerprint(self, subject: str, topics: List[str]) -> tuple:
+        """Changes whenever a lesson is added for the subject"""
+        where, params = self._subject_clause(subject, topics)
+        with self._lock:
+            return tuple(self._db.execute(f"SELECT COUNT(*), MAX(id) FROM lessons WHERE {where}", params).fetchone())
+
+    def export(self, subject: str, topics: List[str]) -> List[tuple]:
+        """The newest lesson for each topic, difficulty and learning style of a subject"""
+        where, params = self._subject_clause(subject, topics)
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT id, topic, difficulty, learning_style, data FROM lessons "
+                f"WHERE {where} ORDER BY topic, difficulty, learning_style, created_at DESC, id DESC",
+                params
+            ).fetchall()
+        lessons, seen = [], set()
+        for lesson_id, topic, difficulty, learning_style, blob in rows:
+            if (topic, difficulty, learning_style) in seen:
+                continue
+            seen.add((topic, difficulty, learning_style))
+            lessons.append((topic, difficulty, learning_style, {"lesson_id": lesson_id, **self._decode(blob)}))
+        return lessons
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            count, stored_bytes = self._db.execute(
+                "SELECT COUNT(*), COALESCE(SUM(LENGTH(data)), 0) FROM lessons"
+            ).fetchone()
+        return {"path": self.path, "lessons": count, "stored_bytes": stored_bytes, "reused": self.reused}
+
+lesson_store = DeferredStore("lesson store", lambda: LessonRepository(LESSON_STORE_PATH) if LESSON_STORE_PATH else None)
+
+def get_lesson_repository() -> Optional[LessonRepository]:
+    return lesson_store.get()
+
+def remember_lesson(
+    cache_key: str,
+    lesson_data: Dict[str, Any],
+    current_topic: str,
+    subject: Optional[str],
+    challenge_level: Optional[str],
+    learning_style: Optional[str]
+):
+    """Give a newly generated lesson its permanent ID, then cache it"""
+    lesson_repository = get_lesson_repository()
+    if lesson_repository is not None:
+        lesson_data["lesson_id"] = lesson_repository.save(
+            cache_key, lesson_data, current_topic, subject,
+            challenge_level or lesson_data.get("difficultyLevel"), learning_style
+        )
+    else:
+        lesson_data["lesson_id"] = lesson_fingerprint_id(lesson_data)
+    lesson_cache.set(cache_key, lesson_data)
+
+def _require_lesson_repository() -> LessonRepository:
+    lesson_repository = get_lesson_repository()
+    if lesson_repository is None:
+        raise HTTPException(status_code=404, detail="Lesson store is disabled")
+    return lesson_repository
+
+@app.get("/api/lessons", response_model=List[Dict[str, Any]])
+async def search_lessons(
+    subject: Optional[str] = None,
+    topic: Optional[str] = None,
+    difficulty: Optional[str] = None,
+    learning_style: Optional[str] = None,
+    limit: int = 20
+):
+    """List stored lessons matching the given subject, topic, difficulty and learning style"""
+    return _require_lesson_repository().search(subject, topic, difficulty, learning_style, min(max(limit, 1), 200))
+
+@app.get("/api/lessons/closest")
+async def get_closest_lesson(
+    topic: str,
+    subject: Optional[str] = None,
+    challenge_level: Optional[str] = None,
+    learning_style: Optional[str] = None
+):
+    """Find the stored lesson closest to a lesson request, to reuse instead of generating a new one"""
+    match = _require_lesson_repository().closest(topic, subject, challenge_level, learning_style)
+    if match is None:
+        raise HTTPException(status_code=404, detail=f"No stored lesson resembles topic '{topic}'")
+    match["lesson"] = LessonResponse.model_validate(match["lesson"]).model_dump()
+    return match
+
+@app.get("/api/lessons/{lesson_id}", response_model=LessonResponse)
+async def get_lesson(lesson_id: int = Path(ge=0, le=MAX_ID)):
+    """Fetch a stored lesson by ID"""
+    lesson_data = _require_lesson_repository().get(lesson_id)
+    if lesson_data is None:
+        raise HTTPException(status_code=404, detail=f"Lesson {lesson_id} not found")
+    lesson = LessonResponse.model_validate(lesson_data)
+    return Response(content=lesson.model_dump_json(), media_type="application/json")
+
+# --- Student mastery ---
+
+class MasteryModel:
+    """
+    Per-student, per-topic mastery estimates updated from quiz results.
+
+    Uses an Elo-style rule on a logistic scale: each (student, topic) pair has an
+    ability and each topic a difficulty, and a quiz result moves both by how far
+    the observed score was from the expected one. State is held in flat arrays
+    indexed by slot, so updates and lookups are O(1) however many students there
+    are. Every update is also written to SQLite and reloaded at startup.
+    """
+    def __init__(self, path: str = ""):
+        self.path = path
+        self.updates = 0
+        self.adapted = 0
+        self.slots: Dict[tuple, int] = {}  # (student_id, topic index) -> slot
+        self.student_slots: Dict[int, List[int]] = {}
+        self.topic_index: Dict[str, int] = {}
+        self.topic_names: List[str] = []
+        # Per slot
+        self.slot_student = array("q")
+        self.slot_topic = array("I")
+        self.ability = array("d")
+        self.attempts = array("I")
+        self.updated_at = array("d")
+        # Per topic
+        self.difficulty = array("d")
+        self.topic_attempts = array("I")
+        self._lock = threading.Lock()
+        self._db = None
+        if path:
+            self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=5)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS mastery (student_id INTEGER NOT NULL, topic TEXT NOT NULL, "
+                "ability REAL NOT NULL, attempts INTEGER NOT NULL, updated_at REAL NOT NULL, "
+                "PRIMARY KEY (student_id, topic))"
+            )
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS topic_difficulty (topic TEXT PRIMARY KEY, "
+                "difficulty REAL NOT NULL, attempts INTEGER NOT NULL)"
+            )
+            self._load()
+
+    def _load(self):
+        for topic, difficulty, attempts in self._db.execute("SELECT topic, difficulty, attempts FROM topic_difficulty"):
+            index = self._topic(topic)
+            self.difficulty[index] = difficulty
+            self.topic_attempts[index] = attempts
+        for student_id, topic, ability, attempts, updated_at in self._db.execute(
+            "SELECT student_id, topic, ability, attempts, updated_at FROM mastery"
+        ):
+            slot = self._slot(student_id, self._topic(topic))
+            self.ability[slot] = ability
+            self.attempts[slot] = attempts
+            self.updated_at[slot] = updated_at
+
+    def _topic(self, topic: str) -> int:
+        index = self.topic_index.get(topic)
+        if index is None:
+            index = self.topic_index[topic] = len(self.topic_names)
+            self.topic_names.append(topic)
+            self.difficulty.append(0.0)
+            self.topic_attempts.append(0)
+        return index
+
+    def _slot(self, student_id: int, topic_index: int) -> int:
+        slot = self.slots.get((student_id, topic_index))
+        if slot is None:
+            slot = len(self.ability)
+            # Fill the columns before registering the slot, so a rejected ID leaves no half-made entry
+            self.slot_student.append(student_id)
+            self.slot_topic.append(topic_index)
+            self.ability.append(0.0)
+            self.attempts.append(0)
+            self.updated_at.append(0.0)
+            self.slots[(student_id, topic_index)] = slot
+            self.student_slots.setdefault(student_id, []).append(slot)
+        return slot
+
+    def _mastery(self, slot: int) -> float:
+        return 1.0 / (1.0 + math.exp(self.difficulty[self.slot_topic[slot]] - self.ability[slot]))
+
+    @staticmethod
+    def level_for(mastery: float) -> str:
+        if mastery >= MASTERY_ADVANCED_AT:
+            return "advanced"
+        if mastery >= MASTERY_INTERMEDIATE_AT:
+            return "intermediate"
+        return "beginner"
+
+    def _describe(self, slot: int) -> Dict[str, Any]:
+        mastery = self._mastery(slot)
+        return {
+            "topic": self.topic_names[self.slot_topic[slot]],
+            "mastery": round(mastery, 3),
+            "attempts": self.attempts[slot],
+            "recommended_level": self.level_for(mastery),
+            "updated_at": self.updated_at[slot],
+        }
+
+    def record(self, student_id: int, topic: str, score: float) -> Dict[str, Any]:
+        """Update mastery from a quiz score in [0, 1] and return the new estimate"""
+        topic_index = self._topic(_normalize_text(topic))
+        slot = self._slot(student_id, topic_index)
+        surprise = score - self._mastery(slot)
+        # Early results move the estimate a lot, later ones refine it
+        k = max(MASTERY_K_MIN, MASTERY_K_FACTOR / (1 + 0.2 * self.attempts[slot]))
+        self.ability[slot] += k * surprise
+        # Topic difficulty is shared by every student, so it moves slowly
+        self.difficulty[topic_index] -= MASTERY_K_MIN * surprise / (1 + 0.01 * self.topic_attempts[topic_index])
+        self.attempts[slot] += 1
+        self.topic_attempts[topic_index] += 1
+        self.updated_at[slot] = time.time()
+        self.updates += 1
+        if self._db is not None:
+            with self._lock:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO mastery (student_id, topic, ability, attempts, updated_at) VALUES (?, ?, ?, ?, ?)",
+                    (student_id, self.topic_names[topic_index], self.ability[slot], self.attempts[slot], self.updated_at[slot])
+                )
+                self._db.execute(
+                    "INSERT OR REPLACE INTO topic_difficulty (topic, difficulty, attempts) VALUES (?, ?, ?)",
+                    (self.topic_names[topic_index], self.difficulty[topic_index], self.topic_attempts[topic_index])
+                )
+        return self._describe(slot)
+
+    def recommended_level(self, student_id: int, topic: str) -> Optional[str]:
+        """Challenge level for a student's next lesson on topic, or None before any quiz result"""
+        topic_index = self.topic_index.get(_normalize_text(topic))
+        slot = self.slots.get((student_id, topic_index))
+        if slot is None or self.attempts[slot] == 0:
+            return None
+        return self.level_for(self._mastery(slot))
+
+    def student(self, student_id: int) -> List[Dict[str, Any]]:
+        return [self._describe(slot) for slot in self.student_slots.get(student_id, [])]
+
+    def stats(self) -> Dict[str, Any]:
+        arrays = (
+            self.slot_student, self.slot_topic, self.ability, self.attempts, self.updated_at,
+            self.difficulty, self.topic_attempts
+        )
+        return {
+            "path": self.path or None,
+            "students": len(self.student_slots),
+            "topics": len(self.topic_names),
+            "entries": len(self.ability),
+            "array_bytes": sum(a.itemsize * len(a) for a in arrays),
+            "updates": self.updates,
+            "lessons_adapted": self.adapted,
+            "topic_difficulty": {
+                name: round(self.difficulty[index], 3) for name, index in self.topic_index.items()
+            },
+        }
+
+mastery_store = DeferredStore("mastery store", lambda: MasteryModel(MASTERY_STORE_PATH))
+
+def get_mastery_model() -> MasteryModel:
+    return mastery_store.get()
+
+@app.post("/api/students/{student_id}/quiz-results")
+async def submit_quiz_result(result: QuizResultRequest, student_id: int = Path(ge=0, le=MAX_ID)):
+    """Record a quiz result and return the student's updated mastery of the topic"""
+    if result.score is not None:
+        if not 0 <= result.score <= 100:
+            raise HTTPException(status_code=422, detail="score must be between 0 and 100")
+        score = result.score / 100
+    elif result.correct is not None and result.total:
+        if not 0 <= result.correct <= result.total:
+            raise HTTPException(status_code=422, detail="correct must be between 0 and total")
+        score = result.correct / result.total
+    else:
+        raise HTTPException(status_code=422, detail="Provide score, or correct and total")
+
+    topic = result.topic
+    if not topic and result.lesson_id is not None:
+        lesson_repository = get_lesson_repository()
+        lesson_data = lesson_repository.get(result.lesson_id) if lesson_repository is not None else None
+        if lesson_data is None:
+            raise HTTPException(status_code=404, detail=f"Lesson {result.lesson_id} not found")
+        topic = lesson_data["topic"]
+    if not topic or not topic.strip():
+        raise HTTPException(status_code=422, detail="Provide topic or lesson_id")
+
+    return {"student_id": student_id, **get_mastery_model().record(student_id, topic, score)}
+
+@app.get("/api/students/{student_id}/mastery")
+async def get_student_mastery(student_id: int = Path(ge=0, le=MAX_ID)):
+    """Get a student's mastery estimate and recommended challenge level per topic"""
+    return {"student_id": student_id, "topics": get_mastery_model().student(student_id)}
+
+@app.get("/admin/mastery")
+async def get_mastery_stats():
+    """Get mastery model size and per-topic difficulty"""
+    return get_mastery_model().stats()
+
+# --- Quiz grading and class analytics ---
+
+SCORE_BUCKETS = [f"{low}-{low + 10}" for low in range(0, 100, 10)]  # The last bucket includes 100
+
+def quiz_option_index(options: List[str], answer: Optional[str]) -> int:
+    """Index of the option an answer names by text or letter; -1 if blank, -2 if it names none"""
+    if answer is None or not answer.strip():
+        return -1
+    normalized = _normalize_text(answer)
+    for index, option in enumerate(options):
+        if _normalize_text(option) == normalized:
+            return index
+    letter = normalized.rstrip(").:")
+    if len(letter) == 1 and 0 <= ord(letter) - ord("a") < len(options):
+        return ord(letter) - ord("a")
+    return -2
+
+def grade_quiz(quiz: List[Dict[str, Any]], answers: List[Optional[str]]) -> List[tuple]:
+    """(choice index, correct) per question; free-text correct answers are compared as text"""
+    graded = []
+    for item, answer in zip(quiz, answers):
+        choice = quiz_option_index(item["options"], answer)
+        correct_choice = quiz_option_index(item["options"], item["correct_answer"])
+        if correct_choice >= 0:
+            graded.append((choice, choice == correct_choice))
+        else:
+            graded.append((choice, _normalize_text(answer) == _normalize_text(item["correct_answer"])))
+    return graded
+
+class QuizResultStore:
+    """
+    Graded quiz submissions held column by column, for vectorized class analytics.
+
+    Each submission appends one row to the per-submission columns and one row per
+    question to the per-answer columns. Analytics view the columns as NumPy arrays
+    without copying and aggregate them with masks and bincounts, so a class
+    dashboard takes a few passes over flat arrays however many students it covers.
+    Rows are also written to SQLite and reloaded at startup.
+    """
+    def __init__(self, path: str = ""):
+        self.path = path
+        self.graded = 0
+        self.class_index: Dict[str, int] = {}
+        self.class_names: List[str] = []
+        self.topic_index: Dict[str, int] = {}
+        self.topic_names: List[str] = []
+        # Per submission
+        self.sub_student = array("q")
+        self.sub_class = array("I")
+        self.sub_lesson = array("q")
+        self.sub_topic = array("I")
+        self.sub_correct = array("H")
+        self.sub_total = array("H")
+        self.sub_time = array("d")
+        # Per answer
+        self.ans_submission = array("I")
+        self.ans_question = array("H")
+        self.ans_choice = array("h")  # Option index, -1 blank, -2 not one of the options
+        self.ans_correct = array("B")
+        self._lock = threading.Lock()
+        self._db = None
+        if path:
+            self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=5)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS quiz_submissions (id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                "student_id INTEGER NOT NULL, class_id TEXT NOT NULL, lesson_id INTEGER NOT NULL, topic TEXT NOT NULL, "
+                "correct INTEGER NOT NULL, total INTEGER NOT NULL, submitted_at REAL NOT NULL, answers BLOB NOT NULL)"
+            )
+            self._load()
+
+    def _load(self):
+        for student_id, class_id, lesson_id, topic, correct, total, submitted_at, answers in self._db.execute(
+            "SELECT student_id, class_id, lesson_id, topic, correct, total, submitted_at, answers "
+            "FROM quiz_submissions ORDER BY id"
+        ):
+            # Rows written before choices widened to two bytes hold one byte per choice
+            choice_bytes = len(answers) - total
+            choices = array("b" if choice_bytes == total else "h", answers[:choice_bytes])
+            self._append(student_id, class_id, lesson_id, topic, submitted_at, list(zip(choices, answers[choice_bytes:])))
+
+    def _intern(self, index: Dict[str, int], names: List[str], name: str) -> int:
+        position = index.get(name)
+        if position is None:
+            position = index[name] = len(names)
+            names.append(name)
+        return position
+
+    def _append(
+        self, student_id: int, class_id: str, lesson_id: int, topic: str, submitted_at: float, graded: List[tuple]
+    ) -> int:
+        submission = len(self.sub_student)
+        self.sub_student.append(student_id)
+        self.sub_class.append(self._intern(self.class_index, self.class_names, class_id))
+        self.sub_lesson.append(lesson_id)
+        self.sub_topic.append(self._intern(self.topic_index, self.topic_names, topic))
+        self.sub_correct.append(sum(1 for _, correct in graded if correct))
+        self.sub_total.append(len(graded))
+        self.sub_time.append(submitted_at)
+        for question, (choice, correct) in enumerate(graded):
+            self.ans_submission.append(submission)
+            self.ans_question.append(question)
+            self.ans_choice.append(choice)
+            self.ans_correct.append(int(correct))
+        return submission
+
+    def record(self, student_id: int, class_id: str, lesson_id: int, topic: str, graded: List[tuple]):
+        """Store one graded submission"""
+        topic = _normalize_text(topic)
+        submitted_at = time.time()
+        with self._lock:
+            self._append(student_id, class_id, lesson_id, topic, submitted_at, graded)
+            if self._db is not None:
+                # Answers pack as two-byte choices followed by correctness bytes
+                answers = array("h", [choice for choice, _ in graded]).tobytes() + bytes(int(c) for _, c in graded)
+                self._db.execute(
+                    "INSERT INTO quiz_submissions (student_id, class_id, lesson_id, topic, correct, total, submitted_at, "
+                    "answers) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                    (student_id, class_id, lesson_id, topic, sum(1 for _, c in graded if c), len(graded), submitted_at, answers)
+                )
+        self.graded += 1
+
+    @staticmethod
+    def _score_summary(scores: "np.ndarray", students: "np.ndarray") -> Dict[str, Any]:
+        counts, _ = np.histogram(scores, bins=10, range=(0, 100))
+        return {
+            "submissions": int(scores.size),
+            "students": int(np.unique(students).size),
+            "mean_score": round(float(scores.mean()), 1),
+            "median_score": round(float(np.median(scores)), 1),
+            "score_distribution": dict(zip(SCORE_BUCKETS, counts.tolist())),
+        }
+
+    @staticmethod
+    def _item_analysis(questions: "np.ndarray", choices: "np.ndarray", correct: "np.ndarray", scores: "np.ndarray"):
+        """Per-question difficulty, discrimination and option counts for one lesson's answers"""
+        n_questions = int(questions.max()) + 1
+        responses = np.bincount(questions, minlength=n_questions).astype(np.float64)
+        p_correct = np.bincount(questions, weights=correct, minlength=n_questions) / responses
+        # Point-biserial correlation of each item with the submission score
+        mean_score = np.bincount(questions, weights=scores, minlength=n_questions) / responses
+        cov = np.bincount(questions, weights=correct * scores, minlength=n_questions) / responses - p_correct * mean_score
+        score_var = np.bincount(questions, weights=scores * scores, minlength=n_questions) / responses - mean_score ** 2
+        denominator = np.sqrt(p_correct * (1 - p_correct) * np.clip(score_var, 0, None))
+        with np.errstate(divide="ignore", invalid="ignore"):
+            discrimination = np.where(denominator > 1e-9, cov / denominator, np.nan)
+        # Columns: not one of the options, blank, then each option
+        width = int(choices.max()) + 3
+        option_counts = np.bincount(
+            questions.astype(np.int64) * width + choices + 2, minlength=n_questions * width
+        ).reshape(n_questions, width)
+        return responses, p_correct, discrimination, option_counts
+
+    def class_analytics(
+        self, class_id: str, topic: Optional[str] = None, lesson_id: Optional[int] = None, lesson_lookup=None
+    ) -> Optional[Dict[str, Any]]:
+        """Score distributions per topic and item analysis per lesson for one class, or None if unknown"""
+        with self._lock:
+            class_position = self.class_index.get(class_id)
+            if class_position is None:
+                return None
+            sub_class = np.frombuffer(self.sub_class, dtype=self.sub_class.typecode)
+            sub_topic = np.frombuffer(self.sub_topic, dtype=self.sub_topic.typecode)
+            sub_lesson = np.frombuffer(self.sub_lesson, dtype=self.sub_lesson.typecode)
+            sub_student = np.frombuffer(self.sub_student, dtype=self.sub_student.typecode)
+            scores = 100.0 * np.frombuffer(self.sub_correct, dtype=self.sub_correct.typecode) / np.maximum(
+                np.frombuffer(self.sub_total, dtype=self.sub_total.typecode), 1
+            )
+            mask = sub_class == class_position
+            if topic is not None:
+                topic_position = self.topic_index.get(_normalize_text(topic))
+                mask &= (sub_topic == topic_position) if topic_position is not None else False
+            if lesson_id is not None:
+                mask &= sub_lesson == lesson_id
+            rows = np.flatnonzero(mask)
+            result: Dict[str, Any] = {"class_id": class_id}
+            if rows.size == 0:
+                return {**result, "submissions": 0, "students": 0, "topics": [], "lessons": []}
+            result.update(self._score_summary(scores[rows], sub_student[rows]))
+
+            row_topics = sub_topic[rows]
+            result["topics"] = sorted((
+                {"topic": self.topic_names[topic_position], **self._score_summary(
+                    scores[rows[row_topics == topic_position]], sub_student[rows[row_topics == topic_position]]
+                )}
+                for topic_position in np.unique(row_topics).tolist()
+            ), key=lambda summary: summary["topic"])
+
+            ans_submission = np.frombuffer(self.ans_submission, dtype=self.ans_submission.typecode)
+            answer_rows = np.flatnonzero(mask[ans_submission])
+            answer_submissions = ans_submission[answer_rows]
+            answer_lessons = sub_lesson[answer_submissions]
+            questions = np.frombuffer(self.ans_question, dtype=self.ans_question.typecode)[answer_rows]
+            choices = np.frombuffer(self.ans_choice, dtype=self.ans_choice.typecode)[answer_rows].astype(np.int64)
+            correct = np.frombuffer(self.ans_correct, dtype=self.ans_correct.typecode)[answer_rows].astype(np.float64)
+            answer_scores = scores[answer_submissions] / 100
+            lessons = []
+            for lesson in np.unique(answer_lessons).tolist():
+                selected = answer_lessons == lesson
+                analysis = self._item_analysis(
+                    questions[selected], choices[selected], correct[selected], answer_scores[selected]
+                )
+                lesson_rows = rows[sub_lesson[rows] == lesson]
+                lessons.append((lesson, self.topic_names[sub_topic[lesson_rows[0]]], int(lesson_rows.size), analysis))
+
+        result["lessons"] = [
+            self._describe_lesson(lesson, lesson_topic, submissions, analysis, lesson_lookup)
+            for lesson, lesson_topic, submissions, analysis in lessons
+        ]
+        return result
+
+    @staticmethod
+    def _describe_lesson(lesson_id: int, topic: str, submissions: int, analysis: tuple, lesson_lookup) -> Dict[str, Any]:
+        responses, p_correct, discrimination, option_counts = analysis
+        lesson_data = lesson_lookup(lesson_id) if lesson_lookup is not None else None
+        quiz = lesson_data.get("practiceQuiz", []) if lesson_data else []
+        items = []
+        for question in range(len(responses)):
+            item = quiz[question] if question < len(quiz) else None
+            options = item["options"] if item else []
+            counts = option_counts[question]
+            items.append({
+                "question": question,
+                "text": item["question"] if item else None,
+                "correct_answer": item["correct_answer"] if item else None,
+                "responses": int(responses[question]),
+                # Share answered correctly; lower means harder
+                "difficulty": round(float(p_correct[question]), 3),
+                "discrimination": None if np.isnan(discrimination[question]) else round(float(discrimination[question]), 3),
+                "options": {
+                    (options[index] if index < len(options) else f"option {index}"): int(count)
+                    for index, count in enumerate(counts[2:].tolist())
+                },
+                "blank": int(counts[1]),
+                "other": int(counts[0]),
+            })
+        return {"lesson_id": lesson_id, "topic": topic, "submissions": submissions, "items": items}
+
+    def stats(self) -> Dict[str, Any]:
+        arrays = (
+            self.sub_student, self.sub_class, self.sub_lesson, self.sub_topic, self.sub_correct, self.sub_total,
+            self.sub_time, self.ans_submission, self.ans_question, self.ans_choice, self.ans_correct
+        )
+        return {
+            "path": self.path or None,
+            "submissions": len(self.sub_student),
+            "answers": len(self.ans_submission),
+            "classes": len(self.class_names),
+            "topics": len(self.topic_names),
+            "array_bytes": sum(a.itemsize * len(a) for a in arrays),
+            "graded": self.graded,
+        }
+
+quiz_store = DeferredStore("quiz store", lambda: QuizResultStore(QUIZ_STORE_PATH))
+
+def get_quiz_results() -> QuizResultStore:
+    return quiz_store.get()
+
+@app.post("/api/students/{student_id}/quiz-submissions")
+async def submit_quiz_answers(submission: QuizSubmissionRequest, student_id: int = Path(ge=0, le=MAX_ID)):
+    """Grade a student's answers to a stored lesson's practice quiz and update their mastery of its topic"""
+    lesson_data = _require_lesson_repository().get(submission.lesson_id)
+    if lesson_data is None:
+        raise HTTPException(status_code=404, detail=f"Lesson {submission.lesson_id} not found")
+    quiz = lesson_data.get("practiceQuiz") or []
+    if not quiz:
+        raise HTTPException(status_code=422, detail=f"Lesson {submission.lesson_id} has no practice quiz")
+    if len(submission.answers) != len(quiz):
+        raise HTTPException(status_code=422, detail=f"Expected {len(quiz)} answers, got {len(submission.answers)}")
+
+    graded = grade_quiz(quiz, submission.answers)
+    correct = sum(1 for _, is_correct in graded if is_correct)
+    get_quiz_results().record(student_id, submission.class_id, submission.lesson_id, lesson_data["topic"], graded)
+    return {
+        "student_id": student_id,
+        "lesson_id": submission.lesson_id,
+        "topic": lesson_data["topic"],
+        "score": round(100 * correct / len(quiz), 1),
+        "correct": correct,
+        "total": len(quiz),
+        "results": [
+            {"question": index, "answer": answer, "correct": is_correct, "correct_answer": item["correct_answer"]}
+            for index, (item, answer, (_, is_correct)) in enumerate(zip(quiz, submission.answers, graded))
+        ],
+        "mastery": get_mastery_model().record(student_id, lesson_data["topic"], correct / len(quiz)),
+    }
+
+@app.get("/api/classes/{class_id}/quiz-analytics")
+async def get_class_quiz_analytics(
+    class_id: str, topic: Optional[str] = None, lesson_id: Optional[int] = Query(default=None, ge=0, le=MAX_ID)
+):
+    """Score distributions per topic and item difficulty, discrimination and distractors per lesson for a class"""
+    lesson_repository = get_lesson_repository()
+    analytics = get_quiz_results().class_analytics(
+        class_id, topic, lesson_id, lesson_repository.get if lesson_repository is not None else None
+    )
+    if analytics is None:
+        raise HTTPException(status_code=404, detail=f"No quiz submissions for class '{class_id}'")
+    return analytics
+
+@app.get("/admin/quiz-results")
+async def get_quiz_result_stats():
+    """Get quiz result store size"""
+    return get_quiz_results().stats()
+
+# --- Incremental lesson parsing ---
+
+class LessonStreamError(ValueError):
+    """Streamed lesson output is structurally invalid and cannot become a valid lesson"""
+
+# Validators for each top-level lesson field, built once
+LESSON_FIELD_ADAPTERS = {name: TypeAdapter(field.annotation) for name, field in GeneratedLesson.model_fields.items()}
+LESSON_REQUIRED_KEYS = list(GeneratedLesson.model_fields)
+
+class LessonStreamParser:
+    """
+    Incremental parser for a lesson JSON object arriving in chunks.
+
+    Tracks string/escape state and container nesting across chunks. Each top-level
+    field is decoded and validated against the LessonResponse schema as soon as its
+    value closes, and each lessonContent item as soon as its object closes, so
+    malformed output is detected long before the model finishes generating.
+    finish() returns the lesson built from the validated fields.
+    """
+    MAX_PREAMBLE = 64  # Tolerates e.g. a leading ```json fence
+
+    def __init__(self, on_event=None):
+        self.on_event = on_event
+        self.buffer = ""
+        self.pos = 0
+        self.started = False
+        self.done = False
+        self.stack: List[tuple] = []  # (open char, offset)
+        self.in_string = False
+        self.escape = False
+        self.string_start = -1
+        self.expect_key = False
+        self.key: Optional[str] = None
+        self.value_start: Optional[int] = None
+        self.fields: Dict[str, Any] = {}
+        self.content_items = 0
+
+    def feed(self, chunk: str):
+        self.buffer += chunk
+        buf = self.buffer
+        i = self.pos
+        n = len(buf)
+        while i < n and not self.done:
+            c = buf[i]
+            if not self.started:
+                if c == "{":
+                    self.started = True
+                    self.stack.append((c, i))
+                    self.expect_key = True
+                elif i >= self.MAX_PREAMBLE:
+                    raise LessonStreamError("Response does not start with a JSON object")
+            elif self.in_string:
+                if self.escape:
+                    self.escape = False
+                elif c == "\\":
+                    self.escape = True
+                elif c == '"':
+                    self.in_string = False
+                    if len(self.stack) == 1 and self.expect_key:
+                        self.key = json.loads(buf[self.string_start:i + 1])
+                        self.expect_key = False
+            elif (
+                len(self.stack) == 2 and self.key == "lessonContent" and self.stack[1][0] == "["
+                and c not in "{]," and not c.isspace()
+            ):
+                raise LessonStreamError(f"lessonContent item {self.content_items} is not an object")
+            elif c == '"':
+                if len(self.stack) == 1 and not self.expect_key and self.value_start is None:
+                    raise LessonStreamError(f"Expected ':' after key '{self.key}'")
+                self.in_string = True
+                self.string_start = i
+            elif c in "{[":
+                if len(self.stack) == 1 and self.value_start is None:
+                    raise LessonStreamError(f"Unexpected '{c}' at offset {i}")
+                self.stack.append((c, i))
+            elif c in "}]":
+                if len(self.stack) == 1 and c == "}":
+                    self._complete_field(i)
+                    self.stack.pop()
+                    self.done = True
+                else:
+                    open_char, start = self.stack.pop()
+                    if (open_char == "{") != (c == "}"):
+                        raise LessonStreamError(f"Mismatched '{c}' at offset {i}")
+                    if c == "}" and len(self.stack) == 2 and self.key == "lessonContent" and self.stack[1][0] == "[":
+                        self._complete_content_item(buf[start:i + 1])
+            elif len(self.stack) == 1:
+                if c == ",":
+                    self._complete_field(i)
+                    self.expect_key = True
+                elif c == ":":
+                    if self.key is None or self.value_start is not None:
+                        raise LessonStreamError(f"Unexpected ':' at offset {i}")
+                    self.value_start = i + 1
+                elif not c.isspace() and self.value_start is None:
+                    raise LessonStreamError(f"Unexpected '{c}' at offset {i}")
+            i += 1
+        self.pos = i
+
+    def _emit(self, event: str, data: Dict[str, Any]):
+        if self.on_event is not None:
+            self.on_event(event, data)
+
+    def _complete_field(self, end: int):
+        if self.key is None:
+            if self.fields or self.expect_key is False:
+                raise LessonStreamError(f"Unexpected delimiter at offset {end}")
+            return  # Empty object
+        if self.value_start is None:
+            raise LessonStreamError(f"Missing value for key '{self.key}'")
+        try:
+            value = json.loads(self.buffer[self.value_start:end])
+        except json.JSONDecodeError as e:
+            raise LessonStreamError(f"Invalid value for '{self.key}': {e.msg}")
+        adapter = LESSON_FIELD_ADAPTERS.get(self.key)
+        if adapter is not None:  # Unknown keys are dropped, as GeneratedLesson ignores them
+            try:
+                self.fields[self.key] = adapter.validate_python(value)
+            except ValidationError as e:
+                raise LessonStreamError(f"Invalid '{self.key}': {e.errors()[0]['msg']}")
+        if self.key != "lessonContent":
+            self._emit("field", {"name": self.key, "value": value})
+        self.key = None
+        self.value_start = None
+
+    def _complete_content_item(self, text: str):
+        try:
+            item = json.loads(text)
+        except ValueError as e:
+            raise LessonStreamError(f"Invalid lessonContent item {self.content_items}: {e}")
+        try:
+            LessonContentItem.model_validate(item)
+        except ValidationError as e:
+            raise LessonStreamError(f"Invalid lessonContent item {self.content_items}: {e.errors()[0]['msg']}")
+        self._emit("content_item", {"index": self.content_items, "item": item})
+        self.content_items += 1
+
+    def finish(self) -> GeneratedLesson:
+        """Return the parsed lesson once the stream has ended"""
+        if not self.done:
+            raise LessonStreamError("Response ended before the lesson JSON was complete")
+        missing_keys = [key for key in LESSON_REQUIRED_KEYS if key not in self.fields]
+        if missing_keys:
+            raise LessonStreamError(f"AI response missing required keys: {', '.join(missing_keys)}")
+        # Every field already passed its validator
+        return GeneratedLesson.model_construct(**self.fields)
+
+def replay_lesson_events(lesson_data: Dict[str, Any], on_event):
+    """Emit the events a streamed generation would have produced for an already complete lesson"""
+    for name, value in lesson_data.items():
+        if name == "lesson_id":
+            continue  # Sent with the complete lesson in the final event
+        if name == "lessonContent":
+            for index, item in enumerate(value):
+                on_event("content_item", {"index": index, "item": item})
+        else:
+            on_event("field", {"name": name, "value": value})
+
+async def stream_lesson_json(model, prompt: str, on_event=None) -> GeneratedLesson:
+    """
+    Stream a lesson from the model and parse it incrementally.
+
+    A structural or schema error aborts the stream immediately and the generation is
+    retried up to LESSON_STREAM_MAX_RETRIES times; a `retry` event tells streaming
+    clients to discard what they received from the aborted attempt.
+    """
+    last_error: Optional[LessonStreamError] = None
+    for attempt in range(LESSON_STREAM_MAX_RETRIES + 1):
+        if attempt and on_event is not None:
+            on_event("retry", {"attempt": attempt, "reason": str(last_error)})
+        parser = LessonStreamParser(on_event)
+        parse_seconds = 0.0
+        chunks = stream_content_async(model, prompt, priority=PRIORITY_LESSON)
+        try:
+            async for text in chunks:
+                parse_started = time.perf_counter()
+                parser.feed(text)
+                parse_seconds += time.perf_counter() - parse_started
+            return parser.finish()
+        except LessonStreamError as e:
+            last_error = e
+            lesson_stream_aborts.inc("final" if attempt == LESSON_STREAM_MAX_RETRIES else "retried")
+            logger.warning(
+                "Aborted malformed lesson stream after %s chars (attempt %s): %s", len(parser.buffer), attempt + 1, e
+            )
+        finally:
+            # Closing the generator cancels the upstream stream and frees its admission slot
+            await chunks.aclose()
+            stage_duration.observe(parse_seconds, "lesson", "incremental_parse")
+
+    raise HTTPException(
+        status_code=500,
+        detail=f"Failed to parse lesson data from AI response: {str(last_error)}"
+    )
+
+# --- AI Tutor Endpoints ---
+
+@app.post("/generate-lesson", response_model=LessonResponse)
+async def generate_lesson(request: LessonRequest, http_request: Request):
+    """Generate a personalized lesson using Google Gemini based on student's context"""
+    try:
+        logger.info("Received lesson generation request for topic: %s", request.current_topic)
         
-        logger.info("Successfully received response from Gemini API")
-        
-        # Extract raw text from response
-        raw_text = response.text
+        # Generate lesson content using Gemini
+        lesson_data = await generate_lesson_content_gemini(
+            student_id=request.student_id,
+            last_quiz_score=request.last_quiz_score,
+            current_topic=request.current_topic,
+            learning_objectives=request.learning_objectives,
+            subject=request.subject,
+            challenge_level=request.challenge_level,
+            learning_style=request.learning_style,
+            http_request=http_request,
+            use_cache=not request.bypass_cache
+        )
+
+        logger.debug("Successfully prepared lesson response for topic: %s", request.current_topic)
+        lesson = build_lesson_response(lesson_data)
+        # Already validated: serialize directly instead of letting response_model validate it again
+        with StageTimer("lesson", "response_serialize"):
+            return Response(content=json.dumps(lesson), media_type="application/json")
         
-        # Extract and parse JSON from response
+    except Exception as e:
+        logger.error("Error in generate_lesson endpoint: %s: %s", type(e).__name__, e)
+        if isinstance(e, HTTPException):
+            raise  # Re-raise HTTP exceptions as they already have status codes
+        raise HTTPException(status_code=500, detail=f"Error generating lesson: {str(e)}")
+
+def build_lesson_response(lesson_data: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Put the lesson ID first in generated lesson content.
+
+    Lesson data is validated once, when it is generated, before it is stored or
+    cached, so the response is built from it as is.
+    """
+    # Generated lessons carry their repository or content-derived ID; older cache entries may not
+    lesson_id = lesson_data.get("lesson_id")
+    return {"lesson_id": lesson_id if lesson_id is not None else lesson_fingerprint_id(lesson_data), **lesson_data}
+
+@app.post("/generate-lessons/batch")
+async def generate_lessons_batch(batch: BatchLessonRequest):
+    """
+    Generate many lessons at once, streaming results back as NDJSON.
+
+    Identical lesson inputs are generated once and fanned out to every matching
+    item. Each output line is either {"index", "status": "ok", "lesson"} or
+    {"index", "status": "error", "error": {"status_code", "detail"}}, in completion order.
+    """
+    if not batch.lessons:
+        raise HTTPException(status_code=400, detail="Batch must contain at least one lesson request")
+    if len(batch.lessons) > LESSON_BATCH_MAX_ITEMS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Batch too large: {len(batch.lessons)} items (max {LESSON_BATCH_MAX_ITEMS})"
+        )
+
+    # Group items whose adaptive inputs are identical
+    groups: "OrderedDict[str, List[int]]" = OrderedDict()
+    for index, lesson_request in enumerate(batch.lessons):
+        # Resolve each student's mastery-based level first, so a group never shares one student's level
+        if not lesson_request.challenge_level:
+            mastery_model = get_mastery_model()
+            challenge_level = mastery_model.recommended_level(lesson_request.student_id, lesson_request.current_topic)
+            if challenge_level:
+                mastery_model.adapted += 1
+                lesson_request = batch.lessons[index] = lesson_request.model_copy(
+                    update={"challenge_level": challenge_level}
+                )
+        key = lesson_cache_key(
+            lesson_request.current_topic,
+            lesson_request.learning_objectives,
+            lesson_request.subject,
+            lesson_request.challenge_level,
+            lesson_request.learning_style,
+            lesson_request.last_quiz_score
+        )
+        # Keep bypass requests apart so they are not served by a cached sibling
+        groups.setdefault(f"{key}:{lesson_request.bypass_cache}", []).append(index)
+
+    # Clients may lower the fan-out but not raise it past the server limit
+    concurrency = max(1, min(batch.max_concurrency or LESSON_BATCH_CONCURRENCY, LESSON_BATCH_CONCURRENCY))
+    logger.info(
+        "Received batch of %s lesson requests (%s unique, concurrency %s)", len(batch.lessons), len(groups), concurrency
+    )
+    return StreamingResponse(
+        _batch_lesson_stream(batch.lessons, list(groups.values()), concurrency),
+        media_type="application/x-ndjson"
+    )
+
+async def _batch_lesson_stream(lessons: List[LessonRequest], groups: List[List[int]], concurrency: int):
+    """Run one generation per group with bounded concurrency and yield NDJSON lines as each finishes"""
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def run_group(indices: List[int]):
+        lesson_request = lessons[indices[0]]
+        async with semaphore:
+            try:
+                lesson_data = await generate_lesson_content_gemini(
+                    student_id=lesson_request.student_id,
+                    last_quiz_score=lesson_request.last_quiz_score,
+                    current_topic=lesson_request.current_topic,
+                    learning_objectives=lesson_request.learning_objectives,
+                    subject=lesson_request.subject,
+                    challenge_level=lesson_request.challenge_level,
+                    learning_style=lesson_request.learning_style,
+                    use_cache=not lesson_request.bypass_cache
+                )
+                return indices, lesson_data, None
+            except HTTPException as e:
+                return indices, None, {"status_code": e.status_code, "detail": e.detail}
+            except Exception as e:
+                logger.error("Error in batch lesson generation: %s: %s", type(e).__name__, e)
+                return indices, None, {"status_code": 500, "detail": f"Error generating lesson: {str(e)}"}
+
+    tasks = [asyncio.ensure_future(run_group(indices)) for indices in groups]
+    succeeded = failed = 0
+    try:
+        for next_done in asyncio.as_completed(tasks):
+            indices, lesson_data, error = await next_done
+            lesson = build_lesson_response(lesson_data) if error is None else None
+            for index in indices:
+                if error is None:
+                    line = {"index": index, "status": "ok", "lesson": lesson}
+                    succeeded += 1
+                else:
+                    line = {"index": index, "status": "error", "error": error}
+                    failed += 1
+                yield json.dumps(line) + "\n"
+    finally:
+        # Stop outstanding work if the client goes away mid-stream
+        for task in tasks:
+            if not task.done():
+                task.cancel()
+    logger.info("Finished lesson batch: %s succeeded, %s failed", succeeded, failed)
+
+@app.post("/generate-lesson/stream")
+async def generate_lesson_stream(request: LessonRequest):
+    """
+    Generate a lesson and stream it as Server-Sent Events while it is generated.
+
+    Emits a `field` event per top-level lesson field and a `content_item` event per
+    lessonContent item as each one completes, then `done` with the full lesson (or
+    `error`). A `retry` event means earlier events should be discarded.
+    """
+    logger.info("Received streaming lesson request for topic: %s", request.current_topic)
+    return StreamingResponse(
+        _lesson_event_stream(request),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+async def _lesson_event_stream(request: LessonRequest):
+    """Relay parser events from the generation task to the client"""
+    events: asyncio.Queue = asyncio.Queue()
+
+    async def produce():
         try:
-            json_string = extract_json_from_response(raw_text)
-            lesson_data = json.loads(json_string)
-            logger.info("Successfully parsed JSON response")
-        except json.JSONDecodeError as json_e:
-            logger.error(f"JSON parsing error: {str(json_e)}")
-            logger.error(f"Attempted to parse: {json_string[:100]}...")
-            raise HTTPException(
-                status_code=500, 
-                detail=f"Failed to parse lesson data from AI response: {str(json_e)}"
+            lesson_data = await generate_lesson_content_gemini(
+                student_id=request.student_id,
+                last_quiz_score=request.last_quiz_score,
+                current_topic=request.current_topic,
+                learning_objectives=request.learning_objectives,
+                subject=request.subject,
+                challenge_level=request.challenge_level,
+                learning_style=request.learning_style,
+                use_cache=not request.bypass_cache,
+                on_event=lambda event, data: events.put_nowait((event, data))
+            )
+            lesson = build_lesson_response(lesson_data)
+            events.put_nowait(("done", {"lesson": lesson}))
+        except HTTPException as e:
+            events.put_nowait(("error", {"status": e.status_code, "detail": e.detail}))
+        except Exception as e:
+            logger.error("Error streaming lesson: %s: %s", type(e).__name__, e)
+            events.put_nowait(("error", {"status": 500, "detail": f"Error generating lesson: {str(e)}"}))
+
+    task = asyncio.ensure_future(produce())
+    try:
+        while True:
+            event, data = await events.get()
+            yield _sse_event(event, data)
+            if event in ("done", "error"):
+                break
+    finally:
+        if not task.done():
+            task.cancel()
+
+async def generate_lesson_content_gemini(
+    student_id: int,
+    last_quiz_score: Optional[float],
+    current_topic: str,
+    learning_objectives: List[str],
+    subject: Optional[str] = None,
+    challenge_level: Optional[str] = None,
+    learning_style: Optional[str] = None,
+    http_request: Optional[Request] = None,
+    use_cache: bool = True,
+    on_event=None
+) -> Dict[str, Any]:
+    """
+    Generate adaptive lesson content, served from cache or coalesced with identical in-flight requests.
+
+    When on_event is given, lesson fields and content items are reported through it
+    as they are parsed; such requests do not join in-flight calls.
+    """
+    
+    logger.info("Generating lesson for student ID: %s, topic: %s", student_id, current_topic)
+
+    # Without an explicit challenge level, pick one from the student's mastery of the topic
+    if not challenge_level:
+        mastery_model = get_mastery_model()
+        challenge_level = mastery_model.recommended_level(student_id, current_topic)
+        if challenge_level:
+            mastery_model.adapted += 1
+            logger.info("Using mastery-based challenge level '%s' for student ID: %s", challenge_level, student_id)
+
+    # Serve from the lesson cache when the same adaptive inputs were seen before
+    cache_key = lesson_cache_key(
+        current_topic, learning_objectives, subject, challenge_level, learning_style, last_quiz_score
+    )
+    if use_cache:
+        cached_lesson = lesson_cache.get(cache_key)
+        if cached_lesson is not None:
+            logger.info("Lesson cache hit for topic: %s", current_topic)
+            if on_event is not None:
+                replay_lesson_events(cached_lesson, on_event)
+            return cached_lesson
+
+        # Reuse a stored lesson generated earlier for the same inputs
+        lesson_repository = get_lesson_repository()
+        if lesson_repository is not None and LESSON_STORE_REUSE_MAX_AGE_SECONDS > 0:
+            stored_lesson = lesson_repository.latest_for_request(cache_key, LESSON_STORE_REUSE_MAX_AGE_SECONDS)
+            if stored_lesson is not None:
+                logger.info("Reusing stored lesson %s for topic: %s", stored_lesson['lesson_id'], current_topic)
+                lesson_cache.set(cache_key, stored_lesson)
+                if on_event is not None:
+                    replay_lesson_events(stored_lesson, on_event)
+                return stored_lesson
+
+    generate = lambda: _generate_lesson_from_model(
+        cache_key=cache_key,
+        student_id=student_id,
+        last_quiz_score=last_quiz_score,
+        current_topic=current_topic,
+        learning_objectives=learning_objectives,
+        subject=subject,
+        challenge_level=challenge_level,
+        learning_style=learning_style,
+        on_event=on_event
+    )
+    try:
+        if on_event is not None:
+            return await generate()
+        # Identical concurrent requests share one upstream call
+        return await lesson_flights.do(cache_key, generate, http_request=http_request)
+    except CircuitOpenError:
+        stale_lesson = lesson_cache.get_stale(cache_key)
+        if stale_lesson is None:
+            raise
+        logger.warning("AI service unavailable, serving cached lesson for topic: %s", current_topic)
+        circuit_fallbacks.inc("lesson")
+        if on_event is not None:
+            replay_lesson_events(stale_lesson, on_event)
+        return stale_lesson
+
+async def _generate_lesson_from_model(
+    cache_key: str,
+    student_id: int,
+    last_quiz_score: Optional[float],
+    current_topic: str,
+    learning_objectives: List[str],
+    subject: Optional[str] = None,
+    challenge_level: Optional[str] = None,
+    learning_style: Optional[str] = None,
+    on_event=None
+) -> Dict[str, Any]:
+    """Generate adaptive lesson content using Google Gemini"""
+    prompt_started = time.perf_counter()
+    
+    # Determine adaptive strategy based on challenge level and score
+    if challenge_level:
+        if challenge_level.lower() == 'advanced':
+            adaptive_instruction = (
+                f"Generate an advanced-level lesson on the topic '{current_topic}'. "
+                f"Include more complex concepts, challenging examples, and thought-provoking questions. "
+                f"The lesson should be suitable for students who already have a good foundation in this subject."
+            )
+            difficulty_level = "advanced"
+        elif challenge_level.lower() == 'intermediate':
+            adaptive_instruction = (
+                f"Generate an intermediate-level lesson on the topic '{current_topic}'. "
+                f"Balance foundational concepts with more challenging applications. "
+                f"The content should be appropriate for students who have some familiarity with the basics."
+            )
+            difficulty_level = "intermediate"
+        else:  # default to beginner if not specified or unknown value
+            adaptive_instruction = (
+                f"Generate a beginner-level lesson on the topic '{current_topic}'. "
+                f"Focus on foundational concepts with clear explanations and simple examples."
+            )
+            difficulty_level = "beginner"
+    # Fall back to score-based adaptation if no challenge level provided
+    elif last_quiz_score is None:
+        adaptive_instruction = f"Generate an introductory lesson on the topic '{current_topic}' suitable for a beginner."
+        difficulty_level = "beginner"
+    elif last_quiz_score > 80:
+        adaptive_instruction = (
+            f"The student scored {last_quiz_score}% on the last quiz for a related topic. "
+            f"Generate a slightly more challenging lesson building upon '{current_topic}' or introducing the next logical topic. "
+            f"Aim for an 'intermediate' or 'advanced' difficulty."
+        )
+        difficulty_level = "intermediate to advanced"
+    else:  # last_quiz_score <= 80
+        adaptive_instruction = (
+            f"The student scored {last_quiz_score}% on the last quiz for '{current_topic}'. "
+            f"Generate a lesson reinforcing '{current_topic}' at a similar or slightly easier difficulty. "
+            f"Focus on clarity and provide foundational examples. Aim for a 'beginner' or 'easy intermediate' difficulty."
+        )
+        difficulty_level = "beginner to easy intermediate"
+    
+    logger.debug("Adapting lesson difficulty to: %s", difficulty_level)
+
+    # Define learning style adaptation if provided
+    learning_style_instruction = ""
+    if learning_style:
+        if learning_style.lower() == 'visual':
+            learning_style_instruction = (
+                "The student is a visual learner. Include visual descriptions, "
+                "diagrams, charts, and image suggestions. Use spatial organization "
+                "and visual patterns in explanations."
+            )
+        elif learning_style.lower() == 'auditory':
+            learning_style_instruction = (
+                "The student is an auditory learner. Use rhythmic patterns, "
+                "spoken word examples, and discussion-based activities. "
+                "Include suggestions for speaking concepts aloud."
+            )
+        elif learning_style.lower() == 'kinesthetic':
+            learning_style_instruction = (
+                "The student is a kinesthetic learner. Incorporate hands-on activities, "
+                "physical movements, and tactile examples. Suggest ways to physically "
+                "engage with the material."
             )
 
-        # Basic validation of response structure
-        required_keys = ["lessonTitle", "topic", "learningObjectives", "difficultyLevel", "lessonContent", "practiceQuiz"]
-        missing_keys = [key for key in required_keys if key not in lesson_data]
-        
-        if missing_keys:
-            error_msg = f"AI response missing required keys: {', '.join(missing_keys)}"
-            logger.error(error_msg)
-            raise HTTPException(status_code=500, detail=error_msg)
-            
-        logger.info(f"Successfully generated lesson: '{lesson_data['lessonTitle']}'")
-        return lesson_data
+    # Add subject context if provided
+    subject_context = f"This lesson is part of the {subject} curriculum. " if subject else ""
 
-    except genai.types.api_errors.ApiError as api_e:
-        # Handle specific Gemini API errors
-        error_message = str(api_e)
-        error_type = type(api_e).__name__
-        logger.error(f"Gemini API error: {error_type} - {error_message}")
+    objectives = clip_items("lesson", "learning_objectives", learning_objectives)
+    prompt = LESSON_PROMPT.render_within_budget("lesson", LESSON_INPUT_TOKEN_BUDGET, dict(
+        current_topic=clip_input("lesson", "current_topic", current_topic),
+        subject=clip_input("lesson", "subject", subject) if subject else 'Not specified',
+        learning_objectives=', '.join(objectives) if objectives else 'None provided, please infer.',
+        last_quiz_score=f'{last_quiz_score}%' if last_quiz_score is not None else 'N/A (first lesson on topic)',
+        challenge_level=challenge_level if challenge_level else 'Not specified',
+        learning_style=learning_style if learning_style else 'Not specified',
+        subject_context=subject_context,
+        adaptive_instruction=adaptive_instruction,
+        learning_style_instruction=learning_style_instruction,
+        difficulty_level=difficulty_level
+    ), elastic=[("learning_objectives", clip_text), ("learning_style_instruction", clip_text)])
+    stage_duration.observe(time.perf_counter() - prompt_started, "lesson", "prompt_build")
+
+    try:
+        model = LESSON_PROMPT.get_model(LESSON_GENERATION_CONFIG)
         
-        if "rate limit" in error_message.lower():
-            logger.error("Rate limit exceeded")
-            raise HTTPException(status_code=429, detail="AI service rate limit exceeded")
-        elif "invalid request" in error_message.lower():
-            logger.error("Invalid request to Gemini API")
-            raise HTTPException(status_code=400, detail=f"Invalid request to AI service: {error_message}")
-        elif "authentication" in error_message.lower() or "unauthorized" in error_message.lower():
-            logger.error("Authentication error with Gemini API")
-            raise HTTPException(status_code=401, detail="AI service authentication failed")
+        logger.debug("Sending request to Gemini API for lesson generation")
+        if LESSON_STREAM_PARSE or on_event is not None:
+            # Validate fields as they stream in so malformed output fails fast
+            with StageTimer("lesson", "model_call"):
+                lesson = await stream_lesson_json(model, prompt, on_event)
         else:
-            # Generic API error
-            raise HTTPException(status_code=502, detail=f"AI service error: {error_type}")
+            lesson = await _generate_lesson_in_one_call(model, prompt)
+
+        # Only validated lessons are stored and cached; responses reuse them as they are
+        lesson_data = lesson.model_dump()
+        logger.info("Successfully generated lesson: '%s'", lesson.lessonTitle)
+        remember_lesson(cache_key, lesson_data, current_topic, subject, challenge_level, learning_style)
+        return lesson_data
+
+    except HTTPException:
+        raise  # Already mapped to a status code (API errors, timeouts, validation)
     except Exception as e:
         # Catch-all for any other unexpected errors
         error_type = type(e).__name__
         error_message = str(e)
-        logger.error(f"Unexpected error generating lesson content: {error_type}: {error_message}")
+        logger.error("Unexpected error generating lesson content: %s: %s", error_type, error_message)
         logger.exception("Full exception details:")
         raise HTTPException(
             status_code=502, 
             detail=f"AI service error: {error_type} - {error_message}"
         )
 
+async def _generate_lesson_in_one_call(model, prompt: str) -> GeneratedLesson:
+    """Generate a lesson without streaming, then parse and validate the complete response"""
+    with StageTimer("lesson", "model_call"):
+        response = await generate_content_async(
+            model,
+            prompt,
+            priority=PRIORITY_LESSON
+        )
+
+    logger.debug("Successfully received response from Gemini API")
+
+    # Extract raw text from response
+    raw_text = response.text
+
+    # Extract JSON, then parse and validate it against the schema in a single pass
+    with StageTimer("lesson", "json_extract"):
+        json_string = extract_json_from_response(raw_text)
+    try:
+        with StageTimer("lesson", "json_parse"):
+            lesson = GeneratedLesson.model_validate_json(json_string)
+        logger.debug("Successfully parsed JSON response")
+    except ValidationError as validation_e:
+        errors = validation_e.errors()
+        missing_keys = [str(error["loc"][0]) for error in errors if error["type"] == "missing" and len(error["loc"]) == 1]
+        if missing_keys:
+            error_msg = f"AI response missing required keys: {', '.join(missing_keys)}"
+        elif errors[0]["type"] == "json_invalid":
+            logger.debug("Attempted to parse: %s...", json_string[:100])
+            error_msg = f"Failed to parse lesson data from AI response: {errors[0]['msg']}"
+        else:
+            location = ".".join(str(part) for part in errors[0]["loc"])
+            error_msg = f"AI response has invalid lesson data at '{location}': {errors[0]['msg']}"
+        logger.error(error_msg)
+        raise HTTPException(status_code=500, detail=error_msg)
+    return lesson
+
 # --- Story Generator Endpoints ---
 
 @app.post("/api/story/generate", response_model=StoryStarterResponse)
-async def generate_story_starters(request: StoryRequest):
+async def generate_story_starters(request: StoryRequest, http_request: Request):
     """
     Generate creative, age-appropriate story starters for early childhood educators
     using Google's Gemini AI.
     """
     try:
-        logger.info(f"Received story starter request with theme: '{request.theme}'")
+        logger.info("Received story starter request (category: %s)", request.category)
+
+        # Requests without custom fields are served from the pre-generated pool
+        personalized = _normalize_text(request.theme) or _normalize_text(request.starting_phrase) \
+            or any(_normalize_text(c) for c in request.character_ideas or [])
+        pooled = STORY_POOL_ENABLED and not personalized
+        if pooled:
+            client_id = story_client_id(http_request)
+            pooled_starters = story_pool.take(request.age_group, request.category, client_id)
+            if pooled_starters is not None:
+                return StoryStarterResponse(storyStarters=pooled_starters)
         
         # Generate story starters
         story_starters = await generate_story_starters_with_gemini(
@@ -444,14 +3884,17 @@ async def generate_story_starters(request: StoryRequest):
             character_ideas=request.character_ideas,
             starting_phrase=request.starting_phrase,
             age_group=request.age_group,
-            category=request.category
+            category=request.category,
+            http_request=http_request
         )
+        if pooled:
+            story_pool.mark_seen(request.age_group, request.category, client_id, story_starters)
         
         # Return response
         return StoryStarterResponse(storyStarters=story_starters)
     
     except Exception as e:
-        logger.error(f"Error generating story starters: {type(e).__name__}: {str(e)}")
+        logger.error("Error generating story starters: %s: %s", type(e).__name__, e)
         if isinstance(e, HTTPException):
             raise
         raise HTTPException(
@@ -459,84 +3902,124 @@ async def generate_story_starters(request: StoryRequest):
             detail=f"Error generating story starters: {str(e)}"
         )
 
+def story_semantic_key(theme: str, character_ideas: List[str], starting_phrase: str) -> str:
+    """Free text a story request is matched on; empty for catalogue requests, which the exact cache covers"""
+    return " ".join(part for part in (theme, " ".join(character_ideas), starting_phrase) if part)
+
+def story_semantic_scope(age_group: Optional[str], category: Optional[str]) -> tuple:
+    return (STORY_PROMPT.id, _normalize_text(age_group), _normalize_text(category))
+
 async def generate_story_starters_with_gemini(
     theme: str = '',
     character_ideas: List[str] = None,
     starting_phrase: str = '',
     age_group: str = '3-6',
-    category: str = 'Fantasy'
+    category: str = 'Fantasy',
+    http_request: Optional[Request] = None,
+    use_cache: bool = True
 ):
     """
-    Generate creative, age-appropriate story starters using Google's Gemini AI.
+    Generate story starters, served from cache or coalesced with identical in-flight requests.
     """
     if character_ideas is None:
         character_ideas = []
-    
+
+    cache_key = story_request_key(theme, character_ideas, starting_phrase, age_group, category)
+    if use_cache:
+        cached_starters = story_cache.get(cache_key)
+        if cached_starters is not None:
+            logger.info("Story starter cache hit for category: %s", category)
+            return cached_starters
+        semantic_key = story_semantic_key(theme, character_ideas, starting_phrase)
+        if semantic_key and story_semantic_cache is not None:
+            similar_starters = story_semantic_cache.get(story_semantic_scope(age_group, category), semantic_key)
+            if similar_starters is not None:
+                logger.info("Story starter near-duplicate cache hit for category: %s", category)
+                return similar_starters
+
+    try:
+        return await story_flights.do(
+            cache_key,
+            lambda: _generate_story_starters_from_model(
+                cache_key=cache_key,
+                theme=theme,
+                character_ideas=character_ideas,
+                starting_phrase=starting_phrase,
+                age_group=age_group,
+                category=category
+            ),
+            http_request=http_request
+        )
+    except CircuitOpenError:
+        # Fall back to this request's last starters, then to the catalogue starters for the age group and category
+        stale_starters = story_cache.get_stale(cache_key)
+        if stale_starters is None:
+            stale_starters = story_cache.get_stale(story_request_key("", [], "", age_group, category))
+        if stale_starters is None:
+            raise
+        logger.warning("AI service unavailable, serving cached story starters for category: %s", category)
+        circuit_fallbacks.inc("story")
+        return stale_starters
+
+async def _generate_story_starters_from_model(
+    cache_key: str,
+    theme: str,
+    character_ideas: List[str],
+    starting_phrase: str,
+    age_group: str,
+    category: str
+):
+    """
+    Generate creative, age-appropriate story starters using Google's Gemini AI.
+    """
     # Log the inputs
-    logger.info(f"Generating story starters with: Theme='{theme}', "
-                f"Category='{category}', Age group='{age_group}'")
-    
-    # Construct the prompt for Gemini
-    prompt = f"""
-    You are a creative assistant for early childhood educators. Your task is to generate 
-    2-3 engaging, open-ended story starters (not full stories) that are age-appropriate 
-    for young children (ages {age_group}).
-    
-    Category: {category}
-    
-    The story starters should be:
-    - Simple and clear language appropriate for young children ages {age_group}
-    - Imaginative and engaging
-    - Open-ended to encourage participation and creativity
-    - 2-3 sentences long (each starter)
-    - Age-appropriate (no scary, violent, or complex themes)
-    - Designed to spark discussion and creative thinking
-    
-    {f"Theme to incorporate: {theme}" if theme else ""}
-    {f"Characters to include: {', '.join(character_ideas)}" if character_ideas else ""}
-    {f"Starting phrase to use or build upon: '{starting_phrase}'" if starting_phrase else ""}
-    
-    Please format your response as a JSON object containing a list of strings:
-    {{
-      "storyStarters": [
-        "string - Starter 1",
-        "string - Starter 2",
-        "string - Starter 3"
-      ]
-    }}
+    logger.debug("Generating story starters with: Theme='%s', Category='%s', Age group='%s'", theme, category, age_group)
+    prompt_started = time.perf_counter()
     
-    Do not include any explanations, only return the JSON object.
-    """
+    characters = clip_items("story", "character_ideas", character_ideas)
+    custom_details = "\n".join(detail for detail in (
+        f"Theme to incorporate: {clip_input('story', 'theme', theme)}" if theme else "",
+        f"Characters to include: {', '.join(characters)}" if characters else "",
+        f"Starting phrase to use or build upon: '{clip_input('story', 'starting_phrase', starting_phrase)}'" if starting_phrase else "",
+    ) if detail)
+    prompt = STORY_PROMPT.render_within_budget("story", STORY_INPUT_TOKEN_BUDGET, dict(
+        age_group=clip_input("story", "age_group", age_group),
+        category=clip_input("story", "category", category),
+        custom_details=custom_details
+    ), elastic=[("custom_details", clip_text)])
+    stage_duration.observe(time.perf_counter() - prompt_started, "story", "prompt_build")
     
     try:
         # Initialize the Gemini model
-        model = get_gemini_model()
-        
-        # Set generation parameters for better JSON responses
-        generation_config = {
-            "temperature": 0.7,  # More creative temperature
-            "response_mime_type": "application/json"  # Request JSON directly
-        }
+        model = STORY_PROMPT.get_model(STORY_GENERATION_CONFIG)
         
         # Call the Gemini API
-        logger.info("Sending request to Gemini API for story starters")
-        response = model.generate_content(
-            prompt,
-            generation_config=generation_config
-        )
+        logger.debug("Sending request to Gemini API for story starters")
+        with StageTimer("story", "model_call"):
+            response = await generate_content_async(
+                model,
+                prompt,
+                priority=PRIORITY_STORY
+            )
         
-        logger.info("Successfully received response from Gemini API")
+        logger.debug("Successfully received response from Gemini API")
         
         # Extract JSON from response
         try:
             # Extract and parse the JSON
-            json_string = extract_json_from_response(response.text)
-            response_data = json.loads(json_string)
+            with StageTimer("story", "json_extract"):
+                json_string = extract_json_from_response(response.text)
+            with StageTimer("story", "json_parse"):
+                response_data = json.loads(json_string)
             
             # Extract story starters
             if 'storyStarters' in response_data and isinstance(response_data['storyStarters'], list):
                 story_starters = response_data['storyStarters']
-                logger.info(f"Successfully generated {len(story_starters)} story starters")
+                logger.debug("Successfully generated %s story starters", len(story_starters))
+                story_cache.set(cache_key, story_starters)
+                semantic_key = story_semantic_key(theme, character_ideas, starting_phrase)
+                if semantic_key and story_semantic_cache is not None:
+                    story_semantic_cache.set(story_semantic_scope(age_group, category), semantic_key, story_starters)
                 return story_starters
             else:
                 logger.warning("Response did not contain expected 'storyStarters' list")
@@ -545,14 +4028,14 @@ async def generate_story_starters_with_gemini(
                     # Look for any list in the response
                     for key, value in response_data.items():
                         if isinstance(value, list) and len(value) > 0:
-                            logger.info(f"Found alternate list under key '{key}', using this instead")
+                            logger.info("Found alternate list under key '%s', using this instead", key)
                             return value
                 
                 # If we couldn't find a usable list, raise an error
                 raise ValueError("Response did not contain a valid list of story starters")
                 
         except json.JSONDecodeError as e:
-            logger.error(f"Failed to parse JSON response: {str(e)}")
+            logger.error("Failed to parse JSON response: %s", e)
             # If JSON parsing fails, attempt to extract text directly
             logger.warning("Attempting to extract plain text response instead")
             
@@ -560,7 +4043,7 @@ async def generate_story_starters_with_gemini(
             potential_starters = re.findall(r'"([^"]+)"', response.text)
             
             if potential_starters:
-                logger.info(f"Extracted {len(potential_starters)} potential starters from text")
+                logger.info("Extracted %s potential starters from text", len(potential_starters))
                 return potential_starters[:3]  # Limit to 3 starters
             
             # If all else fails, return the raw response split by newlines as a fallback
@@ -568,27 +4051,387 @@ async def generate_story_starters_with_gemini(
             lines = [line.strip() for line in response.text.split('\n') if line.strip()]
             return lines[:3]  # Limit to 3 lines as starters
     
-    except genai.types.api_errors.ApiError as api_e:
-        # Handle specific Gemini API errors
-        error_message = str(api_e)
-        error_type = type(api_e).__name__
-        logger.error(f"Gemini API error: {error_type} - {error_message}")
-        
-        if "rate limit" in error_message.lower():
-            raise HTTPException(status_code=429, detail="AI service rate limit exceeded")
-        elif "invalid request" in error_message.lower():
-            raise HTTPException(status_code=400, detail=f"Invalid request to AI service: {error_message}")
-        elif "authentication" in error_message.lower() or "unauthorized" in error_message.lower():
-            raise HTTPException(status_code=401, detail="AI service authentication failed")
-        else:
-            raise HTTPException(status_code=502, detail=f"AI service error: {error_type}")
+    except HTTPException:
+        raise  # Already mapped to a status code (API errors, timeouts)
     
     except Exception as e:
         # General exception handling
-        logger.error(f"Error in generate_story_starters_with_gemini: {type(e).__name__}: {str(e)}")
+        logger.error("Error in generate_story_starters_with_gemini: %s: %s", type(e).__name__, e)
         logger.exception("Full exception details:")
         raise HTTPException(status_code=500, detail=str(e))
 
+# --- Story starter pool ---
+
+class StoryStarterPool:
+    """
+    Pre-generated story starters per (age_group, category) for requests without custom fields.
+
+    Only catalogue age groups and categories are pooled, up to max_buckets of them;
+    other requests go straight to the model and never start a refill. Each starter is served to at most max_serves clients and never twice to the same
+    client. When a bucket falls below the low-water mark, a background task tops it up
+    to the target size with model calls at story priority.
+    """
+    def __init__(
+        self, target_size: int, low_water: int, max_serves: int, max_clients: int, max_buckets: int, catalogue: List[tuple]
+    ):
+        self.target_size = target_size
+        self.low_water = low_water
+        self.max_serves = max_serves
+        self.max_clients = max_clients
+        self.max_buckets = max_buckets
+        self.catalogue = {self.bucket_key(age_group, category): (age_group, category) for age_group, category in catalogue}
+        self.buckets: Dict[tuple, "OrderedDict[str, int]"] = {}  # bucket -> starter -> times served
+        self.known: Dict[tuple, set] = {}  # Every starter a bucket has held, so retired ones are not re-added
+        self.labels: Dict[tuple, tuple] = {}  # bucket -> (age_group, category) as named in the catalogue
+        self.seen: "OrderedDict[str, Dict[tuple, set]]" = OrderedDict()  # client -> bucket -> starters served
+        self.refills: Dict[tuple, asyncio.Task] = {}
+        self.hits = 0
+        self.misses = 0
+        self.generated = 0
+
+    @staticmethod
+    def bucket_key(age_group: str, category: str) -> tuple:
+        return _normalize_text(age_group), _normalize_text(category)
+
+    def accepts(self, age_group: str, category: str) -> bool:
+        """Whether requests for this age group and category are served from the pool"""
+        key = self.bucket_key(age_group, category)
+        return key in self.catalogue and (key in self.buckets or len(self.buckets) < self.max_buckets)
+
+    def _bucket(self, age_group: str, category: str) -> tuple:
+        key = self.bucket_key(age_group, category)
+        if key not in self.buckets:
+            self.buckets[key] = OrderedDict()
+            self.known[key] = set()
+            self.labels[key] = self.catalogue[key]
+            age_group, category = self.catalogue[key]
+            # Seed from starters the curriculum warm-up already generated
+            cached_starters = story_cache.get(story_request_key("", [], "", age_group, category))
+            if cached_starters:
+                self.add(key, cached_starters)
+        return key
+
+    def _client_seen(self, client_id: str, key: tuple) -> set:
+        buckets = self.seen.get(client_id)
+        if buckets is None:
+            buckets = self.seen[client_id] = {}
+            while len(self.seen) > self.max_clients:
+                self.seen.popitem(last=False)
+        self.seen.move_to_end(client_id)
+        return buckets.setdefault(key, set())
+
+    def add(self, key: tuple, starters: List[str]) -> int:
+        """Add new starters to a bucket; returns how many were not already known"""
+        bucket = self.buckets[key]
+        known = self.known[key]
+        added = 0
+        for starter in starters:
+            if not isinstance(starter, str) or not starter.strip() or starter in known:
+                continue
+            known.add(starter)
+            bucket[starter] = 0
+            added += 1
+        self.generated += added
+        return added
+
+    def take(self, age_group: str, category: str, client_id: str, count: int = 3) -> Optional[List[str]]:
+        """Serve count starters this client has not seen, or None if the bucket cannot"""
+        if not self.accepts(age_group, category):
+            return None
+        key = self._bucket(age_group, category)
+        bucket = self.buckets[key]
+        seen = self._client_seen(client_id, key)
+        picks = [starter for starter in bucket if starter not in seen][:count]
+        if len(picks) < count:
+            self.misses += 1
+            self._ensure_refill(key)
+            return None
+
+        for starter in picks:
+            seen.add(starter)
+            bucket[starter] += 1
+            if bucket[starter] >= self.max_serves:
+                del bucket[starter]
+            else:
+                bucket.move_to_end(starter)  # Rotate so other starters are served next
+        self.hits += 1
+        if len(bucket) < self.low_water:
+            self._ensure_refill(key)
+        return picks
+
+    def mark_seen(self, age_group: str, category: str, client_id: str, starters: List[str]):
+        """Record starters a client got from the model so the pool does not serve them again"""
+        if not self.accepts(age_group, category):
+            return
+        self._client_seen(client_id, self._bucket(age_group, category)).update(starters)
+
+    def _ensure_refill(self, key: tuple):
+        task = self.refills.get(key)
+        if task is None or task.done():
+            self.refills[key] = asyncio.ensure_future(self._refill(key))
+
+    async def _refill(self, key: tuple):
+        age_group, category = self.labels[key]
+        bucket = self.buckets[key]
+        rounds_without_new = 0
+        # Identical prompts can return starters the bucket already has; give up after a few such rounds
+        while len(bucket) < self.target_size and rounds_without_new < 3:
+            try:
+                starters = await generate_story_starters_with_gemini(
+                    age_group=age_group,
+                    category=category,
+                    use_cache=False
+                )
+            except Exception as e:
+                detail = e.detail if isinstance(e, HTTPException) else str(e)
+                logger.warning("Story pool refill for %s/%s failed: %s", age_group, category, detail)
+                return
+            rounds_without_new = 0 if self.add(key, starters) else rounds_without_new + 1
+        logger.info("Story pool for %s/%s holds %s starters", age_group, category, len(bucket))
+
+    def stop(self):
+        for task in self.refills.values():
+            if not task.done():
+                task.cancel()
+
+    def stats(self) -> Dict[str, Any]:
+        requests = self.hits + self.misses
+        return {
+            "target_size": self.target_size,
+            "low_water": self.low_water,
+            "max_serves": self.max_serves,
+            "max_buckets": self.max_buckets,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / requests, 4) if requests else 0.0,
+            "generated": self.generated,
+            "clients_tracked": len(self.seen),
+            "refilling": sum(1 for task in self.refills.values() if not task.done()),
+            "buckets": {
+                f"{age_group}/{category}": len(self.buckets[key])
+                for key, (age_group, category) in self.labels.items()
+            },
+        }
+
+story_pool = StoryStarterPool(
+    STORY_POOL_TARGET_SIZE, STORY_POOL_LOW_WATER, STORY_POOL_MAX_SERVES, STORY_POOL_MAX_CLIENTS, STORY_POOL_MAX_BUCKETS,
+    [(age_group, category) for age_group in STORY_AGE_GROUPS for category in STORY_CATEGORIES]
+)
+
+def story_client_id(http_request: Request) -> str:
+    """Identify the client for no-repeat tracking: X-Client-Id header, else the remote address"""
+    client_id = http_request.headers.get("x-client-id")
+    if client_id:
+        return client_id
+    return http_request.client.host if http_request.client else "anonymous"
+
+@app.on_event("shutdown")
+async def stop_story_pool():
+    story_pool.stop()
+
+@app.get("/api/story/pool/stats")
+async def get_story_pool_stats():
+    """Get story starter pool sizes and hit rate"""
+    return story_pool.stats()
+
+# --- Curriculum warm-up ---
+
+class CurriculumWarmer:
+    """
+    Background job that pre-generates lessons and story starters for the whole catalogue.
+
+    Items already cached and younger than WARMUP_MAX_AGE_SECONDS are skipped. Upstream
+    calls are issued one at a time and spaced to stay within the requests-per-minute budget.
+    """
+    def __init__(self, requests_per_minute: float, max_age_seconds: float):
+        self.requests_per_minute = requests_per_minute
+        self.max_age_seconds = max_age_seconds
+        self.task: Optional[asyncio.Task] = None
+        self.runs = 0
+        self.status = "idle"
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+        self.completed = 0
+        self.generated = 0
+        self.skipped = 0
+        self.failed = 0
+        self.last_error: Optional[str] = None
+        self._next_call_at = 0.0
+
+    @staticmethod
+    def lesson_items() -> List[Dict[str, Any]]:
+        return [
+            {"subject": subject["name"], "topic": topic, "challenge_level": level, "learning_style": style}
+            for subject in SUBJECTS
+            for topic in subject["topics"]
+            for level in CHALLENGE_LEVELS
+            for style in LEARNING_STYLES
+        ]
+
+    @staticmethod
+    def story_items() -> List[Dict[str, Any]]:
+        return [
+            {"age_group": age_group, "category": category}
+            for age_group in STORY_AGE_GROUPS
+            for category in STORY_CATEGORIES
+        ]
+
+    @staticmethod
+    def _lesson_key(item: Dict[str, Any]) -> str:
+        return lesson_cache_key(item["topic"], [], item["subject"], item["challenge_level"], item["learning_style"])
+
+    @staticmethod
+    def _story_key(item: Dict[str, Any]) -> str:
+        return story_request_key("", [], "", item["age_group"], item["category"])
+
+    @property
+    def total(self) -> int:
+        return len(self.lesson_items()) + len(self.story_items())
+
+    @property
+    def running(self) -> bool:
+        return self.task is not None and not self.task.done()
+
+    def start(self) -> bool:
+        """Start a warm-up run in the background; returns False if one is already running"""
+        if self.running:
+            return False
+        self.status = "running"
+        self.task = asyncio.ensure_future(self.run())
+        return True
+
+    async def _throttle(self):
+        if self.requests_per_minute <= 0:
+            return  # Unthrottled, like the other *_REQUESTS_PER_MINUTE settings
+        now = time.monotonic()
+        if self._next_call_at > now:
+            await asyncio.sleep(self._next_call_at - now)
+        self._next_call_at = max(self._next_call_at, time.monotonic()) + 60 / self.requests_per_minute
+
+    def _is_fresh(self, cache: GenerationCache, key: str) -> bool:
+        age = cache.age(key)
+        return age is not None and age < self.max_age_seconds
+
+    async def run(self):
+        self.runs += 1
+        self.started_at = time.time()
+        self.finished_at = None
+        self.completed = self.generated = self.skipped = self.failed = 0
+        logger.info("Starting curriculum warm-up of %s items at %s requests/minute", self.total, self.requests_per_minute)
+
+        jobs = [
+            (lesson_cache, self._lesson_key(item), lambda item=item: generate_lesson_content_gemini(
+                student_id=0,
+                last_quiz_score=None,
+                current_topic=item["topic"],
+                learning_objectives=[],
+                subject=item["subject"],
+                challenge_level=item["challenge_level"],
+                learning_style=item["learning_style"],
+                use_cache=False
+            ))
+            for item in self.lesson_items()
+        ] + [
+            (story_cache, self._story_key(item), lambda item=item: generate_story_starters_with_gemini(
+                age_group=item["age_group"],
+                category=item["category"],
+                use_cache=False
+            ))
+            for item in self.story_items()
+        ]
+
+        try:
+            for cache, key, generate in jobs:
+                if self._is_fresh(cache, key):
+                    self.skipped += 1
+                else:
+                    await self._throttle()
+                    try:
+                        await generate()
+                        self.generated += 1
+                    except Exception as e:
+                        self.failed += 1
+                        self.last_error = e.detail if isinstance(e, HTTPException) else str(e)
+                        logger.warning("Warm-up item failed: %s", self.last_error)
+                self.completed += 1
+            self.status = "done"
+        except asyncio.CancelledError:
+            self.status = "cancelled"
+            raise
+        finally:
+            self.finished_at = time.time()
+            logger.info(
+                "Curriculum warm-up %s: %s generated, %s already warm, %s failed",
+                self.status, self.generated, self.skipped, self.failed
+            )
+
+    def _staleness(self, cache: GenerationCache, keys: List[str]) -> Dict[str, Any]:
+        ages = [cache.age(key) for key in keys]
+        cached = [age for age in ages if age is not None]
+        return {
+            "total": len(keys),
+            "fresh": sum(1 for age in cached if age < self.max_age_seconds),
+            "stale": sum(1 for age in cached if age >= self.max_age_seconds),
+            "missing": len(keys) - len(cached),
+            "oldest_age_seconds": round(max(cached), 1) if cached else None,
+        }
+
+    def report(self) -> Dict[str, Any]:
+        return {
+            "status": self.status,
+            "runs": self.runs,
+            "progress": {
+                "completed": self.completed,
+                "total": self.total,
+                "generated": self.generated,
+                "skipped": self.skipped,
+                "failed": self.failed,
+                "last_error": self.last_error,
+            },
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+            "requests_per_minute": self.requests_per_minute,
+            "max_age_seconds": self.max_age_seconds,
+            "lessons": self._staleness(lesson_cache, [self._lesson_key(i) for i in self.lesson_items()]),
+            "story_starters": self._staleness(story_cache, [self._story_key(i) for i in self.story_items()]),
+        }
+
+curriculum_warmer = CurriculumWarmer(WARMUP_REQUESTS_PER_MINUTE, WARMUP_MAX_AGE_SECONDS)
+
+async def _scheduled_warmup():
+    """Re-run the warm-up every WARMUP_INTERVAL_SECONDS"""
+    while True:
+        curriculum_warmer.start()
+        await asyncio.sleep(WARMUP_INTERVAL_SECONDS)
+
+_warmup_scheduler: Optional[asyncio.Task] = None
+
+@app.on_event("startup")
+async def start_curriculum_warmup():
+    global _warmup_scheduler
+    if WARMUP_INTERVAL_SECONDS > 0:
+        _warmup_scheduler = asyncio.ensure_future(_scheduled_warmup())
+    elif WARMUP_ON_STARTUP:
+        curriculum_warmer.start()
+
+@app.on_event("shutdown")
+async def stop_curriculum_warmup():
+    if _warmup_scheduler is not None:
+        _warmup_scheduler.cancel()
+    if curriculum_warmer.running:
+        curriculum_warmer.task.cancel()
+
+@app.get("/admin/warmup")
+async def get_warmup_status():
+    """Get progress of the current warm-up run and cache staleness across the catalogue"""
+    return curriculum_warmer.report()
+
+@app.post("/admin/warmup", status_code=202)
+async def trigger_warmup():
+    """Start a warm-up run now"""
+    started = curriculum_warmer.start()
+    return {"started": started, "status": curriculum_warmer.status}
+
 # --- Subjects and Topics API ---
 @app.get("/api/subjects")
 async def get_subjects():
@@ -603,97 +4446,859 @@ async def get_topics(subject_id: int):
         return subject["topics"]
     raise HTTPException(status_code=404, detail="Subject not found")
 
+# --- Offline bundles ---
+
+BUNDLE_CHUNK_SIZE = 64 * 1024
+BUNDLE_ENCODINGS = {"br": ".br", "gzip": ".gz", "identity": ""}  # In order of preference
+
+class BundleStore:
+    """
+    Versioned NDJSON bundles of stored lessons and cached story starters, for devices to sync offline.
+
+    Each bundle is written to disk once per distinct content, uncompressed and precompressed
+    with gzip (and brotli when installed), under a name that includes its content hash.
+    Requests then stream the file matching the client's Accept-Encoding without re-encoding.
+    A bundle is rebuilt only when the fingerprint of its sources changes.
+    """
+    def __init__(self, directory: str):
+        self.directory = directory
+        self._built: Dict[str, Dict[str, Any]] = {}  # name -> {"source", "version", "records", "last_modified"}
+        self.builds = 0
+        self.flights = SingleFlight("bundle")
+
+    def path(self, name: str, version: str, encoding: str) -> str:
+        return os.path.join(self.directory, f"{name}-{version}.ndjson{BUNDLE_ENCODINGS[encoding]}")
+
+    def _write(self, path: str, data: bytes):
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+    def _build(self, name: str, source: Any, build_records) -> Dict[str, Any]:
+        os.makedirs(self.directory, exist_ok=True)
+        records = build_records()
+        body = "".join(json.dumps(record, sort_keys=True, separators=(",", ":")) + "\n" for record in records)
+        body = body.encode("utf-8")
+        version = hashlib.sha256(body).hexdigest()[:20]
+        encoded = {"identity": lambda: body, "gzip": lambda: gzip.compress(body, 9, mtime=0)}
+        if brotli is not None:
+            encoded["br"] = lambda: brotli.compress(body, quality=11)
+        for encoding, encode in encoded.items():
+            # Another worker may already have written this version
+            if not os.path.exists(self.path(name, version, encoding)):
+                self._write(self.path(name, version, encoding), encode())
+        # Clients still streaming an old version keep their open file after it is removed
+        for filename in os.listdir(self.directory):
+            if filename.startswith(f"{name}-") and not filename.startswith(f"{name}-{version}."):
+                try:
+                    os.remove(os.path.join(self.directory, filename))
+                except OSError:
+                    pass
+        self.builds += 1
+        logger.info("Built offline bundle %s version %s (%s records, %s bytes)", name, version, len(records), len(body))
+        return {
+            "source": source,
+            "version": version,
+            "records": len(records),
+            "last_modified": os.path.getmtime(self.path(name, version, "identity")),
+        }
+
+    async def get(self, name: str, source: Any, build_records) -> Dict[str, Any]:
+        """The current build of a bundle, rebuilding it in a worker thread if its sources changed"""
+        built = self._built.get(name)
+        if built is not None and built["source"] == source:
+            return built
+        loop = asyncio.get_running_loop()
+        built = await self.flights.do(name, lambda: loop.run_in_executor(None, self._build, name, source, build_records))
+        self._built[name] = built
+        return built
+
+    def invalidate(self, name: str):
+        self._built.pop(name, None)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "directory": self.directory,
+            "brotli_enabled": brotli is not None,
+            "builds": self.builds,
+            "bundles": {
+                name: {"version": built["version"], "records": built["records"], "last_modified": built["last_modified"]}
+                for name, built in self._built.items()
+            },
+        }
+
+bundle_store = BundleStore(BUNDLE_DIR)
+
+def _subject_bundle_sources(subject: Dict[str, Any]):
+    repository = _require_lesson_repository()
+    source = (LESSON_PROMPT.id, subject["name"], tuple(subject["topics"]),
+              repository.fingerprint(subject["name"], subject["topics"]))
+
+    def build_records() -> List[Dict[str, Any]]:
+        lessons = repository.export(subject["name"], subject["topics"])
+        records = [
+            {"type": "manifest", "bundle": f"subject-{subject['id']}", "lessons": len(lessons)},
+            {"type": "subject", "id": subject["id"], "name": subject["name"], "topics": subject["topics"]},
+        ]
+        for topic, difficulty, learning_style, lesson_data in lessons:
+            records.append({
+                "type": "lesson",
+                "topic": topic,
+                "difficulty": difficulty,
+                "learning_style": learning_style,
+                "lesson": LessonResponse.model_validate(lesson_data).model_dump(),
+            })
+        return records
+    return source, build_records
+
+def _age_group_bundle_sources(age_group: str):
+    starters = {}
+    for category in STORY_CATEGORIES:
+        cached_starters = story_cache.peek(story_request_key("", [], "", age_group, category))
+        if cached_starters:
+            starters[category] = cached_starters
+    source = (STORY_PROMPT.id, hashlib.sha256(json.dumps(starters, sort_keys=True).encode("utf-8")).hexdigest())
+
+    def build_records() -> List[Dict[str, Any]]:
+        records = [{
+            "type": "manifest", "bundle": f"age-{age_group}", "storyStarters": sum(map(len, starters.values()))
+        }]
+        records += [
+            {"type": "storyStarters", "ageGroup": age_group, "category": category, "starters": category_starters}
+            for category, category_starters in starters.items()
+        ]
+        return records
+    return source, build_records
+
+def _bundle_encoding(accept_encoding: str) -> str:
+    """Best precompressed encoding the client accepts"""
+    accepted = {}
+    for part in accept_encoding.lower().split(","):
+        coding, _, params = part.strip().partition(";")
+        quality = 1.0
+        match = re.search(r"q=([0-9.]+)", params)
+        if match:
+            try:
+                quality = float(match.group(1))
+            except ValueError:
+                continue
+        if coding:
+            accepted[coding.strip()] = quality
+    for encoding in BUNDLE_ENCODINGS:
+        if encoding == "br" and brotli is None:
+            continue
+        if accepted.get(encoding, accepted.get("*", 0.0) if encoding != "identity" else 1.0) > 0:
+            return encoding
+    return "identity"
+
+def _etag_matches(header: str, etag: str) -> bool:
+    """Weak comparison, as used by If-None-Match"""
+    if header.strip() == "*":
+        return True
+    return any(candidate.strip().removeprefix("W/") == etag for candidate in header.split(","))
+
+def _byte_range(header: str, size: int):
+    """
+    Parse a single-range Range header into (start, end) inclusive.
+
+    Returns None to ignore the header (it is malformed or asks for several ranges,
+    so the full body is sent) and "unsatisfiable" when the range lies past the end.
+    """
+    match = re.fullmatch(r"\s*bytes=(\d*)-(\d*)\s*", header)
+    if match is None or match.group(1) == match.group(2) == "":
+        return None
+    if match.group(1) == "":
+        suffix = int(match.group(2))
+        if suffix == 0:
+            return "unsatisfiable"
+        return max(size - suffix, 0), size - 1
+    start = int(match.group(1))
+    end = min(int(match.group(2)), size - 1) if match.group(2) else size - 1
+    if match.group(2) and int(match.group(2)) < start:
+        return None
+    if start >= size:
+        return "unsatisfiable"
+    return start, end
+
+def _read_file_range(f, start: int, length: int):
+    """Yield length bytes of an open file from start, in chunks"""
+    try:
+        f.seek(start)
+        while length > 0:
+            chunk = f.read(min(BUNDLE_CHUNK_SIZE, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
+    finally:
+        f.close()
+
+async def serve_bundle(name: str, sources, http_request: Request) -> Response:
+    """Serve a bundle from disk, honoring If-None-Match, If-Modified-Since, Range and If-Range"""
+    source, build_records = sources
+    encoding = _bundle_encoding(http_request.headers.get("accept-encoding", ""))
+    for attempt in range(2):
+        built = await bundle_store.get(name, source, build_records)
+        try:
+            f = open(bundle_store.path(name, built["version"], encoding), "rb")
+            break
+        except FileNotFoundError:
+            # Another worker replaced the files with a newer version
+            bundle_store.invalidate(name)
+            if attempt:
+                raise HTTPException(status_code=503, detail=f"Bundle {name} is being rebuilt, try again")
+
+    size = os.fstat(f.fileno()).st_size
+    etag = f'"{built["version"]}"' if encoding == "identity" else f'"{built["version"]}-{encoding}"'
+    last_modified = formatdate(built["last_modified"], usegmt=True)
+    headers = {
+        "ETag": etag,
+        "Last-Modified": last_modified,
+        "Cache-Control": "public, no-cache",
+        "Vary": "Accept-Encoding",
+        "Accept-Ranges": "bytes",
+    }
+    if encoding != "identity":
+        headers["Content-Encoding"] = encoding
+
+    if_none_match = http_request.headers.get("if-none-match")
+    if_modified_since = http_request.headers.get("if-modified-since")
+    not_modified = _etag_matches(if_none_match, etag) if if_none_match else False
+    if not if_none_match and if_modified_since:
+        try:
+            not_modified = int(built["last_modified"]) <= parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError):
+            pass
+    if not_modified:
+        f.close()
+        bundle_requests.inc("not_modified")
+        return Response(status_code=304, headers=headers)
+
+    start, end, status = 0, size - 1, 200
+    range_header = http_request.headers.get("range")
+    if_range = http_request.headers.get("if-range")
+    # A range is only valid against the version the client already holds part of
+    if range_header and (not if_range or if_range.strip() in (etag, last_modified)):
+        byte_range = _byte_range(range_header, size)
+        if byte_range == "unsatisfiable":
+            f.close()
+            bundle_requests.inc("unsatisfiable")
+            return Response(status_code=416, headers={**headers, "Content-Range": f"bytes */{size}"})
+        if byte_range is not None:
+            start, end = byte_range
+            status = 206
+            headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+    headers["Content-Length"] = str(end - start + 1)
+    bundle_requests.inc("partial" if status == 206 else "full")
+
+    if http_request.method == "HEAD":
+        f.close()
+        return Response(status_code=status, headers=headers)
+    return StreamingResponse(
+        _read_file_range(f, start, end - start + 1), status_code=status, headers=headers,
+        media_type="application/x-ndjson"
+    )
+
+@app.get("/api/bundles")
+async def list_bundles():
+    """Bundles a device can sync, with the version of each one built so far"""
+    names = [f"subject-{subject['id']}" for subject in SUBJECTS] + [f"age-{age_group}" for age_group in STORY_AGE_GROUPS]
+    urls = [f"/api/bundles/subjects/{subject['id']}" for subject in SUBJECTS]
+    urls += [f"/api/bundles/age-groups/{age_group}" for age_group in STORY_AGE_GROUPS]
+    built = bundle_store.stats()["bundles"]
+    return [{"name": name, "url": url, "current": built.get(name)} for name, url in zip(names, urls)]
+
+@app.api_route("/api/bundles/subjects/{subject_id}", methods=["GET", "HEAD"])
+async def get_subject_bundle(subject_id: int, http_request: Request):
+    """Topics and stored lessons of a subject as an NDJSON bundle"""
+    subject = next((s for s in SUBJECTS if s["id"] == subject_id), None)
+    if subject is None:
+        raise HTTPException(status_code=404, detail="Subject not found")
+    return await serve_bundle(f"subject-{subject_id}", _subject_bundle_sources(subject), http_request)
+
+@app.api_route("/api/bundles/age-groups/{age_group}", methods=["GET", "HEAD"])
+async def get_age_group_bundle(age_group: str, http_request: Request):
+    """Cached story starters for every category of an age group as an NDJSON bundle"""
+    if age_group not in STORY_AGE_GROUPS:
+        raise HTTPException(status_code=404, detail=f"Unknown age group '{age_group}'")
+    return await serve_bundle(f"age-{age_group}", _age_group_bundle_sources(age_group), http_request)
+
+@app.get("/admin/bundles")
+async def get_bundle_stats():
+    return bundle_store.stats()
+
+# --- Conversation memory ---
+
+class Conversation:
+    """
+    Token-budgeted sliding window of chat turns for one conversation.
+
+    Turns that fall out of the window are folded into a short extractive summary,
+    itself capped at a token budget, so the history added to a prompt stays bounded.
+    """
+    def __init__(self, conversation_id: str):
+        self.conversation_id = conversation_id
+        self.turns: deque = deque()  # (role, text, tokens)
+        self.turn_tokens = 0
+        self.summary: deque = deque()  # (snippet, tokens)
+        self.summary_tokens = 0
+        self.last_active = time.time()
+
+    @property
+    def tokens(self) -> int:
+        return self.turn_tokens + self.summary_tokens
+
+    def append(self, role: str, text: str, window_tokens: int, summary_tokens: int):
+        tokens = estimate_tokens(text)
+        self.turns.append((role, text, tokens))
+        self.turn_tokens += tokens
+        self.last_active = time.time()
+
+        # Keep at least the latest turn even if it alone exceeds the window
+        while self.turn_tokens > window_tokens and len(self.turns) > 1:
+            old_role, old_text, old_tokens = self.turns.popleft()
+            self.turn_tokens -= old_tokens
+            self._summarize(old_role, old_text, summary_tokens)
+
+    def _summarize(self, role: str, text: str, summary_tokens: int):
+        first_sentence = re.split(r"(?<=[.!?])\s", text.strip(), maxsplit=1)[0][:160]
+        snippet = f"{'Student asked' if role == 'student' else 'Tutor said'}: {first_sentence}"
+        tokens = estimate_tokens(snippet)
+        self.summary.append((snippet, tokens))
+        self.summary_tokens += tokens
+        while self.summary_tokens > summary_tokens and self.summary:
+            _, dropped_tokens = self.summary.popleft()
+            self.summary_tokens -= dropped_tokens
+
+    def to_prompt_context(self, max_tokens: Optional[int] = None) -> str:
+        """
+        Render the summary and recent turns for inclusion in the tutor prompt.
+
+        Over max_tokens, summary snippets are dropped oldest first, then the oldest
+        turns; the latest turn is kept and cut from the start if it is still too long.
+        """
+        summary = [snippet for snippet, _ in self.summary]
+        turns = [(role, text) for role, text, _ in self.turns]
+        while True:
+            if not turns and not summary:
+                return ""
+            lines = ["Conversation so far:"]
+            if summary:
+                lines.append("Earlier in this conversation: " + " ".join(summary))
+            for role, text in turns:
+                lines.append(f"{'Student' if role == 'student' else 'Tutor'}: {text}")
+            context = "\n".join(lines)
+            if max_tokens is None or estimate_tokens(context) <= max_tokens:
+                return context
+            if summary:
+                summary.pop(0)
+            elif len(turns) > 1:
+                turns.pop(0)
+            else:
+                return clip_text(context, max_tokens, keep_end=True)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "turns": [list(turn) for turn in self.turns],
+            "summary": [list(part) for part in self.summary],
+            "last_active": self.last_active,
+        }
+
+    @classmethod
+    def from_dict(cls, conversation_id: str, data: Dict[str, Any]) -> "Conversation":
+        conversation = cls(conversation_id)
+        conversation.turns = deque(tuple(turn) for turn in data["turns"])
+        conversation.turn_tokens = sum(turn[2] for turn in conversation.turns)
+        conversation.summary = deque(tuple(part) for part in data["summary"])
+        conversation.summary_tokens = sum(part[1] for part in conversation.summary)
+        conversation.last_active = data["last_active"]
+        return conversation
+
+class InMemoryConversationStore:
+    """
+    Process-local conversation store.
+
+    Conversations are kept in least-recently-active order, so idle-TTL expiry and
+    global-cap eviction both pop from the front and append/lookup stay O(1).
+    """
+    name = "memory"
+
+    def __init__(self, window_tokens: int, summary_tokens: int, idle_ttl_seconds: float, max_total_tokens: int):
+        self.window_tokens = window_tokens
+        self.summary_tokens = summary_tokens
+        self.idle_ttl_seconds = idle_ttl_seconds
+        self.max_total_tokens = max_total_tokens
+        self._conversations: "OrderedDict[str, Conversation]" = OrderedDict()
+        self.total_tokens = 0
+        self.evictions = 0
+
+    def _expire(self):
+        cutoff = time.time() - self.idle_ttl_seconds
+        while self._conversations:
+            oldest = next(iter(self._conversations.values()))
+            if oldest.last_active >= cutoff and self.total_tokens <= self.max_total_tokens:
+                break
+            self._conversations.popitem(last=False)
+            self.total_tokens -= oldest.tokens
+            self.evictions += 1
+
+    def get(self, conversation_id: str) -> Optional[Conversation]:
+        self._expire()
+        return self._conversations.get(conversation_id)
+
+    def append(self, conversation_id: str, role: str, text: str):
+        conversation = self._conversations.get(conversation_id)
+        if conversation is None:
+            conversation = self._conversations[conversation_id] = Conversation(conversation_id)
+        before = conversation.tokens
+        conversation.append(role, text, self.window_tokens, self.summary_tokens)
+        self.total_tokens += conversation.tokens - before
+        self._conversations.move_to_end(conversation_id)
+        self._expire()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "backend": self.name,
+            "conversations": len(self._conversations),
+            "total_tokens": self.total_tokens,
+            "max_total_tokens": self.max_total_tokens,
+            "evictions": self.evictions,
+        }
+
+class SQLiteConversationStore:
+    """
+    Persistent conversation store backed by a local SQLite file.
+
+    Each conversation is one row looked up by primary key. Idle and over-cap
+    conversations are swept periodically rather than on every write.
+    """
+    name = "sqlite"
+    SWEEP_EVERY = 50
+
+    def __init__(
+        self,
+        path: str,
+        window_tokens: int,
+        summary_tokens: int,
+        idle_ttl_seconds: float,
+        max_total_tokens: int
+    ):
+        self.path = path
+        self.window_tokens = window_tokens
+        self.summary_tokens = summary_tokens
+        self.idle_ttl_seconds = idle_ttl_seconds
+        self.max_total_tokens = max_total_tokens
+        self._writes = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=5)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS conversations ("
+            "id TEXT PRIMARY KEY, data TEXT NOT NULL, tokens INTEGER NOT NULL, last_active REAL NOT NULL)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS conversations_last_active ON conversations (last_active)")
+
+    def _load(self, conversation_id: str) -> Optional[Conversation]:
+        row = self._db.execute(
+            "SELECT data, last_active FROM conversations WHERE id = ?", (conversation_id,)
+        ).fetchone()
+        if row is None or row[1] < time.time() - self.idle_ttl_seconds:
+            return None
+        return Conversation.from_dict(conversation_id, json.loads(row[0]))
+
+    def get(self, conversation_id: str) -> Optional[Conversation]:
+        with self._lock:
+            return self._load(conversation_id)
+
+    def append(self, conversation_id: str, role: str, text: str):
+        with self._lock:
+            # Read-modify-write in one write transaction so workers sharing the file do not lose turns
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                conversation = self._load(conversation_id) or Conversation(conversation_id)
+                conversation.append(role, text, self.window_tokens, self.summary_tokens)
+                self._db.execute(
+                    "INSERT OR REPLACE INTO conversations (id, data, tokens, last_active) VALUES (?, ?, ?, ?)",
+                    (conversation_id, json.dumps(conversation.to_dict()), conversation.tokens, conversation.last_active)
+                )
+                self._db.execute("COMMIT")
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                raise
+            self._writes += 1
+            if self._writes % self.SWEEP_EVERY == 0:
+                self._sweep()
+
+    def _sweep(self):
+        """Drop idle conversations, then the least recently active ones until under the global cap"""
+        cursor = self._db.execute(
+            "DELETE FROM conversations WHERE last_active < ?", (time.time() - self.idle_ttl_seconds,)
+        )
+        self.evictions += cursor.rowcount
+        total = self._db.execute("SELECT COALESCE(SUM(tokens), 0) FROM conversations").fetchone()[0]
+        if total <= self.max_total_tokens:
+            return
+        for conversation_id, tokens in self._db.execute(
+            "SELECT id, tokens FROM conversations ORDER BY last_active"
+        ).fetchall():
+            self._db.execute("DELETE FROM conversations WHERE id = ?", (conversation_id,))
+            self.evictions += 1
+            total -= tokens
+            if total <= self.max_total_tokens:
+                break
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            count, total = self._db.execute(
+                "SELECT COUNT(*), COALESCE(SUM(tokens), 0) FROM conversations"
+            ).fetchone()
+        return {
+            "backend": self.name,
+            "path": self.path,
+            "conversations": count,
+            "total_tokens": total,
+            "max_total_tokens": self.max_total_tokens,
+            "evictions": self.evictions,
+        }
+
+def create_conversation_store():
+    """Create the conversation store selected by CHAT_MEMORY_BACKEND"""
+    settings = dict(
+        window_tokens=CHAT_MEMORY_WINDOW_TOKENS,
+        summary_tokens=CHAT_MEMORY_SUMMARY_TOKENS,
+        idle_ttl_seconds=CHAT_MEMORY_IDLE_TTL_SECONDS,
+        max_total_tokens=CHAT_MEMORY_MAX_TOTAL_TOKENS,
+    )
+    if CHAT_MEMORY_BACKEND == "sqlite":
+        return SQLiteConversationStore(CHAT_MEMORY_SQLITE_PATH, **settings)
+    if CHAT_MEMORY_BACKEND != "memory":
+        raise ValueError(f"Unknown CHAT_MEMORY_BACKEND '{CHAT_MEMORY_BACKEND}'. Expected 'memory' or 'sqlite'")
+    return InMemoryConversationStore(**settings)
+
+conversation_store = DeferredStore("conversation store", create_conversation_store)
+
+def get_conversation_store():
+    return conversation_store.get()
+
+@app.get("/api/tutoring/memory/stats")
+async def get_conversation_memory_stats():
+    """Get size and eviction counters for the conversation store"""
+    return get_conversation_store().stats()
+
 # --- AI Tutoring Chat Endpoint ---
+
+def build_chat_prompt(request: ChatRequest, conversation: Optional[Conversation] = None) -> str:
+    """Build the tutor prompt for a chat query, optional student profile and conversation history"""
+    # Get or initialize student profile context
+    student_profile = request.studentProfile or {}
+    profile_context = ""
+    
+    if student_profile:
+        interests = clip_items("chat", "interests", student_profile.get("interests") or [])
+        difficulty = clip_input("chat", "preferredDifficulty", str(student_profile.get("preferredDifficulty", "intermediate")))
+        learning_style = clip_input("chat", "learningStyle", str(student_profile.get("learningStyle", "")))
+        
+        profile_context = (
+            "Student Profile Context:\n"
+            f"- Interests: {', '.join(interests) if interests else 'Not specified'}\n"
+            f"- Preferred Difficulty: {difficulty}\n"
+            f"- Learning Style: {learning_style}"
+        )
+    
+    # History gives way first (summary, then oldest turns), then the profile
+    return CHAT_PROMPT.render_within_budget("chat", CHAT_INPUT_TOKEN_BUDGET, dict(
+        profile_context=profile_context,
+        conversation_context=conversation.to_prompt_context() if conversation else "",
+        query=clip_input("chat", "query", request.query)
+    ), elastic=[
+        ("conversation_context", lambda _, max_tokens: conversation.to_prompt_context(max_tokens)),
+        ("profile_context", clip_text),
+    ])
+
+def chat_semantic_scope(request: ChatRequest, conversation: Optional[Conversation]) -> Optional[tuple]:
+    """
+    Scope for the near-duplicate chat cache, or None when the answer depends on
+    earlier turns. Answers are only shared between students whose profiles ask
+    for the same difficulty and learning style.
+    """
+    if chat_semantic_cache is None or (conversation is not None and (conversation.turns or conversation.summary)):
+        return None
+    profile = request.studentProfile or {}
+    return (
+        CHAT_PROMPT.id,
+        bool(profile),
+        str(profile.get("preferredDifficulty", "intermediate")).strip().lower(),
+        str(profile.get("learningStyle", "")).strip().lower(),
+    )
+
+def _sse_event(event: str, data: Dict[str, Any]) -> str:
+    """Format a single Server-Sent Event"""
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+async def _cached_chat_event_stream(ai_response: str, request: ChatRequest):
+    """Replay a near-duplicate cache hit as a single `chunk` event followed by `done`"""
+    conversations = get_conversation_store()
+    conversations.append(request.conversationId, "student", request.query)
+    conversations.append(request.conversationId, "tutor", ai_response)
+    yield _sse_event("chunk", {"text": ai_response})
+    yield _sse_event("done", {
+        "conversationId": request.conversationId,
+        "cached": True,
+        "usage": {
+            "promptChars": 0,
+            "responseChars": len(ai_response),
+            "inputTokens": 0,
+            "outputTokens": 0,
+            "chunks": 1,
+            "timeToFirstChunkMs": 0.0,
+            "totalMs": 0.0,
+        },
+    })
+
+async def _chat_event_stream(model, prompt: str, request: ChatRequest, semantic_scope: Optional[tuple] = None):
+    """Forward model chunks as `chunk` events and finish with a `done` event carrying usage stats"""
+    conversation_id = request.conversationId
+    started = time.perf_counter()
+    first_chunk_ms = None
+    chunk_count = 0
+    response_parts = []
+    try:
+        async for text in stream_content_async(model, prompt, priority=PRIORITY_CHAT):
+            if first_chunk_ms is None:
+                first_chunk_ms = round((time.perf_counter() - started) * 1000, 1)
+            chunk_count += 1
+            response_parts.append(text)
+            yield _sse_event("chunk", {"text": text})
+    except HTTPException as e:
+        error = {"status": e.status_code, "detail": e.detail}
+        if e.headers and "Retry-After" in e.headers:
+            error["retryAfter"] = int(e.headers["Retry-After"])
+        yield _sse_event("error", error)
+        return
+    except Exception as e:
+        logger.error("Error streaming tutoring chat: %s: %s", type(e).__name__, e)
+        yield _sse_event("error", {"status": 500, "detail": f"Error generating response: {str(e)}"})
+        return
+
+    ai_response = "".join(response_parts).strip()
+    usage = request_token_usage.get()
+    conversations = get_conversation_store()
+    conversations.append(conversation_id, "student", request.query)
+    conversations.append(conversation_id, "tutor", ai_response)
+    if semantic_scope is not None and ai_response:
+        chat_semantic_cache.set(semantic_scope, request.query, ai_response)
+
+    logger.debug("Streamed chat response in %s chunks", chunk_count)
+    yield _sse_event("done", {
+        "conversationId": conversation_id,
+        "usage": {
+            "promptChars": len(prompt),
+            "responseChars": len(ai_response),
+            "inputTokens": usage["input"] if usage else CHAT_PROMPT.input_tokens(prompt),
+            "outputTokens": usage["output"] if usage else estimate_tokens(ai_response),
+            "chunks": chunk_count,
+            "timeToFirstChunkMs": first_chunk_ms,
+            "totalMs": round((time.perf_counter() - started) * 1000, 1),
+        },
+    })
+
+@app.post("/api/tutoring/chat/stream")
+async def tutoring_chat_stream(request: ChatRequest):
+    """
+    AI Tutor chat endpoint that streams the reply as Server-Sent Events.
+
+    Emits `chunk` events with partial text as the model produces it, then a final
+    `done` event with the conversationId and usage stats (or an `error` event).
+    """
+    logger.info("Received streaming chat request (%s chars)", len(request.query))
+    conversation = get_conversation_store().get(request.conversationId)
+    semantic_scope = chat_semantic_scope(request, conversation)
+    cached_response = chat_semantic_cache.get(semantic_scope, request.query) if semantic_scope is not None else None
+    if cached_response is not None:
+        logger.info("Chat near-duplicate cache hit")
+        events = _cached_chat_event_stream(cached_response, request)
+    else:
+        model = CHAT_PROMPT.get_model()
+        prompt = build_chat_prompt(request, conversation)
+        events = _chat_event_stream(model, prompt, request, semantic_scope)
+    return StreamingResponse(
+        events,
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
 @app.post("/api/tutoring/chat", response_model=ChatResponse)
-async def tutoring_chat(request: ChatRequest):
+async def tutoring_chat(request: ChatRequest, http_request: Request):
     """AI Tutor chat endpoint for conversational learning"""
+    # Clients that accept an event stream get the streaming variant
+    if "text/event-stream" in http_request.headers.get("accept", ""):
+        return await tutoring_chat_stream(request)
+
     try:
-        logger.info(f"Received chat request: {request.query[:50]}...")
-        
-        # Get or initialize student profile context
-        student_profile = request.studentProfile or {}
-        profile_context = ""
-        
-        if student_profile:
-            interests = student_profile.get("interests", [])
-            difficulty = student_profile.get("preferredDifficulty", "intermediate")
-            learning_style = student_profile.get("learningStyle", "")
-            
-            profile_context = f"""
-            Student Profile Context:
-            - Interests: {', '.join(interests) if interests else 'Not specified'}
-            - Preferred Difficulty: {difficulty}
-            - Learning Style: {learning_style}
-            """
+        logger.info("Received chat request (%s chars)", len(request.query))
+        conversations = get_conversation_store()
+        conversation = conversations.get(request.conversationId)
+
+        # A first question close enough to one already answered reuses that answer
+        semantic_scope = chat_semantic_scope(request, conversation)
+        if semantic_scope is not None:
+            cached_response = chat_semantic_cache.get(semantic_scope, request.query)
+            if cached_response is not None:
+                logger.info("Chat near-duplicate cache hit")
+                conversations.append(request.conversationId, "student", request.query)
+                conversations.append(request.conversationId, "tutor", cached_response)
+                return ChatResponse(response=cached_response, conversationId=request.conversationId)
         
         # Initialize Gemini model
-        model = get_gemini_model()
+        model = CHAT_PROMPT.get_model()
         
-        # Construct the prompt
-        prompt = f"""
-        Act as an AI tutor for elementary school children (ages 5-11). 
-        Your name is KidsPortal AI Edu Assistant.
-        
-        {profile_context}
-        
-        Guidelines:
-        - Be friendly, patient, and encouraging
-        - Use simple language appropriate for young children
-        - Give clear, concise explanations
-        - If asked about a topic you're unsure about, admit limitations politely
-        - Keep responses brief (1-3 sentences for simple questions)
-        - Include examples when helpful
-        - Use analogies that children can relate to
-        - Include child-friendly images/visuals when possible
-        - Use visual descriptions and references that would help children visualize concepts
-        - Be supportive and positive in your responses
-        - Do not include any harmful, inappropriate, or sensitive content
-        
-        Please respond to the following query with kid-friendly visuals when appropriate: "{request.query}"
-        """
+        with StageTimer("chat", "prompt_build"):
+            prompt = build_chat_prompt(request, conversation)
         
         # Call Gemini API
-        logger.info("Sending request to Gemini API for tutoring chat")
-        response = model.generate_content(prompt)
+        logger.debug("Sending request to Gemini API for tutoring chat")
+        with StageTimer("chat", "model_call"):
+            response = await generate_content_async(model, prompt, http_request=http_request, priority=PRIORITY_CHAT)
         
         # Process response
         ai_response = response.text.strip()
-        logger.info(f"Successfully generated response: {ai_response[:50]}...")
+        logger.debug("Generated chat response (%s chars)", len(ai_response))
+
+        conversations.append(request.conversationId, "student", request.query)
+        conversations.append(request.conversationId, "tutor", ai_response)
+        if semantic_scope is not None and ai_response:
+            chat_semantic_cache.set(semantic_scope, request.query, ai_response)
         
         return ChatResponse(
             response=ai_response,
             conversationId=request.conversationId
         )
         
-    except genai.types.api_errors.ApiError as api_e:
-        # Handle specific Gemini API errors
-        error_message = str(api_e)
-        error_type = type(api_e).__name__
-        logger.error(f"Gemini API error: {error_type} - {error_message}")
-        
-        if "rate limit" in error_message.lower():
-            raise HTTPException(status_code=429, detail="AI service rate limit exceeded")
-        elif "invalid request" in error_message.lower():
-            raise HTTPException(status_code=400, detail=f"Invalid request to AI service: {error_message}")
-        elif "authentication" in error_message.lower() or "unauthorized" in error_message.lower():
-            raise HTTPException(status_code=401, detail="AI service authentication failed")
-        else:
-            raise HTTPException(status_code=502, detail=f"AI service error: {error_type}")
+    except HTTPException:
+        raise  # Already mapped to a status code (API errors, timeouts)
     
     except Exception as e:
         # General exception handling
-        logger.error(f"Error in tutoring_chat endpoint: {type(e).__name__}: {str(e)}")
+        logger.error("Error in tutoring_chat endpoint: %s: %s", type(e).__name__, e)
         logger.exception("Full exception details:")
         raise HTTPException(status_code=500, detail=f"Error generating response: {str(e)}")
 
+# --- Startup and readiness ---
+
+_model_warmup: Optional[asyncio.Future] = None
+
+def _prepare_model_clients():
+    """Build the LLM backend and the model client of every prompt template"""
+    for template, generation_config in (
+        (LESSON_PROMPT, LESSON_GENERATION_CONFIG), (STORY_PROMPT, STORY_GENERATION_CONFIG), (CHAT_PROMPT, None)
+    ):
+        template.get_model(generation_config)
+
+def _log_model_warmup(future: asyncio.Future):
+    error = future.exception()
+    if error is None:
+        logger.info("Model clients ready")
+    else:
+        logger.error("Model client warm-up failed: %s", getattr(error, "detail", error))
+
+@app.on_event("startup")
+async def start_model_warmup():
+    """Import the SDK and build model clients off the event loop, so the server takes requests at once"""
+    global _model_warmup
+    _model_warmup = asyncio.get_running_loop().run_in_executor(None, _prepare_model_clients)
+    _model_warmup.add_done_callback(_log_model_warmup)
+
+DEFERRED_STORES = [shared_store, lesson_store, mastery_store, quiz_store, conversation_store]
+
+def _open_stores():
+    """Open every deferred store; a store that fails records its error and is retried on first use"""
+    for store in DEFERRED_STORES:
+        try:
+            store.get()
+        except HTTPException:
+            pass
+
+@app.on_event("startup")
+async def start_store_warmup():
+    """Open the shared cache and load the lesson, mastery, quiz and conversation stores off the event loop"""
+    asyncio.get_running_loop().run_in_executor(None, _open_stores)
+
+def _deferred_store_check(store: DeferredStore) -> str:
+    if not store.opened:
+        return f"error: {store.error}" if store.error else "starting"
+    opened = store.peek()
+    # In-memory stores have no database to query
+    return _database_check(opened if getattr(opened, "_db", None) is not None else None)
+
+def _database_check(store) -> str:
+    """Run a trivial query against a SQLite-backed store"""
+    if store is None:
+        return "disabled"
+    try:
+        with store._lock:
+            store._db.execute("SELECT 1").fetchone()
+        return "ok"
+    except sqlite3.Error as e:
+        return f"error: {e}"
+
+@app.get("/ready")
+async def readiness_check():
+    """Readiness probe: 200 once the model client and stores are usable, 503 until then"""
+    if _model_warmup is not None and _model_warmup.done() and _model_warmup.exception() is None:
+        model_status = "ok"
+    elif _llm_backend_error is not None:
+        model_status = f"error: {_llm_backend_error}"
+    elif _model_warmup is not None and _model_warmup.done():
+        error = _model_warmup.exception()
+        model_status = f"error: {type(error).__name__}: {getattr(error, 'detail', error)}"
+    else:
+        model_status = "starting"
+    checks = {
+        "model": model_status,
+        "shared_cache": _deferred_store_check(shared_store),
+        "lesson_store": _deferred_store_check(lesson_store),
+        "mastery_store": _deferred_store_check(mastery_store),
+        "quiz_store": _deferred_store_check(quiz_store),
+        "conversation_store": _deferred_store_check(conversation_store),
+    }
+    ready = all(status in ("ok", "disabled") for status in checks.values())
+    return JSONResponse({"status": "ready" if ready else "not_ready", "checks": checks}, status_code=200 if ready else 503)
+
 # --- Health check --- 
 @app.get("/health")
 async def health_check():
     """Health check endpoint"""
-    logger.info("Health check endpoint called")
+    logger.debug("Health check endpoint called")
     return {"status": "healthy", "message": "KidsMentor API is running"}
 
+@app.get("/metrics", response_class=PlainTextResponse)
+async def metrics():
+    """Prometheus text-format metrics"""
+    return PlainTextResponse(render_metrics(), media_type="text/plain; version=0.0.4")
+
 # --- Run the application ---
 if __name__ == "__main__":
+    import argparse
     import uvicorn
-    uvicorn.run("main:app", host="0.0.0.0", port=8000, reload=True) 
\ No newline at end of file
+
+    # Before the argument defaults are read; workers and the reloader inherit the environment
+    load_environment()
+    parser = argparse.ArgumentParser(description="Run the KidsMentor API server")
+    parser.add_argument("--production", action="store_true", help="several workers and no auto-reload")
+    parser.add_argument("--host", default=os.getenv("HOST", "0.0.0.0"))
+    parser.add_argument("--port", type=int, default=int(os.getenv("PORT", "8000")))
+    parser.add_argument(
+        "--workers", type=int, default=int(os.getenv("WEB_CONCURRENCY", "0")) or os.cpu_count() or 1,
+        help="worker processes in production mode (default: WEB_CONCURRENCY or the CPU count)"
+    )
+    args = parser.parse_args()
+
+    # The app logs one line per request itself, with sampling
+    if args.production:
+        if args.workers > 1 and os.getenv("CACHE_BACKEND", "local").lower() != "sqlite":
+            logger.warning("Running %s workers with CACHE_BACKEND=local; caches are not shared between them", args.workers)
+        uvicorn.run("main:app", host=args.host, port=args.port, workers=args.workers, access_log=False)
+    else:
+        uvicorn.run("main:app", host=args.host, port=args.port, reload=True, access_log=False)
@@ -4,7 +4,7 @@ echo "Starting KidsMentor Education Portal..."
 
 # Start the backend server
 echo "Starting backend server..."
-(cd backend && source venv/bin/activate && uvicorn main:app --reload) &
+(cd backend && source venv/bin/activate && python main.py) &
 BACKEND_PID=$!
 
 # Wait a moment for the backend to initialize